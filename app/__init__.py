@@ -5,7 +5,7 @@ from sqlalchemy import func
 import os
 
 # 导入数据库和模型
-from app.utils.db_manager import db, User, get_config, set_config
+from app.utils.db_manager import db, User, get_config, set_config, backfill_history_rollups, backfill_latest_states
 # 导入 LoginManager
 from app.utils.login_manager import login_manager
 # 导入 APScheduler
@@ -13,7 +13,7 @@ from app.utils.scheduler import scheduler
 
 # 导入定时任务函数
 # [修改说明] 这里导入的函数现在已经不再需要 app 参数了
-from app.modules.data_core.komari_api import run_periodic_static_sync, run_periodic_snapshot_sync
+from app.modules.data_core.komari_api import run_periodic_static_sync, run_periodic_snapshot_sync, run_periodic_retention_prune
 
 def create_app(config_class=Config):
     # 初始化 Flask 应用
@@ -42,6 +42,7 @@ def create_app(config_class=Config):
     # 初始化变量，确保它们在外部可用
     snapshot_interval = 5
     static_sync_interval = 60
+    retention_interval = 6
     
     # 4. 应用上下文初始化 (数据库与默认设置)
     with app.app_context():
@@ -54,14 +55,28 @@ def create_app(config_class=Config):
         # 初始化应用配置
         init_default_settings()
 
+        # 按设置初始化链接解析缓存
+        init_link_parser()
+
+        # 升级后首次启动：用已有快照回填小时/天汇总表及节点最新状态 (需在调度器启动前完成)
+        init_history_rollups()
+        backfill_latest_states()
+
+        # 升级后首次启动：把旧版 local_nodes.json 导入数据库
+        init_local_nodes_import()
+
         # 安全地读取配置
         try:
             snapshot_interval = int(get_config('ACQUISITION_INTERVAL_MINUTES', 5))
+            snapshot_tick = int(get_config('SNAPSHOT_TICK_SECONDS', 30))
             static_sync_interval = int(get_config('STATIC_SYNC_INTERVAL_MINUTES', 60))
+            retention_interval = int(get_config('RETENTION_PRUNE_INTERVAL_HOURS', 6))
         except (ValueError, TypeError) as e:
             print(f"警告: 配置间隔时间读取失败或格式错误，使用默认值。错误: {e}")
             snapshot_interval = 5
+            snapshot_tick = 30
             static_sync_interval = 60
+            retention_interval = 6
             
     # 5. 初始化并启动调度器
     scheduler.init_app(app)
@@ -75,19 +90,19 @@ def create_app(config_class=Config):
     if not app.debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
         scheduler.start()
         
-        # 注册任务 1: 高频快照
+        # 注册任务 1: 高频快照 (每次只采集已到期的节点，各节点的间隔由调度状态决定)
         if not scheduler.get_job('periodic_snapshot_sync'):
             scheduler.add_job(
                 id='periodic_snapshot_sync',
                 func=run_periodic_snapshot_sync,
                 trigger='interval',
-                minutes=snapshot_interval,
+                seconds=snapshot_tick,
                 max_instances=1,
                 replace_existing=True, 
                 # 清空 args，绝对不能传递 app 对象
                 args=[] 
             )
-            print(f">>> [Scheduler] 快照同步任务已启动 (每 {snapshot_interval} 分钟)")
+            print(f">>> [Scheduler] 快照同步任务已启动 (每 {snapshot_tick} 秒检查到期节点，基础间隔 {snapshot_interval} 分钟)")
 
         # 注册任务 2: 低频静态信息
         if not scheduler.get_job('periodic_static_sync'):
@@ -103,6 +118,19 @@ def create_app(config_class=Config):
             )
             print(f">>> [Scheduler] 静态信息同步任务已启动 (每 {static_sync_interval} 分钟)")
 
+        # 注册任务 3: 过期数据清理
+        if not scheduler.get_job('periodic_retention_prune'):
+            scheduler.add_job(
+                id='periodic_retention_prune',
+                func=run_periodic_retention_prune,
+                trigger='interval',
+                hours=retention_interval,
+                max_instances=1,
+                replace_existing=True,
+                args=[]
+            )
+            print(f">>> [Scheduler] 过期数据清理任务已启动 (每 {retention_interval} 小时)")
+
     return app
 
 def register_blueprints(app):
@@ -147,9 +175,64 @@ def init_default_settings():
         'KOMARI_BASE_URL': {'value': 'http://127.0.0.1:8888', 'desc': 'API 地址'},
         'RAW_DATA_RETENTION_DAYS': {'value': 30, 'desc': '数据库数据保留天数'},
         'ACQUISITION_INTERVAL_MINUTES': {'value': 5, 'desc': '节点流量同步间隔(分)'},
-        'STATIC_SYNC_INTERVAL_MINUTES': {'value': 60, 'desc': '节点列表同步间隔(分)'}
+        'STATIC_SYNC_INTERVAL_MINUTES': {'value': 60, 'desc': '节点列表同步间隔(分)'},
+        'SNAPSHOT_MAX_WORKERS': {'value': 16, 'desc': '快照采集并发数'},
+        'SNAPSHOT_NODE_TIMEOUT_SECONDS': {'value': 15, 'desc': '单节点快照超时(秒)'},
+        'SNAPSHOT_CYCLE_TIMEOUT_SECONDS': {'value': 240, 'desc': '单轮快照采集总时限(秒)'},
+        'SNAPSHOT_TICK_SECONDS': {'value': 30, 'desc': '快照调度检查到期节点的间隔(秒)'},
+        'SNAPSHOT_ADAPTIVE': {'value': 1, 'desc': '按节点流量自适应调整采集间隔(1开启/0关闭)'},
+        'SNAPSHOT_MIN_INTERVAL_SECONDS': {'value': 60, 'desc': '繁忙节点最短采集间隔(秒)'},
+        'SNAPSHOT_MAX_INTERVAL_SECONDS': {'value': 1800, 'desc': '空闲/失败节点最长采集间隔(秒)'},
+        'SNAPSHOT_BUSY_BYTES_PER_SEC': {'value': 1048576, 'desc': '流量速率高于此值(字节/秒)时加快采集'},
+        'SNAPSHOT_IDLE_BYTES_PER_SEC': {'value': 1024, 'desc': '流量速率低于此值(字节/秒)时放慢采集'},
+        'KOMARI_HTTP_POOL_SIZE': {'value': 32, 'desc': 'Komari API 连接池大小'},
+        'KOMARI_HTTP_RETRIES': {'value': 2, 'desc': 'Komari API 请求失败重试次数'},
+        'RETENTION_PRUNE_INTERVAL_HOURS': {'value': 6, 'desc': '过期数据清理间隔(小时)'},
+        'HISTORY_PRUNE_BATCH_SIZE': {'value': 5000, 'desc': '过期数据每批删除行数'},
+        'HISTORY_ROLLUP_ON_PRUNE': {'value': 1, 'desc': '清理前按天汇总流量(1开启/0关闭)'},
+        'HOURLY_ROLLUP_RETENTION_DAYS': {'value': 365, 'desc': '小时流量汇总保留天数'},
+        'LINK_PARSE_CACHE_SIZE': {'value': 8192, 'desc': '节点链接解析缓存条目数(0关闭)'},
+        'LINK_PARSE_PROCESSES': {'value': 0, 'desc': '大量链接时用多进程解析(1开启/0关闭，fork 多线程进程有风险)'},
+        'GEOIP_CACHE_TTL_HOURS': {'value': 168, 'desc': 'IP归属地缓存有效期(小时)'},
+        'GEOIP_NEGATIVE_TTL_MINUTES': {'value': 30, 'desc': 'IP归属地查询失败后的重试间隔(分钟)'},
+        'GEOIP_LOCAL_DB_PATH': {'value': '', 'desc': '本地IP段数据库CSV路径(留空不启用)'},
+        'GEOIP_ONLINE_FALLBACK': {'value': 1, 'desc': '本地查不到时使用在线接口查询归属地(1开启/0关闭)'}
     }
     
     for key, data in default_settings.items():
         if get_config(key) is None:
             set_config(key, data['value'], data['desc'])
+
+def init_link_parser():
+    """按 LINK_PARSE_CACHE_SIZE 等设置初始化链接解析缓存 (单条解析在首次生成配置前就会用到缓存)"""
+    from app.modules.subscription.routes import apply_link_parser_settings
+    apply_link_parser_settings()
+
+def init_history_rollups():
+    """检查并回填流量汇总表 (只执行一次)"""
+    if get_config('HISTORY_ROLLUP_BACKFILLED') == '1':
+        return
+    print(">>> 初始化: 正在用历史快照回填小时/天流量汇总，数据量大时可能需要一些时间...")
+    try:
+        filled = backfill_history_rollups()
+    except Exception as e:
+        # 不标记完成，下次启动重试
+        print(f"!!! 初始化: 流量汇总回填失败: {e}")
+        return
+    set_config('HISTORY_ROLLUP_BACKFILLED', 1, '流量汇总已回填(1)')
+    print(f">>> 初始化: 流量汇总回填完成 ({filled} 个节点日)")
+
+def init_local_nodes_import():
+    """把旧版 local_nodes.json 导入 local_nodes 表 (只执行一次)"""
+    if get_config('LOCAL_NODES_IMPORTED') == '1':
+        return
+    from app.modules.subscription.routes import import_local_nodes_json
+    try:
+        imported = import_local_nodes_json()
+    except Exception as e:
+        # 不标记完成，下次启动重试
+        print(f"!!! 初始化: 导入 local_nodes.json 失败: {e}")
+        return
+    set_config('LOCAL_NODES_IMPORTED', 1, '本地节点已从JSON导入数据库(1)')
+    if imported:
+        print(f">>> 初始化: 已从 local_nodes.json 导入 {imported} 个节点")
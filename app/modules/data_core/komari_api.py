@@ -1,20 +1,35 @@
 import requests
+import hashlib
 import json
+import socket
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
 from flask import Blueprint, jsonify, current_app
+from flask_login import login_required
 
 # ----------------------------------------------------
 # 从 db_manager 导入所有需要的数据库操作接口
 # ----------------------------------------------------
 from app.utils.db_manager import (
     get_config,          # 用于读取 Komari URL/Token
-    upsert_node,         # 用于同步节点列表
-    get_all_nodes,       # 用于获取需要监控的节点UUID
-    bulk_add_history     # 用于批量写入历史数据 (性能优化)
+    set_config,          # 用于记录节点列表的 ETag / 摘要
+    bulk_upsert_nodes,   # 用于同步节点列表 (批量，只写变化的节点)
+    get_node_poll_states, # 用于获取节点UUID及各自的采集调度状态
+    save_node_poll_states, # 用于保存采集后的调度状态
+    bulk_add_history,    # 用于批量写入历史数据 (性能优化)
+    prune_history_data,  # 用于清理过期的历史数据
+    prune_hourly_rollups, # 用于清理过期的小时汇总
+    prune_geoip_cache,    # 用于清理过期的 IP 归属地缓存
+    # 节点列表变化检测信息的配置键
+    NODE_LIST_ETAG_KEY, NODE_LIST_LAST_MODIFIED_KEY, NODE_LIST_DIGEST_KEY
 )
 
 # [新增] 导入全局 scheduler 对象，用于获取绑定的 app 实例
 from app.utils.scheduler import scheduler
+# 共享的连接池 HTTP 会话 (keep-alive / 重试 / gzip)
+from app.utils.http_client import get_http_session
 
 # ----------------------------------------------------
 # 基础配置和辅助函数
@@ -43,6 +58,34 @@ def _get_komari_headers():
     }
     return headers
 
+def _get_int_config(key, default):
+    """
+    读取整数型配置，格式错误或非正数时回退到默认值。
+    """
+    try:
+        value = int(get_config(key, default))
+        return value if value > 0 else default
+    except (ValueError, TypeError):
+        return default
+
+def _get_komari_retries():
+    try:
+        return max(0, int(get_config('KOMARI_HTTP_RETRIES', 2)))
+    except (ValueError, TypeError):
+        return 2
+
+def _get_komari_session(snapshot=False):
+    """
+    获取访问 Komari API 的共享 HTTP 会话。
+    连接池大小与重试次数可在设置中调整 (KOMARI_HTTP_POOL_SIZE / KOMARI_HTTP_RETRIES)。
+    snapshot=True 时返回快照采集专用会话：不做任何重试，单节点耗时由 SNAPSHOT_NODE_TIMEOUT_SECONDS 严格限制
+    (失败的节点由快照调度按失败次数退避，下次到期再采集)。
+    """
+    pool_size = _get_int_config('KOMARI_HTTP_POOL_SIZE', 32)
+    if snapshot:
+        return get_http_session(pool_size=pool_size, retries=0, name='snapshot')
+    return get_http_session(pool_size=pool_size, retries=_get_komari_retries())
+
 def _extract_nested_value(data, keys, default=0.0):
     """
     辅助函数：安全地从嵌套字典中提取值 (例如 'cpu.usage')
@@ -59,29 +102,69 @@ def _extract_nested_value(data, keys, default=0.0):
 # 核心功能实现
 # =========================================================
 
-def sync_node_list():
+def _save_node_list_validators(etag, last_modified, digest):
+    """记录本次节点列表的校验信息 (只写有变化的项，避免无谓地刷新配置版本)"""
+    values = {
+        NODE_LIST_ETAG_KEY: (etag or '', '节点列表 ETag(自动维护)'),
+        NODE_LIST_LAST_MODIFIED_KEY: (last_modified or '', '节点列表 Last-Modified(自动维护)'),
+        NODE_LIST_DIGEST_KEY: (digest, '节点列表内容摘要(自动维护)'),
+    }
+    for key, (value, desc) in values.items():
+        if get_config(key, '') != value:
+            set_config(key, value, desc)
+
+def sync_node_list(force=False):
     """
     [功能一：同步节点列表]
     从远程 API 获取节点列表并更新到本地数据库。
+    变化检测 (force=True 时跳过)：
+    1. 上游支持 ETag / Last-Modified 时发送条件请求，304 直接返回
+    2. 否则比较响应内容摘要，与上次相同则不解析、不访问数据库
+    3. 内容变化时由 bulk_upsert_nodes 逐节点比对，只写变化的节点
     """
     base_url = _get_komari_base_url()
     url = f"{base_url}/api/nodes"
     headers = _get_komari_headers()
+    last_digest = None if force else get_config(NODE_LIST_DIGEST_KEY, '')
+
+    if last_digest:
+        etag = get_config(NODE_LIST_ETAG_KEY, '')
+        last_modified = get_config(NODE_LIST_LAST_MODIFIED_KEY, '')
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
 
     print(f"[{datetime.now().strftime('%H:%M:%S')}] 尝试同步 Komari 节点列表...")
     
     try:
-        response = requests.get(url, headers=headers, timeout=60)
+        response = _get_komari_session().get(url, headers=headers, timeout=60)
+        if response.status_code == 304:
+            print(f"[{datetime.now().strftime('%H:%M:%S')}] 节点列表未变化 (304)，跳过。")
+            return True
         response.raise_for_status() 
+
+        digest = hashlib.sha256(response.content).hexdigest()
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if digest == last_digest:
+            _save_node_list_validators(etag, last_modified, digest)
+            print(f"[{datetime.now().strftime('%H:%M:%S')}] 节点列表内容未变化，跳过。")
+            return True
+
         data = response.json()
 
         if data.get('status') == 'success':
-            node_count = 0
-            for node_info in data.get('data', []):
-                upsert_node(node_info) # 数据库写操作
-                node_count += 1
-            
-            print(f"[{datetime.now().strftime('%H:%M:%S')}] 成功同步 {node_count} 个节点信息。")
+            # 批量写入：只更新内容有变化的节点，整批一个事务
+            result = bulk_upsert_nodes(data.get('data', []))
+            if result is None:
+                print(f"[{datetime.now().strftime('%H:%M:%S')}] 节点信息写入数据库失败。")
+                return False
+
+            node_count, changed_count = result
+            # 写库成功后才记录校验信息，失败时下次会重新处理
+            _save_node_list_validators(etag, last_modified, digest)
+            print(f"[{datetime.now().strftime('%H:%M:%S')}] 成功同步 {node_count} 个节点信息 (变化 {changed_count} 个)。")
             return True
         else:
             print(f"[{datetime.now().strftime('%H:%M:%S')}] Komari API 返回错误: {data.get('message')}")
@@ -97,90 +180,296 @@ def sync_node_list():
         print(f"[{datetime.now().strftime('%H:%M:%S')}] 同步节点列表发生未知错误: {e}")
         return False
 
-def fetch_and_save_snapshots():
+def _fetch_node_snapshot(session, base_url, headers, uuid, timeout, connect_timeout, inflight):
+    """
+    [线程池任务] 获取单个节点的最新快照，整个请求 (连接 + 等待响应 + 读取正文) 不超过 timeout 秒。
+    注意：该函数运行在子线程中，没有 Flask 应用上下文，禁止访问数据库。
+    收到响应头后把 (截止时间, 响应) 登记到 inflight，主线程在截止时间后关闭连接，中断慢速读取。
+    返回待写入的记录字典；节点无数据时返回 None。
+    """
+    deadline = time.monotonic() + timeout
+    url = f"{base_url}/api/recent/{uuid}"
+    # (连接超时, 读取超时)：两者之和不超过单节点时限
+    response = session.get(url, headers=headers, timeout=(connect_timeout, max(1, timeout - connect_timeout)), stream=True)
+    inflight[uuid] = (deadline, response)
+    try:
+        response.raise_for_status()
+        body = response.content
+    except Exception:
+        if time.monotonic() >= deadline:
+            raise TimeoutError(f"超过单节点时限 {timeout}s")
+        raise
+    finally:
+        inflight.pop(uuid, None)
+        response.close()
+    if time.monotonic() >= deadline:
+        raise TimeoutError(f"超过单节点时限 {timeout}s")
+    data = json.loads(body)
+
+    snapshot_data = data.get('data', [])
+    if not snapshot_data:
+        return None
+
+    # 取最新的一个快照点
+    latest_snapshot = snapshot_data[-1]
+
+    return {
+        'uuid': uuid,
+        'total_up': _extract_nested_value(latest_snapshot, 'network.totalUp'),
+        'total_down': _extract_nested_value(latest_snapshot, 'network.totalDown'),
+        'cpu_usage': _extract_nested_value(latest_snapshot, 'cpu.usage'),
+    }
+
+# ----------------------------------------------------
+# 快照采集调度 (每个节点独立的采集间隔)
+# ----------------------------------------------------
+
+def _abort_inflight(inflight, force=False):
+    """关闭已超过截止时间 (force=True 时为全部) 的快照请求连接，使工作线程中的读取立即失败退出"""
+    now = time.monotonic()
+    for uuid, (deadline, response) in list(inflight.items()):
+        if force or now >= deadline:
+            # 仅关闭响应对象不会打断另一个线程中正在阻塞的 recv，需要直接 shutdown 底层 socket
+            sock = getattr(getattr(response.raw, '_connection', None), 'sock', None)
+            try:
+                if sock is not None:
+                    sock.shutdown(socket.SHUT_RDWR)
+                response.close()
+            except Exception:
+                pass
+
+def _get_snapshot_schedule_config():
+    """读取快照调度相关配置，返回 (基础间隔, 最短间隔, 最长间隔, 是否自适应, 繁忙速率, 空闲速率)"""
+    base = _get_int_config('ACQUISITION_INTERVAL_MINUTES', 5) * 60
+    min_interval = min(_get_int_config('SNAPSHOT_MIN_INTERVAL_SECONDS', 60), base)
+    max_interval = max(_get_int_config('SNAPSHOT_MAX_INTERVAL_SECONDS', 1800), base)
+    adaptive = str(get_config('SNAPSHOT_ADAPTIVE', '1')).strip().lower() in ['1', 'true', 'on', 'yes']
+    busy_rate = _get_int_config('SNAPSHOT_BUSY_BYTES_PER_SEC', 1048576)
+    idle_rate = _get_int_config('SNAPSHOT_IDLE_BYTES_PER_SEC', 1024)
+    return base, min_interval, max_interval, adaptive, busy_rate, idle_rate
+
+def _next_due_time(uuid, interval, now):
+    """
+    计算节点下一次采集时间：按 UUID 哈希在间隔内取一个固定相位，
+    使同一间隔的节点均匀分散在整个周期内，而不是同一时刻集中请求。
+    返回 (now, now + interval] 内满足 (t - 相位) % interval == 0 的时刻。
+    """
+    phase = zlib.crc32(uuid.encode('utf-8')) % interval
+    now_ts = now.timestamp()
+    due_ts = now_ts + interval - ((now_ts - phase) % interval)
+    return datetime.fromtimestamp(due_ts)
+
+def _next_poll_interval(state, record, now, config):
+    """
+    根据本次采集结果计算节点新的采集间隔 (秒)，同时更新 state 中的速率 / 失败次数。
+    - 采集失败或无数据：按失败次数指数退避，最长不超过最长间隔
+    - 流量速率 >= 繁忙速率：间隔减半 (不低于最短间隔)
+    - 流量速率 < 空闲速率：间隔加倍 (不超过最长间隔)
+    - 其余情况：回到基础间隔
+    """
+    base, min_interval, max_interval, adaptive, busy_rate, idle_rate = config
+
+    if record is None:
+        state['failures'] = (state.get('failures') or 0) + 1
+        if not adaptive:
+            return base
+        return min(max_interval, base * 2 ** min(state['failures'], 10))
+
+    state['failures'] = 0
+    total = int((record.get('total_up') or 0) + (record.get('total_down') or 0))
+    # 速率按上一次成功采样计算 (中间失败的采集没有计数器，不能作为起点)
+    last_total, last_sample_at = state.get('last_total'), state.get('last_sample_at')
+    state['last_total'] = total
+    state['last_sample_at'] = now
+
+    rate = None
+    if last_total is not None and last_sample_at is not None:
+        elapsed = (now - last_sample_at).total_seconds()
+        if elapsed > 0:
+            # 计数器回绕 (节点重启) 时，当前值即为重启后的增量
+            delta = total - last_total if total >= last_total else total
+            rate = delta / elapsed
+    state['last_rate'] = rate
+
+    current = state.get('interval_seconds') or base
+    if not adaptive or rate is None:
+        return base
+    if rate >= busy_rate:
+        return max(min_interval, min(current, base) // 2)
+    if rate < idle_rate:
+        return min(max_interval, max(current, base) * 2)
+    return base
+
+def fetch_and_save_snapshots(due_only=False):
     """
     [功能二：获取节点快照]
-    遍历所有节点，获取实时状态并存入历史记录表。
+    并发获取节点的实时状态，并在本轮结束时一次性写入历史记录表及各节点的调度状态。
+    due_only=True 时 (定时调度) 只采集 next_due_at 已到期的节点；False 时 (手动刷新) 采集全部节点。
+    - SNAPSHOT_MAX_WORKERS: 并发数 (线程池大小)
+    - SNAPSHOT_NODE_TIMEOUT_SECONDS: 单节点请求超时
+    - SNAPSHOT_CYCLE_TIMEOUT_SECONDS: 整轮采集的总时限，超时未返回的节点本轮直接放弃
     """
-    base_url = _get_komari_base_url()
-    
-    # 1. 从数据库获取所有活动的节点 UUID
-    nodes = get_all_nodes() 
-    if not nodes:
+    now = datetime.now()
+    config = _get_snapshot_schedule_config()
+    base_interval = config[0]
+
+    # 1. 从数据库获取节点 UUID 及调度状态
+    # 在主线程中一次性取出，子线程只负责网络请求
+    poll_states = get_node_poll_states()
+    if not poll_states:
         return
 
-    records_to_save = []
+    states_to_save = []
+    if due_only:
+        uuids = []
+        for uuid, state in poll_states.items():
+            if state is None:
+                # 新节点：按哈希相位排入下一个周期，避免新增/升级后所有节点同时采集
+                states_to_save.append({
+                    'uuid': uuid, 'interval_seconds': base_interval, 'failures': 0,
+                    'next_due_at': _next_due_time(uuid, base_interval, now),
+                })
+            elif state['next_due_at'] <= now:
+                uuids.append(uuid)
+        if not uuids:
+            if states_to_save:
+                save_node_poll_states(states_to_save)
+            return
+    else:
+        uuids = list(poll_states)
+
+    base_url = _get_komari_base_url()
+    headers = _get_komari_headers()
+    session = _get_komari_session(snapshot=True)
+    max_workers = _get_int_config('SNAPSHOT_MAX_WORKERS', 16)
+    node_timeout = _get_int_config('SNAPSHOT_NODE_TIMEOUT_SECONDS', 15)
+    # 连接阶段不需要等满整个单节点时限
+    connect_timeout = min(5, node_timeout / 2)
+    cycle_timeout = _get_int_config('SNAPSHOT_CYCLE_TIMEOUT_SECONDS', 240)
+
+    results = {}
+    failed_count = 0
+    started_at = time.monotonic()
     
-    print(f"[{datetime.now().strftime('%H:%M:%S')}] 开始获取 {len(nodes)} 个节点的快照数据...")
+    print(f"[{datetime.now().strftime('%H:%M:%S')}] 开始获取 {len(uuids)} 个节点的快照数据 (并发 {max_workers})...")
 
-    for node in nodes:
-        uuid = node.uuid
-        url = f"{base_url}/api/recent/{uuid}"
-        headers = _get_komari_headers()
+    # uuid -> (截止时间, 响应)，主线程据此关闭超时的连接
+    inflight = {}
+    executor = ThreadPoolExecutor(max_workers=min(max_workers, len(uuids)), thread_name_prefix='komari-snapshot')
+    futures = {
+        executor.submit(_fetch_node_snapshot, session, base_url, headers, uuid, node_timeout, connect_timeout, inflight): uuid
+        for uuid in uuids
+    }
+    pending = set(futures)
 
-        try:
-            response = requests.get(url, headers=headers, timeout=60)
-            response.raise_for_status()
-            data = response.json()
-            
-            snapshot_data = data.get('data', [])
-            if not snapshot_data:
-                continue
-
-            # 取最新的一个快照点
-            latest_snapshot = snapshot_data[-1] 
-
-            record_info = {
-                'uuid': uuid,
-                'total_up': _extract_nested_value(latest_snapshot, 'network.totalUp'),
-                'total_down': _extract_nested_value(latest_snapshot, 'network.totalDown'),
-                'cpu_usage': _extract_nested_value(latest_snapshot, 'cpu.usage'),
-            }
-            records_to_save.append(record_info)
-
-        except Exception as e:
-            # 单个节点失败不影响其他节点
-            print(f"[{datetime.now().strftime('%H:%M:%S')}] 获取节点 {uuid} 快照失败: {e}")
-
-    # 2. 批量写入数据库
+    try:
+        while pending:
+            remaining = started_at + cycle_timeout - time.monotonic()
+            if remaining <= 0:
+                print(f"[{datetime.now().strftime('%H:%M:%S')}] 快照采集超过总时限 {cycle_timeout}s，放弃 {len(pending)} 个未完成节点。")
+                break
+            done, pending = wait(pending, timeout=min(remaining, 0.5), return_when=FIRST_COMPLETED)
+            for future in done:
+                uuid = futures[future]
+                try:
+                    results[uuid] = future.result()
+                except Exception as e:
+                    # 单个节点失败不影响其他节点
+                    failed_count += 1
+                    print(f"[{datetime.now().strftime('%H:%M:%S')}] 获取节点 {uuid} 快照失败: {e}")
+            _abort_inflight(inflight)
+    finally:
+        # 未开始的任务直接取消，仍在读取的连接全部关闭，
+        # 并在有限时间内等待工作线程退出，不把本轮的请求带入下一轮调度
+        for future in pending:
+            future.cancel()
+        _abort_inflight(inflight, force=True)
+        wait(pending, timeout=node_timeout)
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    records_to_save = [record for record in results.values() if record]
+    elapsed = time.monotonic() - started_at
+    print(f"[{datetime.now().strftime('%H:%M:%S')}] 快照采集完成: 成功 {len(records_to_save)}，失败 {failed_count}，耗时 {elapsed:.1f}s。")
+
+    # 2. 批量写入数据库 (每轮只写一次)
     if records_to_save:
         bulk_add_history(records_to_save) 
         print(f"[{datetime.now().strftime('%H:%M:%S')}] 成功批量写入 {len(records_to_save)} 条历史快照数据。")
 
+    # 3. 更新本轮节点的调度状态 (失败、无数据、超时未完成的节点都按失败退避)
+    for uuid in uuids:
+        state = dict(poll_states[uuid] or {'uuid': uuid})
+        interval = _next_poll_interval(state, results.get(uuid), now, config)
+        state.update(interval_seconds=interval, last_poll_at=now, next_due_at=_next_due_time(uuid, interval, now))
+        states_to_save.append(state)
+    save_node_poll_states(states_to_save)
+
+def prune_expired_history():
+    """
+    [功能三：清理过期数据]
+    按 RAW_DATA_RETENTION_DAYS 删除过期的原始快照，返回删除的行数。
+    HISTORY_ROLLUP_ON_PRUNE 为 1 时，删除前先按天汇总流量，保留长期统计。
+    """
+    retention_days = _get_int_config('RAW_DATA_RETENTION_DAYS', 30)
+    batch_size = _get_int_config('HISTORY_PRUNE_BATCH_SIZE', 5000)
+    rollup = str(get_config('HISTORY_ROLLUP_ON_PRUNE', '1')).strip().lower() in ['1', 'true', 'on', 'yes']
+
+    started_at = time.monotonic()
+    removed = prune_history_data(retention_days, batch_size=batch_size, rollup=rollup)
+    removed_hourly = prune_hourly_rollups(_get_int_config('HOURLY_ROLLUP_RETENTION_DAYS', 365))
+    prune_geoip_cache()
+    elapsed = time.monotonic() - started_at
+
+    print(f"[{datetime.now().strftime('%H:%M:%S')}] 过期数据清理完成: 删除 {removed} 行 (保留 {retention_days} 天)，小时汇总 {removed_hourly} 行，耗时 {elapsed:.1f}s。")
+    return removed
+
 # ----------------------------------------------------
 # 定时/手动任务入口 (核心修改部分)
 # ----------------------------------------------------
 
-def run_periodic_static_sync():
+def run_periodic_static_sync(force=False):
     """
     [低频任务] 任务入口：仅执行节点静态信息同步 (APScheduler 调用)。
     修正：使用 scheduler.app 获取上下文，兼容 PostgreSQL (解决序列化问题)。
+    force=True 时忽略变化检测，强制重新处理节点列表。
     """
     # 检查 scheduler 是否绑定了 app
     if hasattr(scheduler, 'app') and scheduler.app:
         with scheduler.app.app_context():
-            sync_node_list()
+            sync_node_list(force=force)
     else:
         print(">>> [Error] Scheduler 未绑定 app 实例，无法运行静态同步任务。")
 
-def run_periodic_snapshot_sync():
+def run_periodic_snapshot_sync(due_only=True):
     """
     [高频任务] 任务入口：仅执行节点快照数据获取 (APScheduler 调用)。
     修正：使用 scheduler.app 获取上下文，兼容 PostgreSQL (解决序列化问题)。
+    定时调用时只采集已到期的节点；due_only=False 时采集全部节点。
     """
     if hasattr(scheduler, 'app') and scheduler.app:
         with scheduler.app.app_context():
-            fetch_and_save_snapshots()
+            fetch_and_save_snapshots(due_only=due_only)
     else:
         print(">>> [Error] Scheduler 未绑定 app 实例，无法运行快照同步任务。")
 
+def run_periodic_retention_prune():
+    """
+    [低频任务] 任务入口：清理过期的原始快照数据 (APScheduler 调用)。
+    """
+    if hasattr(scheduler, 'app') and scheduler.app:
+        with scheduler.app.app_context():
+            prune_expired_history()
+    else:
+        print(">>> [Error] Scheduler 未绑定 app 实例，无法运行数据清理任务。")
+
 def run_manual_trigger_task():
     """
     [手动任务] 任务入口：同时执行静态同步和快照获取。
     """
-    # 直接调用上述无参函数，它们会自动通过 scheduler.app 获取上下文
-    run_periodic_static_sync()
-    run_periodic_snapshot_sync()
+    # 直接调用上述函数，它们会自动通过 scheduler.app 获取上下文
+    # 手动刷新时强制重新处理节点列表，不依赖变化检测
+    run_periodic_static_sync(force=True)
+    run_periodic_snapshot_sync(due_only=False)
 
 
 # =========================================================
@@ -212,4 +501,24 @@ def manual_refresh_api():
         return jsonify({
             'status': 'error',
             'message': f'手动刷新任务出错: {str(e)}'
-        }), 500
\ No newline at end of file
+        }), 500
+
+@bp.route('/prune-history', methods=['POST'])
+@login_required
+def prune_history_api():
+    """
+    API 接口：立即执行一次过期数据清理，返回删除的行数。
+    """
+    try:
+        removed = prune_expired_history()
+        return jsonify({
+            'status': 'success',
+            'removed': removed,
+            'message': f'已清理 {removed} 条过期数据。'
+        }), 200
+    except Exception as e:
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] 数据清理任务出错: {e}")
+        return jsonify({
+            'status': 'error',
+            'message': f'数据清理任务出错: {str(e)}'
+        }), 500
@@ -4,7 +4,7 @@ from datetime import datetime, timedelta
 import traceback
 
 # 导入 db_manager 模型和数据库对象
-from app.utils.db_manager import db, HistoryData, get_all_nodes
+from app.utils.db_manager import db, HistoryData, get_all_nodes, get_hourly_traffic, get_usage_by_node
 
 bp = Blueprint('history', __name__, url_prefix='/history', template_folder='templates')
 
@@ -52,18 +52,18 @@ def chart_data_api():
         raw_downloads = []
         raw_totals = [] 
         
-        # 初始化24小时的数据桶
+        # 初始化24小时的数据桶 (直接读取预聚合的小时汇总表，最多 24 行)
         hourly_stats = {h: {'up': 0.0, 'down': 0.0} for h in range(24)}
+        for bucket in get_hourly_traffic(uuid, start_time, end_time):
+            hourly_stats[bucket.hour.hour]['up'] += bucket.up_bytes or 0
+            hourly_stats[bucket.hour.hour]['down'] += bucket.down_bytes or 0
         
         if chart_records:
-            # A. 计算累计趋势 (基于全量数据计算，保证准确性)
+            # 计算累计趋势 (基于全量数据计算，保证准确性)
             base_up = chart_records[0].total_up
             base_down = chart_records[0].total_down
-            
-            prev_record = chart_records[0]
 
             for r in chart_records:
-                # --- 1. 累计数据计算 ---
                 raw_times.append(r.timestamp.strftime('%H:%M'))
                 
                 curr_up = r.total_up - base_up
@@ -82,20 +82,6 @@ def chart_data_api():
                 raw_downloads.append(val_down)
                 raw_totals.append(val_up + val_down)
 
-                # --- 2. 每小时增量计算 ---
-                if r != prev_record:
-                    delta_up = r.total_up - prev_record.total_up
-                    delta_down = r.total_down - prev_record.total_down
-                    
-                    if delta_up < 0: delta_up = r.total_up
-                    if delta_down < 0: delta_down = r.total_down
-                    
-                    hour = r.timestamp.hour
-                    hourly_stats[hour]['up'] += delta_up
-                    hourly_stats[hour]['down'] += delta_down
-                
-                prev_record = r
-
         # 数据抽样 (Downsampling)
         # 如果数据点过多(例如超过200个)，前端渲染会非常卡顿甚至不显示
         # 我们在这里进行均匀抽样，只返回约 120 个点给前端
@@ -137,49 +123,26 @@ def chart_data_api():
         # 预先获取当前选择的节点 ID (确保是字符串)
         current_uuid_str = str(uuid)
 
+        # 一次查询取出所有节点当日的首尾计数器，避免每个节点 2 次查询
+        usage_map = get_usage_by_node(start_time, end_time)
+
         for node in all_nodes:
             node_uuid_str = str(node.uuid)
-            try:
-                # 优化查询：只查头尾，避免全表扫描
-                # 注意：在 PG 中这里的查询如果数据量巨大可能会慢，但通常有索引 idx_node_timestamp 会很快
-                first = HistoryData.query.filter(
-                    HistoryData.uuid == node_uuid_str, 
-                    HistoryData.timestamp >= start_time
-                ).order_by(HistoryData.timestamp.asc()).first()
-                
-                last = HistoryData.query.filter(
-                    HistoryData.uuid == node_uuid_str, 
-                    HistoryData.timestamp <= end_time
-                ).order_by(HistoryData.timestamp.desc()).first()
-                
-                usage_total = 0
-                usage_up = 0
-                usage_down = 0
-                
-                if first and last:
-                    d_up = last.total_up - first.total_up
-                    d_down = last.total_down - first.total_down
-                    
-                    if d_up < 0: d_up = last.total_up
-                    if d_down < 0: d_down = last.total_down
-                    
-                    usage_up = round(d_up / 1024 / 1024 / 1024, 3)
-                    usage_down = round(d_down / 1024 / 1024 / 1024, 3)
-                    usage_total = round(usage_up + usage_down, 3)
-                
-                ranking_data.append({
-                    'name': node.custom_name or node.name,
-                    'uuid': node_uuid_str, 
-                    'region': node.region,
-                    'usage': usage_total,
-                    'up': usage_up,
-                    'down': usage_down,
-                    'is_current': (node_uuid_str == current_uuid_str)
-                })
-            except Exception as e:
-                # 捕获单个节点查询错误，防止整个接口崩溃
-                print(f"Error processing node {node.name}: {e}")
-                continue
+            d_up, d_down = usage_map.get(node_uuid_str, (0, 0))
+
+            usage_up = round(d_up / 1024 / 1024 / 1024, 3)
+            usage_down = round(d_down / 1024 / 1024 / 1024, 3)
+            usage_total = round(usage_up + usage_down, 3)
+            
+            ranking_data.append({
+                'name': node.custom_name or node.name,
+                'uuid': node_uuid_str, 
+                'region': node.region,
+                'usage': usage_total,
+                'up': usage_up,
+                'down': usage_down,
+                'is_current': (node_uuid_str == current_uuid_str)
+            })
             
         # 降序排列
         ranking_data.sort(key=lambda x: x['usage'], reverse=True)
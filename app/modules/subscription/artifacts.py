@@ -0,0 +1,110 @@
+# artifacts.py
+# 订阅生成物缓存：base64 订阅 / raw 0、1 YAML / Clash 配置只在输入变化时生成一次，
+# 之后直接从内存返回，并支持 ETag + If-None-Match (304) 以及 gzip 压缩。
+
+import gzip
+import hashlib
+import threading
+from collections import OrderedDict
+
+from flask import make_response, request
+
+# 小于该字节数的内容不压缩 (压缩收益不足以抵消开销)
+GZIP_MIN_SIZE = 1024
+
+# 客户端每次都要带 ETag 回来校验，内容未变化时服务端返回 304
+CACHE_CONTROL = 'no-cache'
+
+# 每个生成物最多同时保留的 key 数：例如客户端通过多个域名访问时，各自的 Clash 配置都能命中缓存
+MAX_KEYS_PER_NAME = 4
+
+
+class Artifact:
+    """一个已生成的订阅内容 (不可变)"""
+
+    def __init__(self, body):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.body = body
+        self.etag = hashlib.sha1(body).hexdigest()
+        self._gzip_body = None
+        self._lock = threading.Lock()
+
+    @property
+    def gzip_etag(self):
+        # 强 ETag 按表示区分，压缩版本使用独立的 ETag
+        return f"{self.etag}-gz"
+
+    @property
+    def gzip_body(self):
+        if self._gzip_body is None:
+            with self._lock:
+                if self._gzip_body is None:
+                    self._gzip_body = gzip.compress(self.body, compresslevel=6)
+        return self._gzip_body
+
+
+class ArtifactCache:
+    """
+    按名称缓存订阅生成物。
+    key 描述生成物的全部输入 (节点集合版本、模板修改时间、访问域名等)，key 不变就直接复用。
+    每个名称按 LRU 保留最近使用的 max_keys 个 key，旧版本的生成物随之淘汰。
+    """
+
+    def __init__(self, max_keys=MAX_KEYS_PER_NAME):
+        self._lock = threading.Lock()
+        self._items = {}
+        self._max_keys = max_keys
+
+    def get(self, name, key, builder):
+        """获取生成物；该 key 没有缓存时调用 builder() 生成"""
+        with self._lock:
+            entries = self._items.get(name)
+            if entries is not None and key in entries:
+                entries.move_to_end(key)
+                return entries[key]
+
+        artifact = Artifact(builder())
+        with self._lock:
+            entries = self._items.setdefault(name, OrderedDict())
+            entries[key] = artifact
+            entries.move_to_end(key)
+            while len(entries) > self._max_keys:
+                entries.popitem(last=False)
+        return artifact
+
+    def invalidate(self, name=None):
+        """清除指定 (或全部) 生成物"""
+        with self._lock:
+            if name is None:
+                self._items.clear()
+            else:
+                self._items.pop(name, None)
+
+
+artifact_cache = ArtifactCache()
+
+
+def make_artifact_response(artifact, mimetype, headers=None):
+    """
+    根据当前请求构造响应：
+    - If-None-Match 命中时返回 304 (不带正文)
+    - 客户端支持 gzip 且内容足够大时返回压缩内容
+    """
+    use_gzip = len(artifact.body) >= GZIP_MIN_SIZE and 'gzip' in request.accept_encodings
+    etag = artifact.gzip_etag if use_gzip else artifact.etag
+
+    if request.if_none_match.contains(artifact.etag) or request.if_none_match.contains(artifact.gzip_etag):
+        resp = make_response('', 304)
+    else:
+        resp = make_response(artifact.gzip_body if use_gzip else artifact.body)
+        resp.mimetype = mimetype
+        if use_gzip:
+            resp.headers['Content-Encoding'] = 'gzip'
+        for k, v in (headers or {}).items():
+            resp.headers[k] = v
+
+    resp.set_etag(etag)
+    resp.headers['Cache-Control'] = CACHE_CONTROL
+    resp.headers['Vary'] = 'Accept-Encoding'
+    return resp
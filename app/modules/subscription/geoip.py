@@ -0,0 +1,357 @@
+# geoip.py
+# IP / 域名归属地查询：进程内 LRU -> 本地 IP 段数据库 -> 数据库持久缓存 -> 在线接口 (ip-api.com)
+
+import bisect
+import gzip
+import ipaddress
+import os
+import socket
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from app.utils.db_manager import get_config, get_geoip_cache, save_geoip_cache
+from app.utils.path_helper import get_external_config_path
+
+# 默认缓存时间：成功结果 7 天，查询失败 (负缓存) 30 分钟
+DEFAULT_TTL_HOURS = 168
+DEFAULT_NEGATIVE_TTL_MINUTES = 30
+DEFAULT_MEMORY_CACHE_SIZE = 1024
+
+# 批量接口：一次最多 100 个地址 (限制 15次/分)
+ONLINE_BATCH_URL = "http://ip-api.com/batch?fields=status,countryCode"
+ONLINE_BATCH_SIZE = 100
+ONLINE_BATCH_TIMEOUT_SECONDS = 10
+DNS_RESOLVE_WORKERS = 8
+
+
+class _RegionLRU:
+    """进程内的小型 LRU：host -> (country_code, 过期时间戳)"""
+
+    def __init__(self, maxsize=DEFAULT_MEMORY_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, host):
+        with self._lock:
+            item = self._items.get(host)
+            if item is None:
+                return None
+            if item[1] <= time.time():
+                del self._items[host]
+                return None
+            self._items.move_to_end(host)
+            return item[0]
+
+    def put(self, host, country_code, expires_ts):
+        with self._lock:
+            self._items[host] = (country_code, expires_ts)
+            self._items.move_to_end(host)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+_memory_cache = _RegionLRU()
+
+
+def _get_int_setting(key, default):
+    try:
+        value = int(get_config(key, default))
+        return value if value >= 0 else default
+    except (ValueError, TypeError):
+        return default
+
+
+# ---------------------------------------------------------
+# 本地 IP 段数据库 (离线查询)
+# ---------------------------------------------------------
+class LocalRangeDB:
+    """
+    从 CSV 加载 "IP 段 -> 国家代码" 数据，按起始地址排序后用二分查找。
+    支持的行格式 (逗号分隔，可带引号，# 开头为注释，无法识别的行 (如表头) 会被跳过)：
+      1.0.0.0/24,AU                       CIDR + 国家代码
+      1.0.0.0,1.0.0.255,AU                起止 IP + 国家代码 (如 DB-IP lite)
+      "16777216","16777471","AU","..."    起止整数 + 国家代码 (如 IP2Location lite)
+    文件名以 .gz 结尾时按 gzip 读取。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        # 国家代码去重后用下标保存，IPv4 使用紧凑的 array，IPv6 地址超过 64 位只能用 int 列表
+        self._codes = []
+        self._v4 = (array('Q'), array('Q'), array('H'))
+        self._v6 = ([], [], array('H'))
+        self._load()
+
+    def _load(self):
+        ranges = {4: [], 6: []}
+        code_index = {}
+
+        opener = gzip.open if self.path.endswith('.gz') else open
+        with opener(self.path, 'rt', encoding='utf-8', errors='replace') as f:
+            for line in f:
+                parsed = self._parse_line(line)
+                if parsed is None:
+                    continue
+                version, start, end, code = parsed
+                if code not in code_index:
+                    code_index[code] = len(self._codes)
+                    self._codes.append(code)
+                ranges[version].append((start, end, code_index[code]))
+
+        for version, target in ((4, self._v4), (6, self._v6)):
+            rows = sorted(ranges[version])
+            starts, ends, codes = target
+            starts.extend(r[0] for r in rows)
+            ends.extend(r[1] for r in rows)
+            codes.extend(r[2] for r in rows)
+            self.count += len(rows)
+
+    @staticmethod
+    def _parse_line(line):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            return None
+        fields = [x.strip().strip('"').strip() for x in line.split(',')]
+        try:
+            if len(fields) == 2 or (len(fields) >= 2 and '/' in fields[0]):
+                network = ipaddress.ip_network(fields[0], strict=False)
+                start, end = network.network_address, network.broadcast_address
+                code = fields[1]
+            else:
+                code = fields[2]
+                if fields[0].isdigit() and fields[1].isdigit():
+                    start_int, end_int = int(fields[0]), int(fields[1])
+                    version = 4 if end_int <= 0xFFFFFFFF else 6
+                    return version, start_int, end_int, LocalRangeDB._normalize_code(code)
+                start, end = ipaddress.ip_address(fields[0]), ipaddress.ip_address(fields[1])
+        except (ValueError, IndexError):
+            return None
+
+        code = LocalRangeDB._normalize_code(code)
+        if start.version != end.version or not code:
+            return None
+        return start.version, int(start), int(end), code
+
+    @staticmethod
+    def _normalize_code(code):
+        code = code.upper()
+        # '-' / 'ZZ' 等表示未知地区
+        return code if len(code) == 2 and code.isalpha() and code != 'ZZ' else ''
+
+    def lookup_ip(self, ip):
+        """查询 IP 字符串，返回国家代码，未收录返回 ''"""
+        try:
+            addr = ipaddress.ip_address(ip)
+        except ValueError:
+            return ''
+        if addr.version == 6 and addr.ipv4_mapped:
+            addr = addr.ipv4_mapped
+
+        starts, ends, codes = self._v4 if addr.version == 4 else self._v6
+        value = int(addr)
+        i = bisect.bisect_right(starts, value) - 1
+        if i >= 0 and value <= ends[i]:
+            return self._codes[codes[i]]
+        return ''
+
+    def lookup_host(self, host):
+        """查询 IP 或域名 (域名先做 DNS 解析)"""
+        try:
+            ipaddress.ip_address(host)
+            return self.lookup_ip(host)
+        except ValueError:
+            pass
+        try:
+            return self.lookup_ip(socket.gethostbyname(host))
+        except OSError:
+            return ''
+
+
+_local_db = None
+_local_db_key = None
+_local_db_lock = threading.Lock()
+
+
+def _resolve_local_db_path():
+    path = str(get_config('GEOIP_LOCAL_DB_PATH', '') or '').strip()
+    if not path:
+        return ''
+    # 相对路径以程序目录 (打包后为 exe 所在目录) 为基准
+    return path if os.path.isabs(path) else get_external_config_path(path)
+
+
+def get_local_db():
+    """
+    获取本地 IP 段数据库；未配置或文件不存在时返回 None。
+    配置的路径或文件修改时间变化时自动重新加载。
+    """
+    global _local_db, _local_db_key
+    path = _resolve_local_db_path()
+    if not path:
+        return None
+    try:
+        key = (path, os.stat(path).st_mtime_ns)
+    except OSError:
+        return None
+
+    if _local_db_key == key:
+        return _local_db
+
+    with _local_db_lock:
+        if _local_db_key != key:
+            started_at = time.monotonic()
+            try:
+                range_db = LocalRangeDB(path)
+                print(f"[GeoIP] 已加载本地 IP 段数据库 {path}: {range_db.count} 条，耗时 {time.monotonic() - started_at:.2f}s")
+            except Exception as e:
+                print(f"[GeoIP] 本地 IP 段数据库加载失败 {path}: {e}")
+                range_db = None
+            _local_db, _local_db_key = range_db, key
+            _memory_cache.clear()
+        return _local_db
+
+
+def _online_fallback_enabled():
+    return str(get_config('GEOIP_ONLINE_FALLBACK', '1')).strip().lower() in ['1', 'true', 'on', 'yes']
+
+
+def normalize_host(host):
+    """统一缓存 key：去掉 IPv6 方括号、首尾空白与大小写差异"""
+    return str(host).strip().strip('[]').lower() if host else ''
+
+
+def _resolve_to_ip(host):
+    """域名解析为 IP，失败时原样返回"""
+    try:
+        return socket.gethostbyname(host)
+    except OSError:
+        return host
+
+
+def lookup_regions_online_batch(hosts):
+    """
+    使用 ip-api.com 批量接口查询多个主机，返回 {host: (country_code, 是否为确定结果)}
+    DNS 解析并发进行，每 ONLINE_BATCH_SIZE 个地址一次请求。
+    """
+    hosts = list(hosts)
+    if not hosts:
+        return {}
+
+    with ThreadPoolExecutor(max_workers=min(DNS_RESOLVE_WORKERS, len(hosts))) as executor:
+        targets = list(executor.map(_resolve_to_ip, hosts))
+
+    results = {}
+    for i in range(0, len(hosts), ONLINE_BATCH_SIZE):
+        chunk_hosts = hosts[i:i + ONLINE_BATCH_SIZE]
+        chunk_targets = targets[i:i + ONLINE_BATCH_SIZE]
+        try:
+            resp = requests.post(ONLINE_BATCH_URL, json=chunk_targets, timeout=ONLINE_BATCH_TIMEOUT_SECONDS)
+            if resp.status_code != 200:
+                raise ValueError(f"HTTP {resp.status_code}")
+            for host, data in zip(chunk_hosts, resp.json()):
+                if data.get('status') == 'success':
+                    results[host] = (data.get('countryCode', ''), True)
+                else:
+                    results[host] = ('', True)
+        except Exception as e:
+            print(f"[IP Batch Query Fail] {len(chunk_hosts)} 个地址: {e}")
+            for host in chunk_hosts:
+                results.setdefault(host, ('', False))
+    return results
+
+
+def remember_region(host, country_code, definitive=True):
+    """把查询结果写入数据库缓存与进程内 LRU"""
+    if definitive:
+        # 包括接口明确无法定位的地址 (内网 / 保留地址)，结果短期内不会变化
+        ttl = _get_int_setting('GEOIP_CACHE_TTL_HOURS', DEFAULT_TTL_HOURS) * 3600
+    else:
+        ttl = _get_int_setting('GEOIP_NEGATIVE_TTL_MINUTES', DEFAULT_NEGATIVE_TTL_MINUTES) * 60
+    expires_at = save_geoip_cache(host, country_code, ttl)
+    _memory_cache.put(host, country_code, expires_at.timestamp())
+
+
+def get_cached_region(host):
+    """只查缓存 (内存 -> 数据库)，未命中返回 None"""
+    key = normalize_host(host)
+    if not key:
+        return ''
+
+    cached = _memory_cache.get(key)
+    if cached is not None:
+        return cached
+
+    row = get_geoip_cache(key)
+    if row is not None:
+        country_code, expires_at = row
+        _memory_cache.put(key, country_code, expires_at.timestamp())
+        return country_code
+    return None
+
+
+def _lookup_offline(key, online):
+    """
+    不访问在线接口的查询：进程内 LRU -> 本地 IP 段数据库 -> 数据库缓存
+    返回国家代码；需要在线查询时返回 None (在线查询关闭时返回 '')
+    """
+    cached = _memory_cache.get(key)
+    if cached is not None:
+        return cached
+
+    local_db = get_local_db()
+    if local_db is not None:
+        country_code = local_db.lookup_host(key)
+        # 本地查询只需微秒级，结果只放进程内缓存，不写数据库
+        if country_code or not online:
+            ttl = _get_int_setting('GEOIP_CACHE_TTL_HOURS', DEFAULT_TTL_HOURS) * 3600
+            _memory_cache.put(key, country_code, time.time() + ttl)
+            return country_code
+
+    cached = get_cached_region(key)
+    if cached is not None:
+        return cached
+    return None if online else ''
+
+
+def resolve_regions(hosts, with_status=False):
+    """
+    批量查询多个主机的国家代码，返回 {原始 host: country_code}
+    先查缓存与本地数据库，剩余的主机合并为一次 (或少数几次) 在线批量请求。
+    with_status=True 时返回 {原始 host: (country_code, 是否为确定结果)}：
+    在线接口限流 / 超时 / 响应缺项，以及命中负缓存的空结果都不是确定结果，调用方可稍后重试。
+    """
+    results = {}
+    pending = {}
+    online = _online_fallback_enabled()
+
+    for host in hosts:
+        key = normalize_host(host)
+        cached = _lookup_offline(key, online) if key else ''
+        if cached is not None:
+            # 缓存中的空字符串无法区分 "确定无结果" 与 "查询失败的负缓存"，按不确定处理
+            results[host] = (cached, bool(cached) or not key or not online)
+        else:
+            pending.setdefault(key, []).append(host)
+
+    if pending:
+        found = lookup_regions_online_batch(pending.keys())
+        for key, hosts_for_key in pending.items():
+            country_code, definitive = found.get(key, ('', False))
+            remember_region(key, country_code, definitive)
+            for host in hosts_for_key:
+                results[host] = (country_code, definitive)
+
+    if with_status:
+        return results
+    return {host: country_code for host, (country_code, _) in results.items()}
@@ -1,7 +1,15 @@
 import urllib.parse
 import base64
+import codecs
 import json
 import re
+import copy
+import multiprocessing
+import os
+import sys
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 
 # ==============================================================================
 # SECTION 1: 基础工具函数 (Utils)
@@ -39,27 +47,43 @@ def get_emoji_flag(region_code):
     except:
         return '🌐'
 
+def _parse_query(query):
+    """
+    将 URL 查询串一次性解析为扁平字典 {key: 第一个值}
+    (与 parse_qs 一致：空值参数被忽略，同名参数只取第一个)
+    """
+    params = {}
+    if not query: return params
+    for pair in query.split('&'):
+        key, sep, value = pair.partition('=')
+        if not sep or not value: continue
+        # 只有包含转义字符时才解码 (与 parse_qsl 相同：'+' 视为空格)
+        if '%' in key or '+' in key: key = urllib.parse.unquote(key.replace('+', ' '))
+        if key in params: continue
+        if '%' in value or '+' in value: value = urllib.parse.unquote(value.replace('+', ' '))
+        params[key] = value
+    return params
+
 def _get_param(params, key, default=''):
-    """获取参数的第一个值"""
-    return params.get(key, [default])[0]
+    """获取参数值 (params 为 _parse_query 的结果)"""
+    return params.get(key, default)
+
+# 常用的布尔参数备选键名
+_INSECURE_KEYS = ('insecure', 'skip-cert-verify')
+_INSECURE_KEYS_EXT = ('insecure', 'skip-cert-verify', 'allowInsecure')
+_TRUE_VALUES = frozenset(['1', 'true', 'on', 'yes'])
 
 def _get_bool(params, keys, default=False):
     """
     解析布尔值，支持多个备选键名 (如 insecure, allowInsecure)
     支持 '1', 'true', 'True' 等格式
     """
-    if isinstance(keys, str): keys = [keys]
+    if isinstance(keys, str): keys = (keys,)
     
-    val = None
     for k in keys:
         if k in params:
-            val = params[k][0]
-            break
-    
-    if val is None: return default
-    
-    val_str = str(val).lower()
-    return val_str in ['1', 'true', 'on', 'yes']
+            return params[k].lower() in _TRUE_VALUES
+    return default
 
 def _get_int(params, key, default=None):
     """安全解析整数"""
@@ -125,7 +149,7 @@ def fix_link_ipv6(link):
     link = link.strip()
 
     # 1. VMess 特殊处理
-    if link.lower().startswith('vmess://'):
+    if link[:8].lower() == 'vmess://':
         try:
             b64_part = link[8:]
             decoded = safe_base64_decode(b64_part)
@@ -184,7 +208,7 @@ def _parse_hysteria2(parsed, params, proxy_name):
         "port": port,
         "password": password,
         "sni": _get_param(params, 'sni', _get_param(params, 'peer')),
-        "skip-cert-verify": _get_bool(params, ['insecure', 'skip-cert-verify', 'allowInsecure']),
+        "skip-cert-verify": _get_bool(params, _INSECURE_KEYS_EXT),
         "udp": True
     }
     
@@ -234,7 +258,7 @@ def _parse_vless(parsed, params, proxy_name):
         "network": network,
         "udp": True,
         "tfo": _get_bool(params, 'fast-open'),
-        "skip-cert-verify": _get_bool(params, ['insecure', 'skip-cert-verify']),
+        "skip-cert-verify": _get_bool(params, _INSECURE_KEYS),
         "servername": _get_param(params, 'sni')
     }
     
@@ -320,7 +344,7 @@ def _parse_trojan(parsed, params, proxy_name):
         "network": network,
         "udp": True,
         "tfo": _get_bool(params, 'fast-open'),
-        "skip-cert-verify": _get_bool(params, ['insecure', 'skip-cert-verify']),
+        "skip-cert-verify": _get_bool(params, _INSECURE_KEYS),
         "sni": _get_param(params, 'sni')
     }
 
@@ -373,7 +397,7 @@ def _parse_tuic(parsed, params, proxy_name):
     if not password: password = parsed.password
     skip_cert_verify_value = _get_bool(
     params, 
-    keys=['insecure', 'skip-cert-verify', 'allowInsecure'], 
+    keys=_INSECURE_KEYS_EXT, 
     default=True # TUIC 默认跳过证书验证
 )
 
@@ -581,7 +605,7 @@ def _parse_socks5(parsed, params, proxy_name):
         "server": server.strip('[]'), # 移除 IPv6 的方括号供 IP 查询使用
         "port": port,
         "udp": True,
-        "skip-cert-verify": _get_bool(params, ['insecure', 'skip-cert-verify'])
+        "skip-cert-verify": _get_bool(params, _INSECURE_KEYS)
     }
 
     if username: proxy['username'] = username
@@ -599,100 +623,348 @@ def _parse_socks5(parsed, params, proxy_name):
 # SECTION 3: 主分发入口 (Main Entry Point)
 # ==============================================================================
 
+# 解析结果缓存 (LRU)：parse_proxy_link 是 (link, base_name, region_code) 的纯函数，
+# 同一批链接会被 sync_nodes_to_files / 添加节点接口反复解析
+DEFAULT_PARSE_CACHE_SIZE = 8192
+
+_parse_cache = OrderedDict()
+_parse_cache_lock = threading.Lock()
+_parse_cache_maxsize = DEFAULT_PARSE_CACHE_SIZE
+_parse_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+def configure_parse_cache(maxsize):
+    """设置解析缓存容量 (条目数)，0 表示关闭缓存；缩小容量时立即淘汰最旧的条目"""
+    global _parse_cache_maxsize
+    maxsize = max(0, int(maxsize))
+    with _parse_cache_lock:
+        _parse_cache_maxsize = maxsize
+        while len(_parse_cache) > maxsize:
+            _parse_cache.popitem(last=False)
+            _parse_cache_stats['evictions'] += 1
+
+def get_parse_cache_stats():
+    """返回解析缓存的命中/未命中/淘汰计数，用于评估缓存容量是否合适"""
+    with _parse_cache_lock:
+        stats = dict(_parse_cache_stats)
+        stats['size'] = len(_parse_cache)
+        stats['maxsize'] = _parse_cache_maxsize
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = round(stats['hits'] / lookups, 4) if lookups else 0.0
+    return stats
+
 def parse_proxy_link(link, base_name, region_code):
     """
     [主函数] 解析各种协议链接并转换为 Clash Meta 配置字典
     路由文件 (routes.py) 调用此函数。
+    结果经过 LRU 缓存，每次返回独立的副本，调用方可以随意修改 (例如覆盖 name)。
     """
+    # 与 parse_proxy_links 使用相同的缓存键 (链接去除首尾空白)，两者可以共享缓存
+    key = ((link or '').strip(), base_name or '', region_code or '')
+    found, result = _cache_lookup(key)
+    if not found:
+        result = _parse_proxy_link_uncached(*key)
+        _cache_store(key, result)
+    return copy.deepcopy(result)
+
+def _cache_lookup(key, skip_none=False):
+    """查询解析缓存，返回 (是否命中, 结果)；skip_none=True 时缓存的失败结果视为未命中"""
+    with _parse_cache_lock:
+        if key in _parse_cache and not (skip_none and _parse_cache[key] is None):
+            _parse_cache.move_to_end(key)
+            _parse_cache_stats['hits'] += 1
+            return True, _parse_cache[key]
+        _parse_cache_stats['misses'] += 1
+        return False, None
+
+def _cache_store(key, result):
+    """写入解析缓存，超出容量时淘汰最久未使用的条目"""
+    with _parse_cache_lock:
+        if _parse_cache_maxsize <= 0:
+            return
+        _parse_cache[key] = result
+        _parse_cache.move_to_end(key)
+        while len(_parse_cache) > _parse_cache_maxsize:
+            _parse_cache.popitem(last=False)
+            _parse_cache_stats['evictions'] += 1
+
+class UnsupportedLinkError(ValueError):
+    """链接协议不受支持"""
+
+def _parse_proxy_link_uncached(link, base_name, region_code):
+    """实际的解析逻辑 (不经过缓存)；热点路径，直接查表调用处理器，不支持的协议直接返回 None 而不抛异常"""
     try:
         link = link.strip()
-        
-        # 1. 构造标准名称
-        flag = get_emoji_flag(region_code)
-        clean_name = base_name.replace(flag, '').strip()
-        proxy_name = f"{flag} {clean_name}"
+        scheme, sep, _ = link.partition('://')
+        handler = _SCHEME_HANDLERS.get(scheme.lower()) if sep else None
+        if handler is None: return None
+        return handler(link, _make_proxy_name(base_name, region_code))
+    except Exception as e:
+        print(f"Link Parse Error [{link[:30]}...]: {e}")
+        return None
 
-        # 2. 协议分发
-        lower_link = link.lower()
+def _url_handler(handler):
+    """适配标准 URL 协议：先解析 URL 与查询参数，再交给协议处理器"""
+    def handle(link, proxy_name):
+        parsed = urllib.parse.urlparse(link)
+        return handler(parsed, _parse_query(parsed.query), proxy_name)
+    return handle
+
+def _handle_ss(link, proxy_name):
+    # SS 只需要查询串，不必完整 urlparse
+    return _parse_ss(link, proxy_name, _parse_query(link.partition('#')[0].partition('?')[2]))
+
+# 协议前缀 (scheme，小写) -> 处理器 (link, proxy_name)
+_SCHEME_HANDLERS = {
+    'vmess': _parse_vmess,
+    'vless': _url_handler(_parse_vless),
+    'trojan': _url_handler(_parse_trojan),
+    'hy2': _url_handler(_parse_hysteria2),
+    'hysteria2': _url_handler(_parse_hysteria2),
+    'tuic': _url_handler(_parse_tuic),
+    'ss': _handle_ss,
+    'socks5': _url_handler(_parse_socks5),
+}
+
+def _dispatch_proxy_link(link, base_name, region_code):
+    """按协议前缀查表分发到各解析器；协议不受支持时抛出 UnsupportedLinkError，其余异常原样抛出"""
+    link = link.strip()
 
-        # [特殊处理] VMess
-        if lower_link.startswith('vmess://'):
-            return _parse_vmess(link, proxy_name)
+    # 只检查 :// 之前的协议前缀，不对整条链接做 lower()
+    scheme, sep, _ = link.partition('://')
+    handler = _SCHEME_HANDLERS.get(scheme.lower()) if sep else None
+    if handler is None:
+        raise UnsupportedLinkError(f"不支持的协议: {scheme[:20] if sep else '未知'}")
 
-        # [标准 URL 协议] 解析 URL 和参数
-        parsed = urllib.parse.urlparse(link)
-        params = urllib.parse.parse_qs(parsed.query)
+    return handler(link, _make_proxy_name(base_name, region_code))
 
-        if lower_link.startswith('vless://'):
-            return _parse_vless(parsed, params, proxy_name)
-        
-        elif lower_link.startswith('trojan://'):
-            return _parse_trojan(parsed, params, proxy_name)
-            
-        elif lower_link.startswith(('hy2://', 'hysteria2://')):
-            return _parse_hysteria2(parsed, params, proxy_name)
-            
-        elif lower_link.startswith('tuic://'):
-            return _parse_tuic(parsed, params, proxy_name)
-            
-        elif lower_link.startswith('ss://'):
-            return _parse_ss(link, proxy_name, params)
-            
-        elif lower_link.startswith('socks5://'):
-            return _parse_socks5(parsed, params, proxy_name)
-            
+def _make_proxy_name(base_name, region_code):
+    """构造标准名称: 国旗 + 去掉重复国旗后的名称"""
+    flag = get_emoji_flag(region_code)
+    clean_name = base_name.replace(flag, '').strip()
+    return f"{flag} {clean_name}"
+
+# ------------------------------------------------------------------------------
+# 批量解析
+# ------------------------------------------------------------------------------
+
+# 未命中缓存的链接数达到该值时才使用进程池 (进程启动与结果回传的开销较大)
+BATCH_PROCESS_THRESHOLD = 2000
+BATCH_CHUNK_SIZE = 256
+BATCH_MAX_PROCESSES = 8
+
+# 进程池默认关闭：在多线程的服务进程 (调度器 / 请求线程 / 数据库连接池) 中 fork 并不安全，
+# Python 3.12+ 也会对此发出警告；需要时通过 configure_parse_processes 显式开启
+_process_pool_enabled = False
+
+def configure_parse_processes(enabled):
+    """开启或关闭批量解析的进程池 (仅影响 use_processes=None 的调用)"""
+    global _process_pool_enabled
+    _process_pool_enabled = bool(enabled)
+
+def _parse_link_entry(entry):
+    """
+    解析单条 (link, base_name, region_code)，返回 (result, error)
+    进程池会 pickle 调用本函数，因此必须定义在模块顶层且不访问缓存
+    """
+    link, base_name, region_code = entry
+    try:
+        result = _dispatch_proxy_link(link, base_name, region_code)
+    except UnsupportedLinkError as e:
+        return None, str(e)
     except Exception as e:
-        print(f"Link Parse Error [{link[:30]}...]: {e}")
-        return None
-    
-    return None
+        return None, f"解析异常: {e}"
+    if not result:
+        return None, '链接格式无效或缺少必要字段'
+    return result, None
+
+def _can_use_process_pool():
+    """
+    打包环境 (PyInstaller) 下子进程会重新执行主程序，spawn/forkserver 也会重新导入 run.py 并再次 create_app()，
+    因此只在支持 fork 的非打包环境中启用进程池
+    """
+    if getattr(sys, 'frozen', False):
+        return False
+    return 'fork' in multiprocessing.get_all_start_methods()
+
+def _parse_entries(entries, use_processes, max_workers):
+    if use_processes is None:
+        use_processes = _process_pool_enabled and len(entries) >= BATCH_PROCESS_THRESHOLD
+    workers = max_workers or min(os.cpu_count() or 1, BATCH_MAX_PROCESSES)
+    # 单核机器上进程池只会增加开销
+    if use_processes and workers > 1 and len(entries) > 1 and _can_use_process_pool():
+        chunksize = max(1, min(BATCH_CHUNK_SIZE, len(entries) // (workers * 4)))
+        try:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork')) as pool:
+                return list(pool.map(_parse_link_entry, entries, chunksize=chunksize))
+        except Exception as e:
+            print(f"[Link Parse] 进程池解析失败，改为逐条解析: {e}")
+    return [_parse_link_entry(entry) for entry in entries]
+
+def parse_proxy_links(entries, use_processes=None, max_workers=None):
+    """
+    批量解析链接。
+    entries: 可迭代对象，元素为链接字符串或 (link, base_name, region_code) 元组
+    返回与输入顺序一致的列表，每项为 {'link': 原始链接, 'result': 配置字典或 None, 'error': 失败原因或 None}
+    - 先查询解析缓存，只解析未命中的链接 (相同输入只解析一次)
+    - use_processes=None 时，仅在 configure_parse_processes 开启且未命中数达到 BATCH_PROCESS_THRESHOLD 时使用进程池；
+      进程池不可用时自动退回逐条解析
+    - 返回的字典均为独立副本，调用方可以随意修改
+    """
+    keys = []
+    for entry in entries:
+        if isinstance(entry, str):
+            entry = (entry, '', '')
+        link, base_name, region_code = entry
+        keys.append(((link or '').strip(), base_name or '', region_code or ''))
+
+    outcomes = {}
+    pending = []
+    for key in dict.fromkeys(keys):
+        found, result = _cache_lookup(key, skip_none=True)
+        if found:
+            outcomes[key] = (result, None)
+        else:
+            pending.append(key)
+
+    if pending:
+        for key, outcome in zip(pending, _parse_entries(pending, use_processes, max_workers)):
+            outcomes[key] = outcome
+            _cache_store(key, outcome[0])
+
+    results = []
+    for key in keys:
+        result, error = outcomes[key]
+        results.append({'link': key[0], 'result': copy.deepcopy(result), 'error': error})
+    return results
 
 # ==============================================================================
 # SECTION 4: 订阅内容解析 (Subscription Helper)
 # ==============================================================================
 
+# 订阅中支持的协议 (别名 -> 统一协议名)
+_SUB_PROTOCOLS = {
+    'hysteria2': 'hy2', 'hy2': 'hy2',
+    'shadowsocks': 'ss',
+    'vmess': 'vmess',
+    'vless': 'vless', 'tuic': 'tuic', 'trojan': 'trojan', 'socks5': 'socks5',
+}
+
+def _line_to_entry(line):
+    """将订阅中的一行转换为 {'name', 'protocol', 'link'}，不是受支持的链接时返回 None"""
+    line = line.strip()
+    if not line or '://' not in line: return None
+
+    protocol = _SUB_PROTOCOLS.get(line.split('://')[0].lower())
+    if not protocol: return None
+
+    name = "Unknown Node"
+    if '#' in line:
+        try:
+            raw_name = line.split('#')[-1]
+            name = urllib.parse.unquote(raw_name).strip()
+        except: pass
+    else:
+        try:
+            parsed = urllib.parse.urlparse(line)
+            name = f"{parsed.hostname}:{parsed.port}"
+        except: pass
+
+    return {
+        'name': name,
+        'protocol': protocol,
+        'link': line
+    }
+
 def extract_nodes_from_content(content):
     """
     [订阅辅助] 从订阅文本（可能是 Base64 编码的）中提取每行链接
-    用于 routes.py 中的 fetch_from_sub_api
+    大体积订阅请使用 iter_nodes_from_chunks 流式处理
     """
     nodes = []
     
     decoded = safe_base64_decode(content)
     text_content = decoded if decoded else content
     
-    lines = text_content.splitlines()
-    
-    for line in lines:
-        line = line.strip()
-        if not line: continue
-        
-        protocol = None
-        if '://' in line:
-            protocol = line.split('://')[0].lower()
-        
-        if protocol in ['hysteria2', 'hy2']: protocol = 'hy2'
-        elif protocol in ['shadowsocks']: protocol = 'ss'
-        elif protocol in ['vmess', 'VMESS']: protocol = 'vmess'
-        elif protocol in ['vless', 'tuic', 'trojan', 'socks5']: pass
-        else: continue 
-        
-        name = "Unknown Node"
-        if '#' in line:
-            try:
-                raw_name = line.split('#')[-1]
-                name = urllib.parse.unquote(raw_name).strip()
-            except: pass
-        else:
-            try:
-                parsed = urllib.parse.urlparse(line)
-                name = f"{parsed.hostname}:{parsed.port}"
-            except: pass
-
-        nodes.append({
-            'name': name,
-            'protocol': protocol,
-            'link': line
-        })
+    for line in text_content.splitlines():
+        entry = _line_to_entry(line)
+        if entry: nodes.append(entry)
         
-    return nodes
\ No newline at end of file
+    return nodes
+
+# Base64 订阅允许出现的字符 (含 URL Safe 字符与换行)
+_BASE64_CHARS = frozenset(b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/-_=\r\n\t ')
+_BASE64_URLSAFE = bytes.maketrans(b'-_', b'+/')
+_WHITESPACE = b' \t\r\n'
+# 判断是否为 Base64 订阅时检查的开头字节数
+_BASE64_DETECT_SIZE = 4096
+
+class _StreamingBase64Decoder:
+    """增量 Base64 解码：每次只解码完整的 4 字符分组，剩余部分留到下一块"""
+
+    def __init__(self):
+        self._pending = b''
+
+    def feed(self, data):
+        data = self._pending + data.translate(_BASE64_URLSAFE, _WHITESPACE)
+        usable = len(data) - len(data) % 4
+        self._pending = data[usable:]
+        return base64.b64decode(data[:usable]) if usable else b''
+
+    def flush(self):
+        data, self._pending = self._pending.rstrip(b'='), b''
+        if not data: return b''
+        return base64.b64decode(data + b'=' * (-len(data) % 4))
+
+def _iter_lines(text_chunks):
+    """将文本块拼接并按行输出，只保留最后一个不完整的行"""
+    tail = ''
+    for text in text_chunks:
+        if not text: continue
+        lines = (tail + text).split('\n')
+        tail = lines.pop()
+        yield from lines
+    if tail:
+        yield tail
+
+def _iter_text_chunks(chunks):
+    """
+    把原始字节块转换为文本块。
+    先缓存开头的 _BASE64_DETECT_SIZE 字节判断是否为 Base64 订阅 (只包含 Base64 字符)，是则增量解码；
+    UTF-8 同样增量解码，多字节字符被分块截断时不会出错。
+    """
+    utf8 = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    b64 = None
+    head = b''
+
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        if not chunk: continue
+        if b64 is None:
+            head += chunk
+            if not _BASE64_CHARS.issuperset(head):
+                b64 = False
+            elif len(head) >= _BASE64_DETECT_SIZE:
+                b64 = _StreamingBase64Decoder()
+            else:
+                continue
+            chunk, head = head, b''
+        yield utf8.decode(b64.feed(chunk) if b64 else chunk)
+
+    if head:
+        # 内容很短，无法提前判断：与 extract_nodes_from_content 一样先尝试整体解码
+        decoded = safe_base64_decode(head.decode('utf-8', errors='replace'))
+        yield decoded if decoded else utf8.decode(head)
+    elif b64:
+        yield utf8.decode(b64.flush())
+    yield utf8.decode(b'', final=True)
+
+def iter_nodes_from_chunks(chunks):
+    """
+    [订阅辅助] 流式版本的 extract_nodes_from_content
+    chunks: 字节 (或字符串) 块的可迭代对象，例如 requests 的 resp.iter_content()
+    逐个产出 {'name', 'protocol', 'link'}，内存占用与订阅大小无关
+    """
+    for line in _iter_lines(_iter_text_chunks(chunks)):
+        entry = _line_to_entry(line)
+        if entry: yield entry
@@ -0,0 +1,238 @@
+# node_registry.py
+# 节点注册表：在内存中缓存 "DB 节点 + 本地节点表" 合并后的统一节点列表
+
+import copy
+import threading
+from contextlib import contextmanager
+
+from app.utils.db_manager import get_all_nodes, get_node_data_version
+
+
+class NodeRegistry:
+    """
+    合并节点列表的进程内缓存。
+    只有以下情况才会重新合并：
+    1. DB 节点数据版本戳变化 (bulk_upsert_nodes / update_node_details 等写操作会刷新)
+    2. 本地节点存储的版本标识变化 (其他进程写入)
+    所有写操作都应通过 save() / save_node() / delete_node() 完成，保证缓存与存储一致；
+    读-改-写需放在 locked() 中，防止并发请求互相覆盖。
+    """
+
+    def __init__(self, store):
+        self._store = store
+        self._lock = threading.RLock()
+        self._nodes = None
+        self._db_version = None
+        self._store_stamp = None
+        # 每次缓存内容变化时递增，供下游缓存 (订阅生成物等) 判断是否过期
+        self.generation = 0
+
+    # ---------------------------------------------------------
+    # 读取
+    # ---------------------------------------------------------
+    def get_nodes(self):
+        """返回合并后节点列表的深拷贝，调用方可以随意修改后再 save()"""
+        with self._lock:
+            return copy.deepcopy(self._ensure_fresh())
+
+    def snapshot(self):
+        """
+        返回缓存中的节点列表本身 (只读)。
+        仅用于只读的热路径 (统计、订阅生成)，调用方不得修改其中的任何字典。
+        """
+        with self._lock:
+            return self._ensure_fresh()
+
+    def versioned_snapshot(self):
+        """原子地返回 (generation, 只读节点列表)，供下游缓存作为 key 使用"""
+        with self._lock:
+            nodes = self._ensure_fresh()
+            return self.generation, nodes
+
+    def find(self, uuid_val):
+        """按 uuid 查找节点 (走存储的索引)，返回可修改的字典或 None"""
+        with self._lock:
+            self._ensure_fresh()
+            return self._store.get(uuid_val)
+
+    def find_by_name(self, name, origins):
+        """按名称查找指定来源的节点 (走存储的索引)，返回可修改的字典或 None"""
+        with self._lock:
+            self._ensure_fresh()
+            return self._store.find_by_name(name, origins)
+
+    # ---------------------------------------------------------
+    # 写入
+    # ---------------------------------------------------------
+    @contextmanager
+    def locked(self):
+        """
+        独占节点数据 (可重入)，用法：
+            with node_registry.locked():
+                nodes = node_registry.get_nodes()
+                ...修改 nodes...
+                node_registry.save(nodes)
+        注意：不要在锁内等待需要读取节点的后台任务 (例如 request_files_sync(wait=True))
+        """
+        with self._lock, self._store.locked():
+            yield
+
+    def save(self, nodes, db_node_updates=None):
+        """
+        保存完整节点列表并同步更新缓存 (存储层只写有变化的节点)。
+        db_node_updates: {uuid: {'custom_name' / 'routing_type': ...}}，对 DB 节点的修改与列表一起原子提交
+        """
+        with self._lock:
+            if not self._store.save(nodes, db_node_updates):
+                # 写入失败时丢弃缓存，下次读取重新加载
+                self._nodes = None
+                return False
+            self._nodes = copy.deepcopy(nodes)
+            self._store_stamp = self._store.stamp()
+            self.generation += 1
+            return True
+
+    def save_node(self, node):
+        """只写入单个节点 (新增或更新)，其余节点不受影响"""
+        return self.save_nodes([node])
+
+    def save_nodes(self, nodes):
+        """只写入给定的若干节点 (新增或更新)"""
+        with self._lock:
+            if not self._store.upsert(nodes):
+                self._nodes = None
+                return False
+            self._patch_cache(updated=nodes)
+            return True
+
+    def delete_node(self, uuid_val):
+        """删除单个节点；写入失败时不修改缓存 (下次读取重新加载)"""
+        with self._lock:
+            if self._store.delete([uuid_val]) is None:
+                self._nodes = None
+                return False
+            self._patch_cache(removed={uuid_val})
+            return True
+
+    def invalidate(self):
+        """强制下次读取时重新合并"""
+        with self._lock:
+            self._nodes = None
+
+    # ---------------------------------------------------------
+    # 内部逻辑
+    # ---------------------------------------------------------
+    def _patch_cache(self, updated=(), removed=()):
+        """单点写入后就地更新缓存，避免整表重新加载 (生成新列表，不修改只读快照)"""
+        if self._nodes is None:
+            return
+        updated = {n['uuid']: copy.deepcopy(n) for n in updated}
+        nodes = []
+        for node in self._nodes:
+            uuid_val = node['uuid']
+            if uuid_val in removed:
+                continue
+            nodes.append(updated.pop(uuid_val, node))
+        nodes.extend(updated.values())
+        nodes.sort(key=lambda x: x.get('sort_index', 9999))
+        self._nodes = nodes
+        self._store_stamp = self._store.stamp()
+        self.generation += 1
+
+    def _ensure_fresh(self):
+        db_version = get_node_data_version()
+        store_stamp = self._store.stamp()
+
+        if self._nodes is None or db_version != self._db_version or store_stamp != self._store_stamp:
+            # 合并结果可能需要回写，整个过程持有存储锁，避免与其他进程的写入交错
+            with self._store.locked():
+                nodes, has_changes = self._merge()
+                if has_changes:
+                    self._store.save(nodes)
+                store_stamp = self._store.stamp()
+            self._nodes = nodes
+            self._db_version = db_version
+            self._store_stamp = store_stamp
+            self.generation += 1
+
+        return self._nodes
+
+    def _merge(self):
+        """
+        将数据库节点同步到本地节点表
+        修改点：将 DB 节点的 is_fixed 改为 False，允许前端拖拽改变分组
+        返回 (合并后的节点列表, 是否需要回写文件)
+        """
+        db_nodes = get_all_nodes()
+        local_nodes = self._store.load()
+
+        local_map = {n['uuid']: n for n in local_nodes}
+        active_db_uuids = set()
+        has_changes = False
+
+        # --- 1. 同步 DB 节点 ---
+        for db_node in db_nodes:
+            uuid_str = str(db_node.uuid)
+            active_db_uuids.add(uuid_str)
+
+            # 获取 DB 权威数据
+            db_name = db_node.custom_name or db_node.name
+            links = db_node.get_links_dict()
+            r_type = db_node.routing_type if db_node.routing_type is not None else -1
+            region = db_node.region or 'DB'
+
+            if uuid_str in local_map:
+                # [更新]
+                node = local_map[uuid_str]
+
+                updates = {
+                    'name': db_name,
+                    'links': links,
+                    'routing_type': r_type,
+                    'region': region,
+                    'origin': 'db',
+                    'is_fixed': False  # 允许 DB 节点被拖拽移动
+                }
+
+                for k, v in updates.items():
+                    if node.get(k) != v:
+                        node[k] = v
+                        has_changes = True
+
+                if 'sort_index' not in node:
+                    node['sort_index'] = 9999
+                    has_changes = True
+
+            else:
+                # [新增]
+                new_node = {
+                    "uuid": uuid_str,
+                    "name": db_name,
+                    "links": links,
+                    "routing_type": r_type,
+                    "region": region,
+                    "origin": "db",
+                    "is_fixed": False,  # 允许 DB 节点被拖拽移动
+                    "sort_index": 99999
+                }
+                local_nodes.append(new_node)
+                has_changes = True
+
+        # --- 2. 清理失效节点 ---
+        final_nodes = []
+        for node in local_nodes:
+            is_db_node = node.get('origin') == 'db'
+
+            if is_db_node and node['uuid'] not in active_db_uuids:
+                has_changes = True
+                continue
+
+            if not is_db_node:
+                if node.get('origin') not in ['local', 'sub']:
+                    node['origin'] = 'local'
+                    node['is_fixed'] = False
+                    has_changes = True
+
+            final_nodes.append(node)
+
+        return final_nodes, has_changes
@@ -0,0 +1,164 @@
+# node_store.py
+# 本地节点存储层：
+# - LocalNodeDBStore: 节点保存在数据库 local_nodes 表中，支持按 uuid / 名称的单点读写
+# - load_local_nodes_json: 读取旧版 local_nodes.json，仅用于一次性导入
+# 使用 同进程可重入线程锁 + 跨进程文件锁 (fcntl / msvcrt) 保护 "读-改-写"
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from app.utils.db_manager import (get_all_local_nodes, get_local_node, find_local_node_by_name,
+                                  replace_local_nodes, upsert_local_nodes, delete_local_nodes,
+                                  get_local_node_version)
+
+try:
+    import fcntl
+    msvcrt = None
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+class _LockedStore:
+    """可重入的 线程锁 + 文件锁，子类提供锁文件路径"""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        # 每个线程各自的加锁层数，其他线程持锁时不会误判为自己持锁
+        self._local = threading.local()
+        self._lock_file = None
+
+    def _lock_path(self):
+        raise NotImplementedError
+
+    @contextmanager
+    def locked(self):
+        """
+        独占锁 (同一线程可重入)。
+        读-改-写必须整体放在锁内，否则并发请求之间会互相覆盖修改。
+        """
+        with self._lock:
+            depth = getattr(self._local, 'depth', 0)
+            if depth == 0:
+                self._lock_file = self._acquire_file_lock()
+            self._local.depth = depth + 1
+            try:
+                yield self
+            finally:
+                self._local.depth = depth
+                if depth == 0:
+                    self._release_file_lock(self._lock_file)
+                    self._lock_file = None
+
+    def held(self):
+        """当前线程是否持有锁"""
+        return getattr(self._local, 'depth', 0) > 0
+
+    def _acquire_file_lock(self):
+        """对旁路的 .lock 文件加锁 (不锁数据文件本身，因为它会被原子替换)"""
+        try:
+            f = open(self._lock_path(), 'a+')
+        except OSError as e:
+            # 目录只读等情况下退化为仅进程内加锁
+            print(f"[NodeStore] 无法创建锁文件，仅使用进程内锁: {e}")
+            return None
+
+        try:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            else:
+                f.seek(0)
+                while True:
+                    try:
+                        msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError:
+                        # LK_LOCK 重试约 10 秒后仍失败会抛错，继续等待
+                        time.sleep(0.1)
+        except Exception as e:
+            print(f"[NodeStore] 文件加锁失败，仅使用进程内锁: {e}")
+        return f
+
+    @staticmethod
+    def _release_file_lock(f):
+        if f is None:
+            return
+        try:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        except Exception:
+            pass
+        finally:
+            f.close()
+
+
+def load_local_nodes_json(path):
+    """读取旧版 local_nodes.json 的节点列表；文件不存在或损坏时返回空列表"""
+    if not os.path.exists(path):
+        return []
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            text = f.read()
+        # 初始模板文件为空白内容，视为没有节点
+        return json.loads(text) if text.strip() else []
+    except Exception as e:
+        print(f"Error loading local nodes: {e}")
+        return []
+
+
+class LocalNodeDBStore(_LockedStore):
+    """
+    数据库 local_nodes 表的存储层：整表读写 (load / save)、版本戳 (stamp) 与加锁 (locked)，
+    另外提供按 uuid / 名称的单点读写，修改单个节点时只写对应的行。
+    """
+
+    def __init__(self, lock_path_getter):
+        super().__init__()
+        self._lock_path_getter = lock_path_getter
+
+    def _lock_path(self):
+        return self._lock_path_getter()
+
+    def load(self):
+        """读取全部节点 (按 sort_index 排序)"""
+        return get_all_local_nodes()
+
+    def save(self, nodes, db_node_updates=None):
+        """
+        用完整列表替换表内容 (只写有变化的行)，成功返回 True。
+        db_node_updates 为对 DB 节点的修改，与节点列表在同一事务中提交。
+        """
+        # 与旧版保持一致：保存前按 sort_index 排序
+        nodes.sort(key=lambda x: x.get('sort_index', 9999))
+        with self.locked():
+            return replace_local_nodes(nodes, db_node_updates)
+
+    def stamp(self):
+        """
+        数据版本戳。持有锁时直接查库，保证 读-改-写 能看到其他进程刚提交的修改；
+        其余时候走进程内配置缓存。
+        """
+        return get_local_node_version(fresh=self.held())
+
+    # ---------------------------------------------------------
+    # 单点读写
+    # ---------------------------------------------------------
+    def get(self, uuid_val):
+        return get_local_node(uuid_val)
+
+    def find_by_name(self, name, origins):
+        return find_local_node_by_name(name, origins)
+
+    def upsert(self, nodes):
+        with self.locked():
+            return upsert_local_nodes(nodes)
+
+    def delete(self, uuids):
+        with self.locked():
+            return delete_local_nodes(uuids)
@@ -0,0 +1,91 @@
+# regen_worker.py
+# 订阅相关的后台任务：合并短时间内的多次请求，只执行一次 (重建 0.yaml / 1.yaml、补全节点归属地等)
+
+import threading
+import time
+
+
+class RegenerationWorker:
+    """
+    防抖 + 合并的后台任务线程。
+    - request() 只登记一次 "需要执行"，立即返回；
+    - 后台线程等到 debounce 秒内没有新请求 (最长等待 max_delay 秒) 后执行一次 task；
+    - 需要读写一致时可以 request(wait=True)，阻塞到覆盖本次请求的那一轮执行完成。
+    """
+
+    def __init__(self, task, debounce=0.5, max_delay=3.0, name='subscription-regen'):
+        self._task = task
+        self._name = name
+        self._debounce = debounce
+        self._max_delay = max_delay
+        self._cond = threading.Condition()
+        self._requested = 0
+        self._completed = 0
+        self._last_result = (True, '')
+        self._app = None
+        self._thread = None
+
+    def request(self, app, wait=False, timeout=30):
+        """
+        登记一次执行请求。
+        wait=False 时返回 None；wait=True 时返回该轮执行的 (success, message)。
+        """
+        with self._cond:
+            self._requested += 1
+            target = self._requested
+            self._app = app
+            self._ensure_thread()
+            self._cond.notify_all()
+
+            if not wait:
+                return None
+            if not self._cond.wait_for(lambda: self._completed >= target, timeout):
+                return False, '等待后台任务完成超时'
+            return self._last_result
+
+    @property
+    def pending(self):
+        with self._cond:
+            return self._requested > self._completed
+
+    @property
+    def last_result(self):
+        """最近一轮执行的 (success, message)"""
+        with self._cond:
+            return self._last_result
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name=self._name, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._requested > self._completed)
+                seen = self._requested
+            started_at = time.monotonic()
+
+            # 防抖：debounce 时间内仍有新请求则继续等待，但总等待不超过 max_delay
+            while time.monotonic() - started_at < self._max_delay:
+                time.sleep(self._debounce)
+                with self._cond:
+                    if self._requested == seen:
+                        break
+                    seen = self._requested
+
+            with self._cond:
+                target = self._requested
+                app = self._app
+
+            try:
+                with app.app_context():
+                    result = self._task()
+            except Exception as e:
+                print(f"[{self._name} Error] {e}")
+                result = (False, f"执行失败: {str(e)}")
+
+            with self._cond:
+                self._completed = target
+                self._last_result = result
+                self._cond.notify_all()
@@ -1,6 +1,6 @@
 # routes.py
 
-from flask import Blueprint, render_template, jsonify, Response, make_response, request, url_for, abort
+from flask import Blueprint, render_template, jsonify, Response, make_response, request, url_for, abort, current_app
 from flask_login import login_required
 # 引入 update_node_custom_name 用于 DB 节点改名
 from app.utils.db_manager import get_all_nodes, update_node_details, get_config, set_config, update_node_custom_name
@@ -15,39 +15,24 @@ import time
 import urllib.parse
 import uuid
 from io import BytesIO
-import socket
+import threading
+import copy
 
 from ruamel.yaml import YAML
-from .link_parser import parse_proxy_link, get_emoji_flag, extract_nodes_from_content, fix_link_ipv6
+from .link_parser import (parse_proxy_link, parse_proxy_links, get_emoji_flag, fix_link_ipv6,
+                          iter_nodes_from_chunks,
+                          configure_parse_cache, get_parse_cache_stats, DEFAULT_PARSE_CACHE_SIZE,
+                          configure_parse_processes)
+from .node_registry import NodeRegistry
+from .node_store import LocalNodeDBStore, load_local_nodes_json
+from .artifacts import artifact_cache, make_artifact_response
+from .regen_worker import RegenerationWorker
+from .geoip import resolve_regions # IP 归属地批量查询 (带持久缓存)
 
 bp = Blueprint('subscription', __name__, url_prefix='/subscription', template_folder='templates')
 
-# [新增] IP 归属地查询辅助函数
-def get_ip_region(host):
-    """
-    输入 IP 或域名，返回国家代码 (例如 'US', 'HK', 'CN')
-    使用 ip-api.com 免费接口 (限制 45次/分，足够个人使用)
-    """
-    if not host: return ''
-    try:
-        # 1. 尝试解析域名为 IP (可选，ip-api 其实支持域名，但转 IP 更稳)
-        # import socket  <-- 记得在文件最顶部确认 import socket，如果没有就加上，或者直接传域名
-        try:
-            target = socket.gethostbyname(host)
-        except:
-            target = host # 解析失败则直接用原值尝试
-
-        # 2. 调用 API
-        url = f"http://ip-api.com/json/{target}?fields=status,countryCode"
-        resp = requests.get(url, timeout=3) # 设置短超时，防止卡住
-        if resp.status_code == 200:
-            data = resp.json()
-            if data.get('status') == 'success':
-                return data.get('countryCode', '') # 返回 'US' 等
-    except Exception as e:
-        print(f"[IP Query Fail] {host}: {e}")
-    
-    return ''
+# 流式下载外部订阅时每次读取的字节数
+SUB_STREAM_CHUNK_SIZE = 64 * 1024
 
 # ---------------------------------------------------------
 # 新增辅助函数：自愈机制
@@ -124,135 +109,103 @@ def get_nodes_dir():
 # 2. 本地节点管理工具 & 核心同步逻辑
 # ---------------------------------------------------------
 LOCAL_NODES_FILE = 'local_nodes.json'
+LOCAL_NODES_LOCK_FILE = 'local_nodes.lock'
 
 def get_local_nodes_path():
+    """旧版本地节点 JSON 文件路径 (现在仅用于一次性导入)"""
     return os.path.join(get_nodes_dir(), LOCAL_NODES_FILE)
 
-def load_local_nodes_raw():
-    """
-    [底层函数] 仅读取原始 JSON 数据，不进行业务逻辑处理
-    """
-    path = get_local_nodes_path()
-    if not os.path.exists(path): return []
-    try:
-        with open(path, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except: return []
+def get_local_nodes_lock_path():
+    return os.path.join(get_nodes_dir(), LOCAL_NODES_LOCK_FILE)
 
-# 建立别名兼容旧代码调用
-load_local_nodes = load_local_nodes_raw
+# 本地节点存储：数据库 local_nodes 表 (加锁保护读-改-写，只写有变化的行)
+local_node_store = LocalNodeDBStore(get_local_nodes_lock_path)
 
-def save_local_nodes(nodes):
-    """保存节点列表到 JSON"""
-    try:
-        # 保存前按 sort_index 排序，保持文件整洁
-        nodes.sort(key=lambda x: x.get('sort_index', 9999))
-        with open(get_local_nodes_path(), 'w', encoding='utf-8') as f:
-            json.dump(nodes, f, ensure_ascii=False, indent=2)
-        return True
-    except Exception as e:
-        print(f"Error saving local nodes: {e}")
-        return False
+# 合并节点列表的内存缓存 (DB 节点 + 本地节点表)
+# 仅在 DB 节点版本戳或本地节点版本戳变化时才重新合并，所有写操作都通过 node_registry
+# 读-改-写必须放在 node_registry.locked() 中
+node_registry = NodeRegistry(local_node_store)
 
-def merge_db_to_local_json():
+def import_local_nodes_json():
     """
-    将数据库节点同步到本地 JSON
-    修改点：将 DB 节点的 is_fixed 改为 False，允许前端拖拽改变分组
+    把旧版 local_nodes.json 导入本地节点表 (升级后首次启动执行一次)，返回导入的节点数。
+    导入后原文件改名为 local_nodes.json.imported 作为备份，之后再编辑它不会生效。
     """
-    db_nodes = get_all_nodes()
-    local_nodes = load_local_nodes_raw()
-    
-    local_map = {n['uuid']: n for n in local_nodes}
-    active_db_uuids = set()
-    has_changes = False
-
-    # --- 1. 同步 DB 节点 ---
-    for db_node in db_nodes:
-        uuid_str = str(db_node.uuid)
-        active_db_uuids.add(uuid_str)
-        
-        # 获取 DB 权威数据
-        db_name = db_node.custom_name or db_node.name
-        links = db_node.get_links_dict()
-        r_type = db_node.routing_type if db_node.routing_type is not None else -1
-        region = db_node.region or 'DB'
-
-        if uuid_str in local_map:
-            # [更新]
-            node = local_map[uuid_str]
-            
-            updates = {
-                'name': db_name,
-                'links': links,
-                'routing_type': r_type,
-                'region': region,
-                'origin': 'db',
-                'is_fixed': False  # 允许 DB 节点被拖拽移动
-            }
-            
-            for k, v in updates.items():
-                if node.get(k) != v:
-                    node[k] = v
-                    has_changes = True
-            
-            if 'sort_index' not in node:
-                node['sort_index'] = 9999
-                has_changes = True
-                
-        else:
-            # [新增]
-            new_node = {
-                "uuid": uuid_str,
-                "name": db_name,
-                "links": links,
-                "routing_type": r_type,
-                "region": region,
-                "origin": "db",
-                "is_fixed": False, # 允许 DB 节点被拖拽移动
-                "sort_index": 99999
-            }
-            local_nodes.append(new_node)
-            has_changes = True
-
-    # --- 2. 清理失效节点 ---
-    final_nodes = []
-    for node in local_nodes:
-        is_db_node = node.get('origin') == 'db'
-        
-        if is_db_node and node['uuid'] not in active_db_uuids:
-            has_changes = True
-            continue 
-            
-        if not is_db_node:
-            if node.get('origin') not in ['local', 'sub']:
-                node['origin'] = 'local'
-                node['is_fixed'] = False 
-                has_changes = True
+    path = get_local_nodes_path()
+    nodes = [n for n in load_local_nodes_json(path) if isinstance(n, dict)]
+    if not nodes:
+        return 0
+
+    for node in nodes:
+        node.setdefault('uuid', str(uuid.uuid4()))
+    with local_node_store.locked():
+        existing = {n['uuid'] for n in local_node_store.load()}
+        new_nodes = [n for n in nodes if n['uuid'] not in existing]
+        if new_nodes and not local_node_store.upsert(new_nodes):
+            raise RuntimeError('写入本地节点表失败')
+    node_registry.invalidate()
+
+    try:
+        os.replace(path, f"{path}.imported")
+    except OSError as e:
+        print(f"[{time.strftime('%H:%M:%S')}] 旧节点文件改名失败 (不影响使用): {e}")
+    return len(new_nodes)
 
-        final_nodes.append(node)
-    
-    if has_changes:
-        save_local_nodes(final_nodes)
-        return final_nodes
-    
-    return final_nodes
 # ---------------------------------------------------------
 # 3. 配置文件生成逻辑 (读取统一数据源)
 # ---------------------------------------------------------
+# 已编译的 Clash 代理缓存：(link, display_name, region) -> proxy_dict (解析失败为 None)
+# 每次生成只重新解析输入发生变化的链接，未被引用的条目在生成后清除
+_compiled_proxies = {}
+_compiled_proxies_lock = threading.Lock()
+
+def _compile_proxies(cache, keys):
+    """批量编译缓存中缺失的代理 (开启 LINK_PARSE_PROCESSES 且链接很多时由 parse_proxy_links 分发到进程池)"""
+    missing = [key for key in dict.fromkeys(keys) if key not in cache]
+    if not missing:
+        return
+
+    # 注意：虽然传入了 display_name，但解析器可能会优先读取 link 中的 #hash
+    for key, item in zip(missing, parse_proxy_links(missing)):
+        proxy_dict = item['result']
+        if proxy_dict:
+            # 无论 parse_proxy_link 返回的 name 是什么（可能是旧的后缀格式），
+            # 这里强制将其覆盖为我们刚刚构造的前缀格式。
+            proxy_dict['name'] = key[1]
+        cache[key] = proxy_dict
+
+# 上一次成功生成配置文件时节点注册表的 generation，用于判断文件是否已是最新
+_synced_generation = None
+
+def apply_link_parser_settings():
+    """按设置调整链接解析缓存容量与进程池开关 (应用启动时及每次生成配置前调用)"""
+    try:
+        configure_parse_cache(int(get_config('LINK_PARSE_CACHE_SIZE', DEFAULT_PARSE_CACHE_SIZE)))
+    except (ValueError, TypeError):
+        pass
+    configure_parse_processes(str(get_config('LINK_PARSE_PROCESSES', '0')).strip().lower() in ['1', 'true', 'on', 'yes'])
+
 def sync_nodes_to_files():
     """
     生成 0.yaml 和 1.yaml
     强制将 YAML 中的 name 字段重写为 'Flag Proto-Name' 格式
     """
-    # 1. 获取最新合并后的节点列表
-    all_nodes = merge_db_to_local_json()
-    
-    # 2. 按 sort_index 排序
-    all_nodes.sort(key=lambda x: x.get('sort_index', 0))
+    global _synced_generation
+    # 设置可能在运行中被修改，每次生成前同步一次
+    apply_link_parser_settings()
+
+    # 1. 获取最新合并后的节点列表 (只读快照)，并按 sort_index 排序
+    generation, all_nodes = node_registry.versioned_snapshot()
+    all_nodes = sorted(all_nodes, key=lambda x: x.get('sort_index', 0))
 
     proxies_map = {0: [], 1: []}
     count_summary = {0: 0, 1: 0}
 
+    with _compiled_proxies_lock:
+        cache = dict(_compiled_proxies)
+    # (routing_type, 编译 key)，保持节点排序
+    entries = []
+
     for node in all_nodes:
         r_type = node.get('routing_type', -1)
         if r_type not in proxies_map: continue
@@ -285,16 +238,27 @@ def sync_nodes_to_files():
                 # 2. 构造强制名称：Flag Protocol-Name (例如: 🇸🇬 hy2-SG-NAT1)
                 display_name = f"{flag} {name_prefix}{node_name}".strip()
                 
-                # 3. 调用解析器
-                # 注意：虽然传入了 display_name，但解析器可能会优先读取 link 中的 #hash
-                proxy_dict = parse_proxy_link(link.strip(), display_name, region)
-                
-                if proxy_dict:
-                    # 无论 parse_proxy_link 返回的 name 是什么（可能是旧的后缀格式），
-                    # 这里强制将其覆盖为我们刚刚构造的前缀格式。
-                    proxy_dict['name'] = display_name
-                    proxies_map[r_type].append(proxy_dict)
-                    count_summary[r_type] += 1
+                entries.append((r_type, (link.strip(), display_name, region)))
+
+    # 3. 编译代理 (输入未变化的链接直接复用缓存，其余一次性批量解析)
+    _compile_proxies(cache, [key for _, key in entries])
+
+    used_keys = set()
+    for r_type, key in entries:
+        proxy_dict = cache[key]
+        if key in used_keys and proxy_dict:
+            # 同一次生成中重复出现的代理需独立对象，否则 YAML 会输出锚点/别名
+            proxy_dict = copy.deepcopy(proxy_dict)
+        used_keys.add(key)
+
+        if proxy_dict:
+            proxies_map[r_type].append(proxy_dict)
+            count_summary[r_type] += 1
+
+    # 只保留本次仍被引用的编译结果，已删除/已修改节点的旧条目随之淘汰
+    with _compiled_proxies_lock:
+        _compiled_proxies.clear()
+        _compiled_proxies.update((k, cache[k]) for k in used_keys)
 
     # --- 写入 YAML ---
     nodes_dir = get_nodes_dir()
@@ -305,21 +269,112 @@ def sync_nodes_to_files():
     yaml.width = 4096
 
     try:
-        with open(os.path.join(nodes_dir, '0.yaml'), 'w', encoding='utf-8') as f:
-            yaml.dump({'proxies': proxies_map[0]}, f)
-        with open(os.path.join(nodes_dir, '1.yaml'), 'w', encoding='utf-8') as f:
-            yaml.dump({'proxies': proxies_map[1]}, f)  
+        for r_type in (0, 1):
+            # 先写临时文件再替换，避免订阅请求读到写了一半的 YAML
+            target = os.path.join(nodes_dir, f'{r_type}.yaml')
+            tmp_path = f"{target}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                yaml.dump({'proxies': proxies_map[r_type]}, f)
+            os.replace(tmp_path, target)
+        _synced_generation = generation
         return True, f"同步成功: 直连 {count_summary[0]}, 落地 {count_summary[1]}"
     except Exception as e:
         return False, f"写入失败: {str(e)}"
 
+# 后台重建线程：短时间内的多次修改 (例如连续拖拽排序) 合并为一次配置文件重建
+regen_worker = RegenerationWorker(sync_nodes_to_files)
+
+def _files_up_to_date():
+    """没有待执行的重建，且配置文件由当前版本的节点数据生成"""
+    if regen_worker.pending or _synced_generation is None:
+        return False
+    if node_registry.versioned_snapshot()[0] != _synced_generation:
+        return False
+    nodes_dir = get_nodes_dir()
+    return all(os.path.exists(os.path.join(nodes_dir, f'{r_type}.yaml')) for r_type in (0, 1))
+
+def request_files_sync(wait=False):
+    """
+    请求重建 0.yaml / 1.yaml (防抖合并，在后台线程执行)
+    wait=True 时阻塞到包含本次修改的重建完成并返回 (success, message)，否则立即返回 None；
+    文件已是最新时 wait=True 直接返回上一轮的结果，不再等待防抖
+    """
+    if wait and _files_up_to_date():
+        return regen_worker.last_result
+    return regen_worker.request(current_app._get_current_object(), wait=wait)
+
+# ---------------------------------------------------------
+# 节点归属地后台补全
+# ---------------------------------------------------------
+# 新增节点先以空地区保存并标记 region_pending，由后台线程批量查询后再回填，
+# 避免添加接口 (尤其是批量部署脚本的回调) 被 DNS + GeoIP 查询阻塞
+REGION_PENDING_FLAG = 'region_pending'
+
+def _extract_server(link):
+    """复用 link_parser 解析出链接中的 server 地址"""
+    try:
+        proxy_info = parse_proxy_link(link, "temp", "")
+        return proxy_info.get('server') if proxy_info else None
+    except Exception:
+        return None
+
+def enrich_pending_regions():
+    """后台任务：为所有 region_pending 的节点批量查询并回填地区代码"""
+    pending = []
+    for node in node_registry.snapshot():
+        if node.get(REGION_PENDING_FLAG):
+            link = next((l for l in node.get('links', {}).values() if l), None)
+            pending.append((node['uuid'], _extract_server(link) if link else None))
+    if not pending:
+        return True, '没有待补全归属地的节点'
+
+    # 网络查询在读取/保存节点列表之外完成，避免长时间持有节点数据
+    regions = resolve_regions({host for _, host in pending if host}, with_status=True)
+
+    with node_registry.locked():
+        updated = []
+        resolved = 0
+        for uuid_val, host in pending:
+            node = node_registry.find(uuid_val)
+            if not node or not node.get(REGION_PENDING_FLAG):
+                continue
+            # 解析不出地址的节点无需重试；查询失败 (限流 / 超时等) 的保留标记，稍后由 /api/stats 重新触发
+            region_code, definitive = regions.get(host, ('', False)) if host else ('', True)
+            if not definitive:
+                continue
+            node.pop(REGION_PENDING_FLAG, None)
+            if region_code and not node.get('region'):
+                node['region'] = region_code
+                resolved += 1
+            updated.append(node)
+        if updated:
+            node_registry.save_nodes(updated)
+
+    if updated:
+        request_files_sync()
+    print(f"[{time.strftime('%H:%M:%S')}] 节点归属地补全完成: {resolved}/{len(pending)}")
+    return True, f"归属地补全完成: {resolved}/{len(pending)}"
+
+region_worker = RegenerationWorker(enrich_pending_regions, debounce=1.0, max_delay=5.0, name='region-enrich')
+
+def request_region_enrichment():
+    """请求后台补全节点归属地 (短时间内的多次请求合并为一次批量查询)"""
+    region_worker.request(current_app._get_current_object())
+
+def _wants_wait(data=None):
+    """写接口是否要求读写一致：URL 参数 ?wait=1 或 JSON 中 "wait": true"""
+    flag = request.args.get('wait')
+    if flag is None and isinstance(data, dict):
+        flag = data.get('wait')
+    return str(flag).lower() in ('1', 'true', 'yes') if flag is not None else False
+
 # ---------------------------------------------------------
 # 4. 统计逻辑
 # ---------------------------------------------------------
 def get_stats_data():
     """获取统计信息：修改为统一从合并列表获取"""
-    # 触发同步，获取全量数据
-    all_nodes = merge_db_to_local_json()
+    # 获取全量数据 (只读快照)
+    all_nodes = node_registry.snapshot()
 
     stats = {
         "total": len(all_nodes),
@@ -427,48 +482,61 @@ def refresh_token_api():
         return jsonify({'status': 'success', 'token': new_token, 'message': 'Token 已刷新'})
     return jsonify({'status': 'error', 'message': '刷新失败'}), 500
 
+def _build_clash_config(path, base_url, token, timestamp):
+    """根据 clash_meta.yaml 模板生成完整的 Clash 配置 (返回 bytes)"""
+    yaml = YAML()
+    yaml.preserve_quotes = True
+    yaml.indent(mapping=2, sequence=4, offset=2)
+    with open(path, 'r', encoding='utf-8') as f: config_data = yaml.load(f)
+    
+    # 更新 Provider URL
+    if 'proxy-providers' in config_data:
+        for name, p in config_data['proxy-providers'].items():
+            if '0.yaml' in p.get('path', '') or '/raw/0' in p.get('url', '') or '中转' in name:
+                p['url'] = f"{base_url}/subscription/raw/0?token={token}&t={timestamp}"
+                p['interval'] = 300
+            elif '1.yaml' in p.get('path', '') or '/raw/1' in p.get('url', '') or '落地' in name:
+                p['url'] = f"{base_url}/subscription/raw/1?token={token}&t={timestamp}"
+                p['interval'] = 300
+    
+    if 'rule-providers' in config_data:
+        for name, p in config_data['rule-providers'].items():
+            if 'direct' in name or 'direct' in p.get('path', ''):
+                p['url'] = f"{base_url}/subscription/list/direct?token={token}&t={timestamp}"
+            elif 'customize' in name or 'customize' in p.get('path', ''):
+                p['url'] = f"{base_url}/subscription/list/customize?token={token}&t={timestamp}"
+
+    out = BytesIO()
+    yaml.dump(config_data, out)
+    return out.getvalue()
+
 @bp.route('/clash')
 def download_clash_config():
-    """下载 Clash 配置文件"""
+    """
+    下载 Clash 配置文件
+    同一模板版本 + 访问域名 + Token 只生成一次，之后直接返回内存缓存 (支持 ETag/304)
+    """
     verify_request_token()
     
     try:
         base_url = get_base_url()
         token = get_sub_settings().get('api_token', 'default')
-        timestamp = int(time.time())
         path = os.path.join(get_nodes_dir(), 'clash_meta.yaml')
         
         if not os.path.exists(path): return "Error: Template not found.", 404
-        
-        yaml = YAML()
-        yaml.preserve_quotes = True
-        yaml.indent(mapping=2, sequence=4, offset=2)
-        with open(path, 'r', encoding='utf-8') as f: config_data = yaml.load(f)
-        
-        # 更新 Provider URL
-        if 'proxy-providers' in config_data:
-            for name, p in config_data['proxy-providers'].items():
-                if '0.yaml' in p.get('path', '') or '/raw/0' in p.get('url', '') or '中转' in name:
-                    p['url'] = f"{base_url}/subscription/raw/0?token={token}&t={timestamp}"
-                    p['interval'] = 300
-                elif '1.yaml' in p.get('path', '') or '/raw/1' in p.get('url', '') or '落地' in name:
-                    p['url'] = f"{base_url}/subscription/raw/1?token={token}&t={timestamp}"
-                    p['interval'] = 300
-        
-        if 'rule-providers' in config_data:
-            for name, p in config_data['rule-providers'].items():
-                if 'direct' in name or 'direct' in p.get('path', ''):
-                    p['url'] = f"{base_url}/subscription/list/direct?token={token}&t={timestamp}"
-                elif 'customize' in name or 'customize' in p.get('path', ''):
-                    p['url'] = f"{base_url}/subscription/list/customize?token={token}&t={timestamp}"
-
-        out = BytesIO()
-        yaml.dump(config_data, out)
-        resp = make_response(out.getvalue())
-        resp.headers["Content-Disposition"] = "attachment; filename=clash_meta_config.yaml"
-        resp.mimetype = "text/yaml; charset=utf-8"
-        resp.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
-        return resp
+
+        # 以模板修改时间作为 URL 中的版本参数，模板不变时生成结果保持稳定
+        template_mtime = os.stat(path).st_mtime_ns
+        timestamp = template_mtime // 1_000_000_000
+        artifact = artifact_cache.get(
+            'clash',
+            (template_mtime, base_url, token),
+            lambda: _build_clash_config(path, base_url, token, timestamp)
+        )
+        return make_artifact_response(
+            artifact, "text/yaml; charset=utf-8",
+            {"Content-Disposition": "attachment; filename=clash_meta_config.yaml"}
+        )
     except Exception as e: return f"Error: {str(e)}", 500
 
 @bp.route('/install-singbox.sh')
@@ -483,12 +551,17 @@ def download_singbox_script():
 def get_stats_api():
     try:
         # 1. 触发文件同步：
-        # 此函数会执行：a) DB -> local_nodes.json (缓存)
-        #              b) local_nodes.json -> 0.yaml/1.yaml (文件生成)
-        success, message = sync_nodes_to_files() 
+        # 此函数会执行：a) DB -> 本地节点表 (缓存)
+        #              b) 本地节点表 -> 0.yaml/1.yaml (文件生成)
+        # 若有尚未完成的后台重建，则与其合并后等待结果
+        success, message = request_files_sync(wait=True)
         
         # 2. 获取统计数据
         stats = get_stats_data()
+
+        # 上次运行中未完成归属地补全的节点 (例如进程重启)，在这里补发一次
+        if any(n.get(REGION_PENDING_FLAG) for n in node_registry.snapshot()):
+            request_region_enrichment()
         
         # 如果文件同步失败，返回一个警告状态，但仍带上统计信息
         if not success:
@@ -501,11 +574,17 @@ def get_stats_api():
         # 如果发生其他异常（例如 DB 读取错误），则返回错误
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
+@bp.route('/api/parse_cache/stats')
+@login_required
+def parse_cache_stats_api():
+    """API: 链接解析缓存的命中率统计 (用于调整 LINK_PARSE_CACHE_SIZE)"""
+    return jsonify({'status': 'success', 'stats': get_parse_cache_stats()})
+
 @bp.route('/api/sync_files', methods=['POST'])
 @login_required
 def sync_files_api():
     """API: 手动触发同步"""
-    success, message = sync_nodes_to_files()
+    success, message = request_files_sync(wait=True)
     return jsonify({'status': 'success' if success else 'error', 'message': message})
 
 # ---------------------------------------------------------
@@ -517,12 +596,11 @@ def sync_files_api():
 def get_nodes_list_api():
     """
     API: 获取节点列表
-    修改：调用 merge_db_to_local_json 获取统一列表并按 sort_index 排序
+    修改：从节点注册表获取统一列表并按 sort_index 排序
     新增：过滤掉没有协议链接(links为空)的空节点，不在前端显示
     """
     try:
-        all_nodes = merge_db_to_local_json() # 获取最新同步数据
-        all_nodes.sort(key=lambda x: x.get('sort_index', 0)) # 排序
+        all_nodes = sorted(node_registry.snapshot(), key=lambda x: x.get('sort_index', 0)) # 获取最新同步数据并排序
         
         valid_nodes = []
         
@@ -534,7 +612,9 @@ def get_nodes_list_api():
             if not links:
                 continue
 
-            # 补充前端需要的辅助字段
+            # 补充前端需要的辅助字段 (浅拷贝，不修改缓存中的节点)
+            node = dict(node)
+            node.pop(REGION_PENDING_FLAG, None)
             node['is_db'] = (node.get('origin') == 'db')
             node['is_local'] = (node.get('origin') == 'local')
             node['is_sub'] = (node.get('origin') == 'sub')
@@ -551,7 +631,7 @@ def get_nodes_list_api():
 
 
 # ---------------------------------------------------------
-# 从订阅获取节点并保存到 local_nodes.json
+# 从订阅获取节点并保存到本地节点表
 # ---------------------------------------------------------
 @bp.route('/api/local_nodes/fetch_from_sub', methods=['POST'])
 @login_required
@@ -560,7 +640,7 @@ def fetch_from_sub_api():
     API: 从外部订阅下载并解析节点
     1. 保存订阅链接到 DB
     2. 下载并解析内容
-    3. 更新/合并到 local_nodes.json (origin='sub')
+    3. 更新/合并到本地节点表 (origin='sub')
     4. 自动清理订阅中已失效的节点
     """
     try:
@@ -572,63 +652,69 @@ def fetch_from_sub_api():
         # 1. 存入数据库 (记录最后一次使用的订阅)
         set_config('external_sub_url', url, description='节点管理-外部订阅')
 
-        # 2. 下载内容
+        # 2. 下载内容 (流式读取，订阅体积很大时也不会整体载入内存)
+        # 3. 边下载边解析 (不持有节点锁，下载慢时不阻塞其他写请求)
+        # with 保证状态码异常或解析出错时连接也会被关闭
+        items = []
         try:
-            resp = requests.get(url, timeout=15, headers={'User-Agent': 'v2rayN/6.0'})
-            resp.raise_for_status()
-            content = resp.text
-        except Exception as e:
+            with requests.get(url, timeout=15, headers={'User-Agent': 'v2rayN/6.0'}, stream=True) as resp:
+                resp.raise_for_status()
+                items.extend(iter_nodes_from_chunks(resp.iter_content(chunk_size=SUB_STREAM_CHUNK_SIZE)))
+        except requests.RequestException as e:
             return jsonify({'status': 'error', 'message': f'下载失败: {str(e)}'}), 500
+        except ValueError:
+            # base64 尾块非法 (binascii.Error 是 ValueError 的子类)
+            return jsonify({'status': 'error', 'message': '订阅内容为空或无法解析'}), 400
 
-        # 3. 解析内容
-        extracted_nodes = extract_nodes_from_content(content)
-        if not extracted_nodes:
+        if not items:
             return jsonify({'status': 'error', 'message': '订阅内容为空或无法解析'}), 400
 
-        # 4. 读取现有节点
-        local_nodes = load_local_nodes_raw()
-        new_node_names = set()
-        sub_node_map = {n['name']: n for n in local_nodes if n.get('origin') == 'sub'}
+        # 4. 在锁内读取现有节点并逐个合并
+        with node_registry.locked():
+            local_nodes = node_registry.get_nodes()
+            new_node_names = set()
+            sub_node_map = {n['name']: n for n in local_nodes if n.get('origin') == 'sub'}
 
-        count_new = 0
-        count_updated = 0
+            count_new = 0
+            count_updated = 0
 
-        for item in extracted_nodes:
-            name = item['name']
-            proto = item['protocol']
-            link = item['link']
-            
-            new_node_names.add(name) # 标记此节点存在于新订阅中
-            
-            if name in sub_node_map:
-                # 仅更新链接和协议，保留 uuid, routing_type, sort_index
-                target = sub_node_map[name]
-                target.setdefault('links', {})[proto] = link
-                count_updated += 1
-            else:
-                new_node = {
-                    "uuid": str(uuid.uuid4()),
-                    "name": name,
-                    "links": {proto: link},
-                    "routing_type": -1, # 默认作为屏蔽节点，防止订阅轰炸首页
-                    "origin": "sub",   # 核心标志
-                    "is_fixed": False,
-                    "sort_index": 99999
-                }
-                local_nodes.append(new_node)
-                # 更新 map 防止同名重复插入
-                sub_node_map[name] = new_node
-                count_new += 1
+            for item in items:
+                name = item['name']
+                proto = item['protocol']
+                link = item['link']
 
-        initial_count = len(local_nodes)
-        local_nodes = [
-            n for n in local_nodes 
-            if not (n.get('origin') == 'sub' and n['name'] not in new_node_names)
-        ]
-        count_deleted = initial_count - len(local_nodes)
+                new_node_names.add(name) # 标记此节点存在于新订阅中
 
-        save_local_nodes(local_nodes)
-        sync_nodes_to_files()
+                if name in sub_node_map:
+                    # 仅更新链接和协议，保留 uuid, routing_type, sort_index
+                    target = sub_node_map[name]
+                    target.setdefault('links', {})[proto] = link
+                    count_updated += 1
+                else:
+                    new_node = {
+                        "uuid": str(uuid.uuid4()),
+                        "name": name,
+                        "links": {proto: link},
+                        "routing_type": -1, # 默认作为屏蔽节点，防止订阅轰炸首页
+                        "origin": "sub",   # 核心标志
+                        "is_fixed": False,
+                        "sort_index": 99999
+                    }
+                    local_nodes.append(new_node)
+                    # 更新 map 防止同名重复插入
+                    sub_node_map[name] = new_node
+                    count_new += 1
+
+            initial_count = len(local_nodes)
+            local_nodes = [
+                n for n in local_nodes 
+                if not (n.get('origin') == 'sub' and n['name'] not in new_node_names)
+            ]
+            count_deleted = initial_count - len(local_nodes)
+
+            node_registry.save(local_nodes)
+
+        request_files_sync(wait=_wants_wait(data))
 
         msg = f'同步完成：新增 {count_new}，更新 {count_updated}'
         if count_deleted > 0:
@@ -651,38 +737,32 @@ def add_local_node_api():
         name, proto, link = data.get('name'), data.get('protocol'), data.get('link')
         if not all([name, proto, link]): return jsonify({'status': 'error', 'message': '参数不完整'}), 400
         
-        # [新增] 自动查询 IP 归属地 ------------------------------------
-        region_code = ""
-        try:
-            proxy_info = parse_proxy_link(link, "temp", "")
-            if proxy_info and 'server' in proxy_info:
-                region_code = get_ip_region(proxy_info['server'])
-        except: pass
-        # -----------------------------------------------------------
-
-        local_nodes = load_local_nodes_raw()
-        target = next((n for n in local_nodes if n['name'] == name and n.get('origin') != 'db'), None)
-        
-        if target:
-            target.setdefault('links', {})[proto] = link
-            if region_code and not target.get('region'):
-                target['region'] = region_code
-            msg = f"协议 {proto} 已合并到本地节点 {name}"
-        else:
-            local_nodes.append({
-                "uuid": str(uuid.uuid4()),
-                "name": name,
-                "links": {proto: link},
-                "routing_type": 1,
-                "origin": "local",
-                "is_fixed": False,
-                "sort_index": 99999,
-                "region": region_code # [新增]
-            })
-            msg = f"本地节点 {name} 已创建"
-            
-        save_local_nodes(local_nodes)
-        sync_nodes_to_files() # 记得这里要触发同步
+        with node_registry.locked():
+            target = node_registry.find_by_name(name, ('local', 'sub'))
+
+            # 归属地由后台线程查询后回填 (见 enrich_pending_regions)
+            if target:
+                target.setdefault('links', {})[proto] = link
+                if not target.get('region'):
+                    target[REGION_PENDING_FLAG] = True
+                msg = f"协议 {proto} 已合并到本地节点 {name}"
+            else:
+                target = {
+                    "uuid": str(uuid.uuid4()),
+                    "name": name,
+                    "links": {proto: link},
+                    "routing_type": 1,
+                    "origin": "local",
+                    "is_fixed": False,
+                    "sort_index": 99999,
+                    "region": "",
+                    REGION_PENDING_FLAG: True
+                }
+                msg = f"本地节点 {name} 已创建"
+
+            node_registry.save_node(target)
+        request_files_sync(wait=_wants_wait(data)) # 记得这里要触发同步
+        request_region_enrichment()
         return jsonify({'status': 'success', 'message': msg})
     except Exception as e: return jsonify({'status': 'error', 'message': str(e)}), 500
 
@@ -691,7 +771,7 @@ def add_local_node_api():
 def rename_local_node_api():
     """
     API: 重命名节点
-    修改：根据 origin 判断调用 DB 函数还是修改本地 JSON
+    修改：根据 origin 判断调用 DB 函数还是修改本地节点
     """
     try:
         data = request.get_json()
@@ -699,21 +779,21 @@ def rename_local_node_api():
         new_name = data.get('name')
         if not target_uuid or not new_name: return jsonify({'status': 'error', 'message': '参数不完整'}), 400
             
-        local_nodes = load_local_nodes_raw()
-        target_node = next((n for n in local_nodes if n['uuid'] == target_uuid), None)
-        
-        if not target_node: return jsonify({'status': 'error', 'message': '未找到节点'}), 404
-            
-        if target_node.get('origin') == 'db':
-            # DB 节点：调用数据库更新
-            success = update_node_custom_name(target_uuid, new_name)
-            if not success: return jsonify({'status': 'error', 'message': '数据库更新失败'}), 500
-        else:
-            # Local 节点：直接更新 JSON
-            target_node['name'] = new_name
-            save_local_nodes(local_nodes)
+        with node_registry.locked():
+            target_node = node_registry.find(target_uuid)
+
+            if not target_node: return jsonify({'status': 'error', 'message': '未找到节点'}), 404
+
+            if target_node.get('origin') == 'db':
+                # DB 节点：调用数据库更新
+                success = update_node_custom_name(target_uuid, new_name)
+                if not success: return jsonify({'status': 'error', 'message': '数据库更新失败'}), 500
+            else:
+                # Local 节点：直接更新本地节点表
+                target_node['name'] = new_name
+                node_registry.save_node(target_node)
             
-        sync_nodes_to_files() # 重新同步以刷新配置
+        request_files_sync(wait=_wants_wait(data)) # 重新同步以刷新配置
         return jsonify({'status': 'success', 'message': '重命名成功'})
     except Exception as e: return jsonify({'status': 'error', 'message': str(e)}), 500
 
@@ -728,24 +808,23 @@ def update_local_node_links_api():
         # 获取前端传来的禁用列表，默认为空
         disabled_protocols = data.get('disabled_protocols', []) 
 
-        local_nodes = load_local_nodes_raw()
-        node = next((n for n in local_nodes if n['uuid'] == uuid_val), None)
-        
-        if not node: return jsonify({'status': 'error', 'message': '节点不存在'}), 404
-        if node.get('origin') == 'db': return jsonify({'status': 'error', 'message': '数据库节点链接不可在此修改'}), 403
-        
-        cleaned = {k: v for k, v in links.items() if v and v.strip()}
-        if not cleaned:
-            local_nodes.remove(node)
-            msg = '节点已清空并删除'
-        else:
-            node['links'] = cleaned
-            # [新增] 保存禁用列表状态到 JSON
-            node['disabled_protocols'] = disabled_protocols 
-            msg = '链接及状态已更新'
-            
-        save_local_nodes(local_nodes)
-        sync_nodes_to_files()
+        with node_registry.locked():
+            node = node_registry.find(uuid_val)
+
+            if not node: return jsonify({'status': 'error', 'message': '节点不存在'}), 404
+            if node.get('origin') == 'db': return jsonify({'status': 'error', 'message': '数据库节点链接不可在此修改'}), 403
+
+            cleaned = {k: v for k, v in links.items() if v and v.strip()}
+            if not cleaned:
+                node_registry.delete_node(uuid_val)
+                msg = '节点已清空并删除'
+            else:
+                node['links'] = cleaned
+                # [新增] 保存禁用列表状态
+                node['disabled_protocols'] = disabled_protocols 
+                node_registry.save_node(node)
+                msg = '链接及状态已更新'
+        request_files_sync(wait=_wants_wait(data))
         return jsonify({'status': 'success', 'message': msg})
     except Exception as e: return jsonify({'status': 'error', 'message': str(e)}), 500
 
@@ -754,16 +833,16 @@ def update_local_node_links_api():
 def delete_local_node_api():
     """API: 删除节点 (仅限本地节点)"""
     try:
-        uuid_val = request.get_json().get('uuid')
-        local_nodes = load_local_nodes_raw()
-        node = next((n for n in local_nodes if n['uuid'] == uuid_val), None)
-        
-        if not node: return jsonify({'status': 'error', 'message': '节点不存在'}), 404
-        if node.get('origin') == 'db': return jsonify({'status': 'error', 'message': '无法删除数据库同步节点'}), 403
-        
-        local_nodes.remove(node)
-        save_local_nodes(local_nodes)
-        sync_nodes_to_files()
+        data = request.get_json()
+        uuid_val = data.get('uuid')
+        with node_registry.locked():
+            node = node_registry.find(uuid_val)
+
+            if not node: return jsonify({'status': 'error', 'message': '节点不存在'}), 404
+            if node.get('origin') == 'db': return jsonify({'status': 'error', 'message': '无法删除数据库同步节点'}), 403
+
+            node_registry.delete_node(uuid_val)
+        request_files_sync(wait=_wants_wait(data))
         return jsonify({'status': 'success', 'message': '节点已删除'})
     except Exception as e: return jsonify({'status': 'error', 'message': str(e)}), 500
 
@@ -775,20 +854,23 @@ def clear_subscription_nodes_api():
     保留手动添加的 (local) 和数据库同步的 (db) 节点
     """
     try:
-        # 1. 读取当前节点列表
-        local_nodes = load_local_nodes_raw()
-        initial_count = len(local_nodes)
-        
-        # 2. 过滤列表：只保留 origin 不为 'sub' 的节点
-        # 这样会把 'sub' 节点全部剔除，保留 'local' 和 'db'
-        new_nodes = [n for n in local_nodes if n.get('origin') != 'sub']
-        
-        deleted_count = initial_count - len(new_nodes)
-        
-        # 3. 如果有变化，保存并触发同步
+        data = request.get_json(silent=True)
+        with node_registry.locked():
+            # 1. 读取当前节点列表
+            local_nodes = node_registry.get_nodes()
+            initial_count = len(local_nodes)
+
+            # 2. 过滤列表：只保留 origin 不为 'sub' 的节点
+            # 这样会把 'sub' 节点全部剔除，保留 'local' 和 'db'
+            new_nodes = [n for n in local_nodes if n.get('origin') != 'sub']
+
+            deleted_count = initial_count - len(new_nodes)
+            if deleted_count > 0:
+                node_registry.save(new_nodes)
+
+        # 3. 如果有变化，触发同步
         if deleted_count > 0:
-            save_local_nodes(new_nodes)
-            sync_nodes_to_files() # 立即重新生成 yaml，让更改生效
+            request_files_sync(wait=_wants_wait(data)) # 重新生成 yaml，让更改生效
             msg = f'已清除 {deleted_count} 个订阅节点'
         else:
             msg = '没有可清除的订阅节点'
@@ -805,22 +887,24 @@ def delete_local_node_protocol_api():
     try:
         data = request.get_json()
         uuid_val, proto = data.get('uuid'), data.get('protocol')
-        local_nodes = load_local_nodes_raw()
-        node = next((n for n in local_nodes if n['uuid'] == uuid_val), None)
-        
-        if not node: return jsonify({'status': 'error', 'message': '节点不存在'}), 404
-        if node.get('origin') == 'db': return jsonify({'status': 'error', 'message': '无法修改数据库节点'}), 403
-        
-        if 'links' in node and proto in node['links']:
+        with node_registry.locked():
+            node = node_registry.find(uuid_val)
+
+            if not node: return jsonify({'status': 'error', 'message': '节点不存在'}), 404
+            if node.get('origin') == 'db': return jsonify({'status': 'error', 'message': '无法修改数据库节点'}), 403
+            if 'links' not in node or proto not in node['links']:
+                return jsonify({'status': 'error', 'message': '协议不存在'}), 404
+
             del node['links'][proto]
             msg = '协议已删除'
             if not node['links']:
-                local_nodes.remove(node)
+                node_registry.delete_node(uuid_val)
                 msg += '，节点为空已清理'
-            save_local_nodes(local_nodes)
-            sync_nodes_to_files()
-            return jsonify({'status': 'success', 'message': msg})
-        return jsonify({'status': 'error', 'message': '协议不存在'}), 404
+            else:
+                node_registry.save_node(node)
+
+        request_files_sync(wait=_wants_wait(data))
+        return jsonify({'status': 'success', 'message': msg})
     except Exception as e: return jsonify({'status': 'error', 'message': str(e)}), 500
 
 @bp.route('/api/nodes/update_routing', methods=['POST'])
@@ -833,58 +917,214 @@ def update_nodes_routing_api():
     """
     try:
         data = request.get_json()
-        local_nodes = load_local_nodes_raw()
-        node_map = {n['uuid']: n for n in local_nodes}
-        
-        groups = [('direct', 0), ('land', 1), ('blocked', -1)]
-        current_index = 0
-        
-        for group_name, type_code in groups:
-            uuid_list = data.get(group_name, [])
-            for uuid_val in uuid_list:
-                if uuid_val in node_map:
-                    node = node_map[uuid_val]
-                    
-                    # 1. 更新排序索引 (所有节点)
-                    node['sort_index'] = current_index
-                    current_index += 1
-                    
-                    # 2. 更新分组 (路由类型)
-                    old_type = node.get('routing_type', -1)
-                    
-                    # 如果分组发生了变化
-                    if old_type != type_code:
-                        if node.get('origin') == 'db':
-                            # [核心修改] DB 节点：调用数据库函数更新 routing_type
-                            # update_node_details 需要完整信息，我们从 local_nodes 中读取当前的 links 和 name
-                            success = update_node_details(
-                                uuid_val, 
-                                node.get('links', {}), 
-                                type_code, # 新的路由类型
-                                node.get('name') 
-                            )
-                            if success:
-                                node['routing_type'] = type_code
+        with node_registry.locked():
+            local_nodes = node_registry.get_nodes()
+            node_map = {n['uuid']: n for n in local_nodes}
+
+            groups = [('direct', 0), ('land', 1), ('blocked', -1)]
+            current_index = 0
+
+            for group_name, type_code in groups:
+                uuid_list = data.get(group_name, [])
+                for uuid_val in uuid_list:
+                    if uuid_val in node_map:
+                        node = node_map[uuid_val]
+
+                        # 1. 更新排序索引 (所有节点)
+                        node['sort_index'] = current_index
+                        current_index += 1
+
+                        # 2. 更新分组 (路由类型)
+                        old_type = node.get('routing_type', -1)
+
+                        # 如果分组发生了变化
+                        if old_type != type_code:
+                            if node.get('origin') == 'db':
+                                # [核心修改] DB 节点：调用数据库函数更新 routing_type
+                                # update_node_details 需要完整信息，我们从 local_nodes 中读取当前的 links 和 name
+                                success = update_node_details(
+                                    uuid_val, 
+                                    node.get('links', {}), 
+                                    type_code, # 新的路由类型
+                                    node.get('name') 
+                                )
+                                if success:
+                                    node['routing_type'] = type_code
+                                else:
+                                    print(f"Failed to update DB node routing: {uuid_val}")
                             else:
-                                print(f"Failed to update DB node routing: {uuid_val}")
-                        else:
-                            # Local 节点：直接更新 JSON
-                            node['routing_type'] = type_code
-        
-        # 保存 JSON 并生成配置文件
-        save_local_nodes(local_nodes)
-        sync_nodes_to_files()
+                                # Local 节点：直接更新本地节点表
+                                node['routing_type'] = type_code
+
+            # 保存节点 (只写有变化的行) 并请求重建配置文件 (连续拖拽时合并为一次)
+            node_registry.save(local_nodes)
+
+        request_files_sync(wait=_wants_wait(data))
         
         return jsonify({'status': 'success', 'message': '排序与分组已更新 (DB已同步)'})
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
-@bp.route('/base64/all')
-def download_v2ray_base64():
-    """下载 Base64 订阅"""
-    verify_request_token()
-    # 1. 统一从 merged 列表获取所有节点
-    all_nodes = merge_db_to_local_json()
+# ---------------------------------------------------------
+# 批量修改：一次请求完成多项操作，只保存一次、只重建一次配置文件
+# ---------------------------------------------------------
+class BatchOperationError(Exception):
+    """批量操作中某一项校验失败，整批放弃"""
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+def _batch_str(op, key):
+    """取出字符串参数；缺失返回 None，类型不对时整批放弃"""
+    value = op.get(key)
+    if value is not None and not isinstance(value, str):
+        raise BatchOperationError(f'参数 {key} 格式错误')
+    return value
+
+def _batch_str_list(op, key):
+    """取出字符串列表参数；缺失返回空列表，类型不对时整批放弃"""
+    value = op.get(key)
+    if value is None:
+        return []
+    if not isinstance(value, list) or not all(isinstance(v, str) for v in value):
+        raise BatchOperationError(f'参数 {key} 必须是字符串列表')
+    return value
+
+def _batch_get_local(node_map, op, action):
+    """取出可修改的本地节点 (DB 节点不允许 action)"""
+    node = node_map.get(_batch_str(op, 'uuid'))
+    if not node:
+        raise BatchOperationError('节点不存在', 404)
+    if node.get('origin') == 'db':
+        raise BatchOperationError(f'数据库节点不可{action}', 403)
+    return node
+
+def _batch_rename(ctx, op):
+    new_name = (_batch_str(op, 'name') or '').strip()
+    if not new_name:
+        raise BatchOperationError('参数不完整')
+    node = ctx['map'].get(_batch_str(op, 'uuid'))
+    if not node:
+        raise BatchOperationError('节点不存在', 404)
+    if node.get('origin') == 'db':
+        ctx['db_updates'].setdefault(node['uuid'], {})['custom_name'] = new_name
+    node['name'] = new_name
+
+def _batch_delete(ctx, op):
+    node = _batch_get_local(ctx['map'], op, '删除')
+    del ctx['map'][node['uuid']]
+
+def _batch_update_links(ctx, op):
+    node = _batch_get_local(ctx['map'], op, '修改链接')
+    links = op.get('links')
+    if not isinstance(links, dict):
+        raise BatchOperationError('参数不完整')
+    if not all(v is None or isinstance(v, str) for v in links.values()):
+        raise BatchOperationError('参数 links 的链接必须是字符串')
+    disabled_protocols = _batch_str_list(op, 'disabled_protocols')
+    cleaned = {k: v for k, v in links.items() if v and v.strip()}
+    if not cleaned:
+        del ctx['map'][node['uuid']]
+        return
+    node['links'] = cleaned
+    node['disabled_protocols'] = disabled_protocols
+
+def _batch_delete_protocol(ctx, op):
+    node = _batch_get_local(ctx['map'], op, '修改')
+    proto = _batch_str(op, 'protocol')
+    if proto not in node.get('links', {}):
+        raise BatchOperationError('协议不存在', 404)
+    del node['links'][proto]
+    if not node['links']:
+        del ctx['map'][node['uuid']]
+
+def _batch_routing(ctx, op):
+    """与 update_nodes_routing_api 相同：按分组顺序重排 sort_index 并更新分组"""
+    groups = [(_batch_str_list(op, name), type_code) for name, type_code in (('direct', 0), ('land', 1), ('blocked', -1))]
+    current_index = 0
+    for uuids, type_code in groups:
+        for uuid_val in uuids:
+            node = ctx['map'].get(uuid_val)
+            if not node:
+                continue
+            node['sort_index'] = current_index
+            current_index += 1
+            if node.get('routing_type', -1) != type_code:
+                if node.get('origin') == 'db':
+                    ctx['db_updates'].setdefault(uuid_val, {})['routing_type'] = type_code
+                node['routing_type'] = type_code
+
+_BATCH_HANDLERS = {
+    'rename': _batch_rename,
+    'delete': _batch_delete,
+    'update_links': _batch_update_links,
+    'delete_protocol': _batch_delete_protocol,
+    'routing': _batch_routing,
+}
+
+@bp.route('/api/nodes/batch', methods=['POST'])
+@login_required
+def batch_update_nodes_api():
+    """
+    API: 批量修改节点
+    请求体: {"operations": [{"op": "rename", "uuid": ..., "name": ...},
+                            {"op": "delete", "uuid": ...},
+                            {"op": "update_links", "uuid": ..., "links": {...}, "disabled_protocols": [...]},
+                            {"op": "delete_protocol", "uuid": ..., "protocol": ...},
+                            {"op": "routing", "direct": [...], "land": [...], "blocked": [...]}]}
+    按顺序应用到节点列表副本上，任意一项失败则整批不生效；
+    全部成功后 (含 DB 节点的改名/分组) 在一个事务中保存，并只重建一次配置文件。
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        if not isinstance(data, dict):
+            return jsonify({'status': 'error', 'message': '请求体必须是 JSON 对象'}), 400
+        operations = data.get('operations')
+        if not isinstance(operations, list) or not operations:
+            return jsonify({'status': 'error', 'message': '没有要执行的操作'}), 400
+
+        with node_registry.locked():
+            local_nodes = node_registry.get_nodes()
+            # dict 保持插入顺序，删除节点后剩余节点顺序不变
+            ctx = {'map': {n['uuid']: n for n in local_nodes}, 'db_updates': {}}
+
+            for index, op in enumerate(operations):
+                name = op.get('op') if isinstance(op, dict) else None
+                handler = _BATCH_HANDLERS.get(name) if isinstance(name, str) else None
+                try:
+                    if handler is None:
+                        raise BatchOperationError(f'不支持的操作: {name}')
+                    handler(ctx, op)
+                except BatchOperationError as e:
+                    return jsonify({
+                        'status': 'error',
+                        'message': f'第 {index + 1} 项操作 ({name}) 失败: {e}，所有更改均未保存',
+                        'index': index
+                    }), e.status_code
+
+            if not node_registry.save(list(ctx['map'].values()), ctx['db_updates']):
+                return jsonify({'status': 'error', 'message': '保存失败，所有更改均未生效'}), 500
+
+        request_files_sync(wait=_wants_wait(data))
+        return jsonify({'status': 'success', 'message': f'已完成 {len(operations)} 项操作', 'applied': len(operations)})
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+@bp.route('/api/local_nodes/export', methods=['GET'])
+@login_required
+def export_local_nodes_api():
+    """API: 导出全部节点为 JSON (格式与旧版 local_nodes.json 相同，用于备份)"""
+    # 内部的归属地补全标记不导出
+    nodes = [{k: v for k, v in node.items() if k != REGION_PENDING_FLAG} for node in node_registry.get_nodes()]
+    filename = f"local_nodes_{time.strftime('%Y%m%d_%H%M%S')}.json"
+    return Response(
+        json.dumps(nodes, ensure_ascii=False, indent=2),
+        mimetype='application/json',
+        headers={'Content-Disposition': f'attachment; filename={filename}'}
+    )
+
+def _build_v2ray_base64(all_nodes):
+    """根据合并后的节点列表生成 Base64 订阅内容"""
     # 2. 【核心修复】筛选只包含 直连(0) 和 落地(1) 的节点
     # 屏蔽/禁用节点 (routing_type = -1) 将被排除
     nodes_to_include = [
@@ -931,8 +1171,19 @@ def download_v2ray_base64():
                 if '#' in link: link = link.split('#')[0]
                 links.append(f"{link}#{safe_name}")
 
-    b64 = base64.b64encode("\n".join(links).encode('utf-8')).decode('utf-8')
-    return Response(b64, mimetype='text/plain')
+    return base64.b64encode("\n".join(links).encode('utf-8'))
+
+@bp.route('/base64/all')
+def download_v2ray_base64():
+    """
+    下载 Base64 订阅
+    节点集合不变时直接返回内存中的生成结果 (支持 ETag/304)
+    """
+    verify_request_token()
+    # 1. 统一从 merged 列表获取所有节点 (只读快照)
+    generation, all_nodes = node_registry.versioned_snapshot()
+    artifact = artifact_cache.get('base64', generation, lambda: _build_v2ray_base64(all_nodes))
+    return make_artifact_response(artifact, 'text/plain')
 
 @bp.route('/api/callback/add_node', methods=['POST'])
 def add_node_callback():
@@ -941,61 +1192,57 @@ def add_node_callback():
         name, proto, link = data.get('name'), data.get('protocol'), data.get('link')
         if not all([name, proto, link]): return jsonify({'status': 'error', 'message': 'Missing data'}), 400
         
-        # [新增] 自动查询 IP 归属地 ------------------------------------
-        region_code = ""
-        try:
-            # 1. 复用 link_parser 解析出 server 地址
-            # 随便传个名字和region，我们只想要 server 字段
-            proxy_info = parse_proxy_link(link, "temp", "") 
-            if proxy_info and 'server' in proxy_info:
-                server_addr = proxy_info['server']
-                # 2. 查询国家代码
-                region_code = get_ip_region(server_addr)
-                print(f"[Auto Region] {name} ({server_addr}) -> {region_code}")
-        except Exception as e:
-            print(f"[Auto Region Error] {e}")
-        # -----------------------------------------------------------
-
-        local_nodes = load_local_nodes_raw()
-        target = next((n for n in local_nodes if n['name'] == name and n.get('origin') == 'local'), None)
-        
-        if target:
-            target.setdefault('links', {})[proto] = link
-            # [新增] 如果原有节点没地区，就更新进去
-            if region_code and not target.get('region'):
-                target['region'] = region_code
-            msg = f"已合并到节点 {name}"
-        else:
-            local_nodes.append({
-                "uuid": str(uuid.uuid4()),
-                "name": name,
-                "links": {proto: link},
-                "routing_type": 1,
-                "origin": "local",
-                "is_fixed": False,
-                "sort_index": 99999,
-                "region": region_code  # [新增] 保存国家代码
-            })
-            msg = f"自动添加节点 {name}"
-        
-        save_local_nodes(local_nodes)
-        sync_nodes_to_files()
+        # 多个部署脚本可能同时回调，读-改-写必须在锁内完成
+        with node_registry.locked():
+            target = node_registry.find_by_name(name, ('local',))
+
+            # 归属地不在请求线程中查询：先保存节点，由后台线程批量查询后回填
+            if target:
+                target.setdefault('links', {})[proto] = link
+                # 如果原有节点没地区，标记为待补全
+                if not target.get('region'):
+                    target[REGION_PENDING_FLAG] = True
+                msg = f"已合并到节点 {name}"
+            else:
+                target = {
+                    "uuid": str(uuid.uuid4()),
+                    "name": name,
+                    "links": {proto: link},
+                    "routing_type": 1,
+                    "origin": "local",
+                    "is_fixed": False,
+                    "sort_index": 99999,
+                    "region": "",
+                    REGION_PENDING_FLAG: True
+                }
+                msg = f"自动添加节点 {name}"
+
+            node_registry.save_node(target)
+        request_files_sync(wait=_wants_wait(data))
+        request_region_enrichment()
         return jsonify({'status': 'success', 'message': msg})
     except Exception as e: return jsonify({'status': 'error', 'message': str(e)}), 500
 
+def _read_file_bytes(path):
+    with open(path, 'rb') as f: return f.read()
+
 @bp.route('/raw/<int:routing_type>')
 def download_raw_subscription(routing_type):
+    """
+    下载 raw 0/1 YAML
+    文件内容按 (修改时间, 大小) 缓存在内存中，文件未重新生成时直接返回缓存 (支持 ETag/304)
+    """
     verify_request_token()
     filename = '0.yaml' if routing_type == 0 else '1.yaml'
     path = os.path.join(get_nodes_dir(), filename)
-    if not os.path.exists(path): sync_nodes_to_files()
-    content = "proxies: []"
-    if os.path.exists(path):
-        with open(path, 'r', encoding='utf-8') as f: content = f.read()
-    resp = make_response(content)
-    resp.mimetype = "text/yaml; charset=utf-8"
-    resp.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
-    return resp
+    if not os.path.exists(path): request_files_sync(wait=True)
+    
+    try:
+        stat = os.stat(path)
+        artifact = artifact_cache.get(f'raw/{filename}', (stat.st_mtime_ns, stat.st_size), lambda: _read_file_bytes(path))
+    except OSError:
+        artifact = artifact_cache.get(f'raw/{filename}', None, lambda: "proxies: []")
+    return make_artifact_response(artifact, "text/yaml; charset=utf-8")
 
 @bp.route('/list/<list_type>')
 def download_rule_list(list_type):
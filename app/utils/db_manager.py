@@ -1,11 +1,16 @@
 from flask_sqlalchemy import SQLAlchemy
 from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime
+from datetime import datetime, timedelta
 from sqlalchemy import desc, func, case, BigInteger, literal_column, text
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased
 from flask_login import UserMixin
+import hashlib
 import json
 import os
+import threading
+import time
+import uuid as uuid_lib
 
 # =========================================================
 #  第一部分：基础初始化
@@ -57,6 +62,10 @@ class Node(db.Model):
     updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
     # cascade='all, delete-orphan' 确保删除 Node 时自动删除关联的 HistoryData
     history_data = db.relationship('HistoryData', backref='node', lazy='dynamic', cascade='all, delete-orphan')
+    history_daily = db.relationship('HistoryDaily', backref='node', lazy='dynamic', cascade='all, delete-orphan')
+    history_hourly = db.relationship('HistoryHourly', backref='node', lazy='dynamic', cascade='all, delete-orphan')
+    latest_state = db.relationship('NodeLatestState', backref='node', uselist=False, cascade='all, delete-orphan')
+    poll_state = db.relationship('NodePollState', backref='node', uselist=False, cascade='all, delete-orphan')
 
     def get_links_dict(self):
         try:
@@ -74,6 +83,145 @@ class HistoryData(db.Model):
     total_down = db.Column(db.BigInteger)
     cpu_usage = db.Column(db.Float)
 
+class NodeLatestState(db.Model):
+    """
+    每个节点最新一次快照 (每节点一行)，由 bulk_add_history 在同一事务中更新。
+    仪表盘直接读取此表，查询开销只与节点数有关，与历史数据量无关。
+    字段与 HistoryData 保持一致，模板可以直接复用。
+    """
+    __tablename__ = 'node_latest_state'
+    uuid = db.Column(db.String(36), db.ForeignKey('nodes.uuid'), primary_key=True)
+    timestamp = db.Column(db.DateTime)
+    total_up = db.Column(db.BigInteger)
+    total_down = db.Column(db.BigInteger)
+    cpu_usage = db.Column(db.Float)
+
+class NodePollState(db.Model):
+    """
+    每个节点的快照采集调度状态 (每节点一行)，由快照调度任务维护。
+    interval_seconds 随节点流量速率和失败次数自适应调整，next_due_at 到期的节点才会被采集。
+    """
+    __tablename__ = 'node_poll_state'
+    uuid = db.Column(db.String(36), db.ForeignKey('nodes.uuid'), primary_key=True)
+    interval_seconds = db.Column(db.Integer, nullable=False)
+    next_due_at = db.Column(db.DateTime, nullable=False, index=True)
+    last_poll_at = db.Column(db.DateTime)
+    # 最近一次成功采样的时间与计数器 (失败的采集不更新)，用于计算流量速率
+    last_sample_at = db.Column(db.DateTime)
+    last_total = db.Column(db.BigInteger)
+    last_rate = db.Column(db.Float)
+    failures = db.Column(db.Integer, default=0)
+
+class HistoryHourly(db.Model):
+    """
+    按小时汇总的流量增量 (每节点每小时一行)，由 bulk_add_history 增量维护。
+    hour 为该小时的起始时间 (例如 2024-01-01 13:00:00)。
+    """
+    __tablename__ = 'history_hourly'
+    __table_args__ = (db.UniqueConstraint('uuid', 'hour', name='uq_history_hourly_uuid_hour'),)
+    id = db.Column(db.Integer, primary_key=True)
+    uuid = db.Column(db.String(36), db.ForeignKey('nodes.uuid'), nullable=False)
+    hour = db.Column(db.DateTime, nullable=False, index=True)
+    up_bytes = db.Column(db.BigInteger, default=0)
+    down_bytes = db.Column(db.BigInteger, default=0)
+    samples = db.Column(db.Integer, default=0)
+
+class HistoryDaily(db.Model):
+    """
+    按天汇总的流量 (每节点每天一行)，由 bulk_add_history 增量维护。
+    原始快照过期清理前也会检查并补齐这里的汇总，保证长期流量统计不丢失。
+    last_total_up / last_total_down 记录当天最后一个计数器值，用于衔接下一次的增量计算。
+    """
+    __tablename__ = 'history_daily'
+    __table_args__ = (db.UniqueConstraint('uuid', 'day', name='uq_history_daily_uuid_day'),)
+    id = db.Column(db.Integer, primary_key=True)
+    uuid = db.Column(db.String(36), db.ForeignKey('nodes.uuid'), nullable=False)
+    day = db.Column(db.Date, nullable=False, index=True)
+    up_bytes = db.Column(db.BigInteger, default=0)
+    down_bytes = db.Column(db.BigInteger, default=0)
+    samples = db.Column(db.Integer, default=0)
+    last_total_up = db.Column(db.BigInteger)
+    last_total_down = db.Column(db.BigInteger)
+
+class NodeSyncState(db.Model):
+    """
+    Komari 节点列表同步状态 (每节点一行)：记录上次同步时节点信息的内容哈希。
+    bulk_upsert_nodes 据此跳过未变化的节点，只写真正变化的行。
+    """
+    __tablename__ = 'node_sync_state'
+    uuid = db.Column(db.String(36), primary_key=True)
+    content_hash = db.Column(db.String(40), nullable=False)
+    synced_at = db.Column(db.DateTime, default=datetime.now)
+
+class GeoIPCache(db.Model):
+    """
+    主机 (IP 或域名) -> 国家代码 的持久缓存，避免重复调用在线 GeoIP 接口。
+    country_code 为空字符串表示查询失败 (负缓存)，过期时间较短。
+    """
+    __tablename__ = 'geoip_cache'
+    host = db.Column(db.String(255), primary_key=True)
+    country_code = db.Column(db.String(8), nullable=False, default='')
+    updated_at = db.Column(db.DateTime, default=datetime.now)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+class LocalNode(db.Model):
+    """
+    订阅模块的节点列表 (原 local_nodes.json)：手动添加(local)、外部订阅(sub) 以及 DB 节点的镜像(db)。
+    一行一个节点，增删改只写受影响的行。
+    id 自增，用于 sort_index 相同时保持插入顺序 (与旧 JSON 列表的顺序一致)。
+    可选字段为 NULL 时表示旧 JSON 中没有该键；不认识的键原样保存在 extra 中。
+    """
+    __tablename__ = 'local_nodes'
+    __table_args__ = (db.Index('idx_local_node_origin_name', 'origin', 'name'),)
+    id = db.Column(db.Integer, primary_key=True)
+    uuid = db.Column(db.String(36), unique=True, index=True, nullable=False)
+    name = db.Column(db.Text)
+    origin = db.Column(db.String(16), default='local')
+    links = db.Column(db.Text, default='{}')
+    routing_type = db.Column(db.Integer)
+    sort_index = db.Column(db.Integer, index=True)
+    region = db.Column(db.String(32))
+    is_fixed = db.Column(db.Boolean)
+    disabled_protocols = db.Column(db.Text)
+    extra = db.Column(db.Text)
+    updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
+
+    # 与旧 JSON 中的键一一对应的列 (JSON 序列化的列单独处理)
+    PLAIN_FIELDS = ('name', 'origin', 'routing_type', 'sort_index', 'region', 'is_fixed')
+    OPTIONAL_FIELDS = ('routing_type', 'sort_index', 'region', 'is_fixed')
+
+    def to_dict(self):
+        """还原为旧 local_nodes.json 中的节点字典"""
+        node = {
+            'uuid': self.uuid,
+            'name': self.name,
+            'links': json.loads(self.links) if self.links else {},
+            'origin': self.origin,
+        }
+        for key in self.OPTIONAL_FIELDS:
+            value = getattr(self, key)
+            if value is not None:
+                node[key] = value
+        if self.disabled_protocols is not None:
+            node['disabled_protocols'] = json.loads(self.disabled_protocols)
+        if self.extra:
+            node.update(json.loads(self.extra))
+        return node
+
+    def update_from_dict(self, node):
+        """用节点字典更新各列，只有值变化的列才会被赋值"""
+        values = {key: node.get(key) for key in self.PLAIN_FIELDS}
+        values['links'] = json.dumps(node.get('links') or {}, ensure_ascii=False)
+        disabled = node.get('disabled_protocols')
+        values['disabled_protocols'] = json.dumps(disabled, ensure_ascii=False) if disabled is not None else None
+        extra = {k: v for k, v in node.items() if k not in _LOCAL_NODE_KEYS}
+        values['extra'] = json.dumps(extra, ensure_ascii=False, sort_keys=True) if extra else None
+        for key, value in values.items():
+            if getattr(self, key) != value:
+                setattr(self, key, value)
+
+_LOCAL_NODE_KEYS = frozenset(('uuid', 'links', 'disabled_protocols') + LocalNode.PLAIN_FIELDS)
+
 
 # =========================================================
 #  第三部分：全局操作接口 (Operations / DAO)
@@ -81,24 +229,92 @@ class HistoryData(db.Model):
 
 # --- 1. 配置相关操作 ---
 
+# 进程内配置缓存：首次读取时一次性加载全部配置行，之后直接查内存。
+# CONFIG_VERSION 行保存一个版本戳，每次 set_config 都会刷新它；
+# 多进程部署时，其他进程最多每 CONFIG_CACHE_CHECK_SECONDS 秒比对一次版本戳，发现变化即整体重载。
+CONFIG_VERSION_KEY = 'CONFIG_VERSION'
+CONFIG_CACHE_CHECK_SECONDS = 5
+
+_config_caches = {}
+_config_cache_lock = threading.Lock()
+
+def _get_config_cache():
+    """获取当前数据库对应的缓存槽 (按数据库地址区分，避免切换数据库后串用)"""
+    cache_key = str(db.engine.url)
+    cache = _config_caches.get(cache_key)
+    if cache is None:
+        cache = _config_caches.setdefault(cache_key, {'values': None, 'version': None, 'checked_at': 0.0})
+    return cache
+
+def _load_config_values(cache):
+    values = {setting.key: setting.value for setting in AppSetting.query.all()}
+    cache['values'] = values
+    cache['version'] = values.get(CONFIG_VERSION_KEY)
+    cache['checked_at'] = time.monotonic()
+    return values
+
+def _get_cached_configs():
+    """返回缓存中的全部配置 {key: value}，必要时重载或校验版本戳"""
+    cache = _get_config_cache()
+    now = time.monotonic()
+    if cache['values'] is not None and now - cache['checked_at'] < CONFIG_CACHE_CHECK_SECONDS:
+        return cache['values']
+
+    with _config_cache_lock:
+        if cache['values'] is None:
+            return _load_config_values(cache)
+        if now - cache['checked_at'] >= CONFIG_CACHE_CHECK_SECONDS:
+            version_row = db.session.get(AppSetting, CONFIG_VERSION_KEY)
+            version = version_row.value if version_row else None
+            if version != cache['version']:
+                return _load_config_values(cache)
+            cache['checked_at'] = now
+        return cache['values']
+
 def get_config(key, default=None):
     try:
-        setting = AppSetting.query.get(key)
-        return setting.value if setting else default
+        value = _get_cached_configs().get(key)
+        return value if value is not None else default
     except Exception as e:
         print(f"Error reading config {key}: {e}")
         return default
 
+def _stage_config(key, value, description=None):
+    """
+    [内部] 在当前事务中写入配置并刷新版本戳 (不提交)。
+    返回提交成功后需要写入本进程缓存的 {key: value}。
+    """
+    setting = db.session.get(AppSetting, key)
+    if not setting:
+        setting = AppSetting(key=key)
+        db.session.add(setting)
+    setting.value = str(value)
+    if description:
+        setting.description = description
+
+    # 同一事务内刷新版本戳，其他进程据此发现缓存过期
+    version = uuid_lib.uuid4().hex
+    version_row = db.session.get(AppSetting, CONFIG_VERSION_KEY)
+    if not version_row:
+        version_row = AppSetting(key=CONFIG_VERSION_KEY, description='配置版本戳(自动维护)')
+        db.session.add(version_row)
+    version_row.value = version
+
+    return {key: str(value), CONFIG_VERSION_KEY: version}
+
+def _apply_config_cache(changes):
+    """[内部] 事务提交后写穿本进程缓存"""
+    with _config_cache_lock:
+        cache = _get_config_cache()
+        if cache['values'] is not None:
+            cache['values'].update(changes)
+            cache['version'] = changes[CONFIG_VERSION_KEY]
+
 def set_config(key, value, description=None):
     try:
-        setting = AppSetting.query.get(key)
-        if not setting:
-            setting = AppSetting(key=key)
-            db.session.add(setting)
-        setting.value = str(value)
-        if description:
-            setting.description = description
+        changes = _stage_config(key, value, description)
         db.session.commit()
+        _apply_config_cache(changes)
         return True
     except Exception as e:
         db.session.rollback()
@@ -154,62 +370,161 @@ def get_db_file_size():
 
 # --- 2. 节点相关操作 ---
 
-# 找到 upsert_node 函数，替换其中的日期处理逻辑
+# 节点数据版本戳：DB 节点发生变化时刷新，订阅模块的节点缓存据此判断是否需要重载。
+# 版本戳存放在 AppSetting 中，随节点修改在同一事务提交，多进程部署也能感知。
+NODE_DATA_VERSION_KEY = 'NODE_DATA_VERSION'
+
+# Komari 节点列表变化检测：上次成功处理的响应的 ETag / Last-Modified / 内容摘要 (由 komari_api 维护)
+NODE_LIST_ETAG_KEY = 'KOMARI_NODES_ETAG'
+NODE_LIST_LAST_MODIFIED_KEY = 'KOMARI_NODES_LAST_MODIFIED'
+NODE_LIST_DIGEST_KEY = 'KOMARI_NODES_DIGEST'
 
-def upsert_node(node_info):
-    """[写] 更新或插入节点信息 (通常由 Komari 同步任务调用)"""
+def _stage_node_data_version():
+    """[内部] 在当前事务中刷新节点数据版本戳 (不提交)"""
+    return _stage_config(NODE_DATA_VERSION_KEY, uuid_lib.uuid4().hex, '节点数据版本戳(自动维护)')
+
+def get_node_data_version():
+    """[读] 获取当前节点数据版本戳"""
+    return get_config(NODE_DATA_VERSION_KEY, '0')
+
+def _parse_expired_at(expired_at_str, uuid):
+    """
+    解析 Komari 返回的过期时间。
+    修复：防止 invalid date (year -1 / year 0) 导致崩溃，无效或早于 2000 年的日期视为永不过期 (None)
+    """
+    if not expired_at_str:
+        return None
     try:
-        uuid = node_info.get('uuid')
-        node = Node.query.get(uuid)
-        
-        if not node:
-            node = Node(uuid=uuid)
-            db.session.add(node)
-        
-        node.name = node_info.get('name')
-        if 'custom_name' in node_info:
-            node.custom_name = node_info.get('custom_name')
-        elif not node.custom_name:
-            node.custom_name = node_info.get('name')
-            
-        node.region = node_info.get('region')
-        node.traffic_limit = node_info.get('traffic_limit', 0)
-        
-        # ------------------ [CRITICAL FIX START] ------------------
-        # 修复：防止 invalid date (year -1 / year 0) 导致崩溃
-        expired_at_str = node_info.get('expired_at')
-        if expired_at_str:
-            try:
-                # 1. 预处理 ISO 格式
-                if expired_at_str.endswith('Z'):
-                    expired_at_str = expired_at_str[:-1]
-                
-                # 2. 尝试解析
-                dt_obj = datetime.fromisoformat(expired_at_str)
-                
-                # 3. [关键] 安全范围检查
-                # 如果年份小于 2000 (例如 0001-01-01)，视为无效/永不过期
-                if dt_obj.year < 2000:
-                    node.expired_at = None
-                else:
-                    node.expired_at = dt_obj
-                    
-            except (ValueError, OSError) as ve:
-                # 捕获 "year is out of range" 或格式解析错误
-                print(f"Warning: Ignored invalid date '{expired_at_str}' for node {uuid}: {ve}")
-                node.expired_at = None
-        else:
-            node.expired_at = None
-        # ------------------ [CRITICAL FIX END] ------------------
-        
-        node.weight = node_info.get('weight')
-        
+        # 1. 预处理 ISO 格式
+        if expired_at_str.endswith('Z'):
+            expired_at_str = expired_at_str[:-1]
+
+        # 2. 尝试解析
+        dt_obj = datetime.fromisoformat(expired_at_str)
+
+        # 3. [关键] 安全范围检查
+        # 如果年份小于 2000 (例如 0001-01-01)，视为无效/永不过期
+        return None if dt_obj.year < 2000 else dt_obj
+    except (ValueError, OSError) as ve:
+        # 捕获 "year is out of range" 或格式解析错误
+        print(f"Warning: Ignored invalid date '{expired_at_str}' for node {uuid}: {ve}")
+        return None
+
+# 批量 upsert 每条语句的行数：旧版 SQLite 单条语句最多 999 个参数
+BULK_UPSERT_CHUNK_SIZE = 80
+
+def _node_content_hash(node_info):
+    """节点列表同步涉及字段的内容哈希 (与字段顺序无关)"""
+    fields = {key: node_info.get(key) for key in ('name', 'region', 'traffic_limit', 'expired_at', 'weight')}
+    if 'custom_name' in node_info:
+        fields['custom_name'] = node_info.get('custom_name')
+    payload = json.dumps(fields, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+def _native_insert():
+    """返回支持 ON CONFLICT 的 insert 构造函数；当前数据库不支持时返回 None"""
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        return insert
+    if dialect == 'sqlite':
+        import sqlite3
+        # SQLite 3.24 起才支持 ON CONFLICT ... DO UPDATE
+        if sqlite3.sqlite_version_info >= (3, 24, 0):
+            from sqlalchemy.dialects.sqlite import insert
+            return insert
+    return None
+
+def _upsert_rows(model, rows, update_columns):
+    """
+    [内部] 按主键批量 upsert (不提交)。
+    新行写入 rows 中的全部字段，已存在的行只更新 update_columns；
+    数据库支持时使用 ON CONFLICT，否则逐行查询后更新。
+    """
+    if not rows:
+        return
+    pk = [col.name for col in model.__table__.primary_key.columns]
+    insert = _native_insert()
+    if insert is None:
+        for row in rows:
+            obj = db.session.get(model, tuple(row[col] for col in pk))
+            if obj is None:
+                db.session.add(model(**row))
+            else:
+                for col in update_columns:
+                    setattr(obj, col, row[col])
+        return
+    for i in range(0, len(rows), BULK_UPSERT_CHUNK_SIZE):
+        stmt = insert(model.__table__).values(rows[i:i + BULK_UPSERT_CHUNK_SIZE])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=pk,
+            set_={col: stmt.excluded[col] for col in update_columns}
+        )
+        db.session.execute(stmt)
+
+def bulk_upsert_nodes(node_infos):
+    """
+    [写] 批量更新或插入节点信息 (Komari 节点列表同步使用)，整批一个事务。
+    与上次同步的内容哈希 (NodeSyncState) 比对，只写入新增或内容变化的节点；
+    custom_name 规则：传入了 custom_name 则覆盖，否则仅在原本为空时用 name 填充。
+    返回 (节点总数, 实际写入的节点数)，失败返回 None。
+    """
+    try:
+        infos = {}
+        for info in node_infos:
+            if info.get('uuid'):
+                infos[info['uuid']] = info  # 同一 uuid 出现多次时以最后一条为准
+        uuids = list(infos)
+
+        existing, hashes = {}, {}
+        for i in range(0, len(uuids), 500):
+            chunk = uuids[i:i + 500]
+            existing.update(db.session.query(Node.uuid, Node.custom_name).filter(Node.uuid.in_(chunk)).all())
+            hashes.update(db.session.query(NodeSyncState.uuid, NodeSyncState.content_hash)
+                          .filter(NodeSyncState.uuid.in_(chunk)).all())
+
+        now = datetime.now()
+        node_rows, state_rows = [], []
+        for uuid, info in infos.items():
+            content_hash = _node_content_hash(info)
+            custom_name = existing.get(uuid)
+            if uuid in existing and hashes.get(uuid) == content_hash and (custom_name or 'custom_name' in info):
+                continue
+
+            name = info.get('name')
+            if 'custom_name' in info:
+                custom_name = info.get('custom_name')
+            elif not custom_name:
+                custom_name = name
+            node_rows.append({
+                'uuid': uuid,
+                'name': name,
+                'custom_name': custom_name,
+                'region': info.get('region'),
+                'traffic_limit': info.get('traffic_limit', 0),
+                'expired_at': _parse_expired_at(info.get('expired_at'), uuid),
+                'weight': info.get('weight'),
+                # 以下字段仅在插入新节点时生效
+                'links': '{}',
+                'routing_type': 0,
+                'created_at': now,
+                'updated_at': now,
+            })
+            state_rows.append({'uuid': uuid, 'content_hash': content_hash, 'synced_at': now})
+
+        if not node_rows:
+            return len(infos), 0
+
+        _upsert_rows(Node, node_rows, ('name', 'custom_name', 'region', 'traffic_limit', 'expired_at', 'weight', 'updated_at'))
+        _upsert_rows(NodeSyncState, state_rows, ('content_hash', 'synced_at'))
+        changes = _stage_node_data_version()
         db.session.commit()
-        return True
+        _apply_config_cache(changes)
+        return len(infos), len(node_rows)
     except Exception as e:
         db.session.rollback()
-        print(f"Error upserting node: {e}")
-        return False
+        print(f"Error bulk upserting nodes: {e}")
+        return None
 
 def get_total_nodes():
     try:
@@ -229,7 +544,9 @@ def update_node_custom_name(uuid, custom_name):
         node = Node.query.get(uuid)
         if node:
             node.custom_name = custom_name
+            changes = _stage_node_data_version()
             db.session.commit()
+            _apply_config_cache(changes)
             return True
         return False
     except Exception as e:
@@ -242,7 +559,13 @@ def delete_node_by_uuid(uuid):
         node = Node.query.get(uuid)
         if node:
             db.session.delete(node)
+            NodeSyncState.query.filter_by(uuid=uuid).delete(synchronize_session=False)
+            changes = _stage_node_data_version()
+            # 清除节点列表的变化检测信息，下次同步时上游仍存在的节点会被重新写回 (与删除前的行为一致)
+            for key in (NODE_LIST_ETAG_KEY, NODE_LIST_LAST_MODIFIED_KEY, NODE_LIST_DIGEST_KEY):
+                changes.update(_stage_config(key, ''))
             db.session.commit()
+            _apply_config_cache(changes)
             return True
         return False
     except Exception as e:
@@ -250,21 +573,39 @@ def delete_node_by_uuid(uuid):
         print(f"Error deleting node {uuid}: {e}")
         return False
 
+POLL_STATE_FIELDS = ('uuid', 'interval_seconds', 'next_due_at', 'last_poll_at', 'last_sample_at', 'last_total',
+                     'last_rate', 'failures')
+
+def get_node_poll_states():
+    """[读] 所有节点的采集调度状态 {uuid: 状态字典}，尚无状态的节点为 None"""
+    try:
+        rows = db.session.query(Node.uuid, NodePollState).outerjoin(
+            NodePollState, Node.uuid == NodePollState.uuid
+        ).all()
+        return {
+            uuid: ({field: getattr(state, field) for field in POLL_STATE_FIELDS} if state else None)
+            for uuid, state in rows
+        }
+    except Exception as e:
+        print(f"Error fetching node poll states: {e}")
+        return {}
+
+def save_node_poll_states(states):
+    """[写] 批量写入采集调度状态 (一个事务)"""
+    try:
+        rows = [{field: state.get(field) for field in POLL_STATE_FIELDS} for state in states]
+        _upsert_rows(NodePollState, rows, POLL_STATE_FIELDS[1:])
+        db.session.commit()
+        return True
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error saving node poll states: {e}")
+        return False
+
 def get_nodes_with_latest_traffic():
     try:
-        subquery = db.session.query(
-            HistoryData.uuid,
-            func.max(HistoryData.timestamp).label('max_timestamp')
-        ).group_by(HistoryData.uuid).subquery()
-        
-        query = db.session.query(Node, HistoryData).outerjoin(
-            subquery, Node.uuid == subquery.c.uuid
-        ).outerjoin(
-            HistoryData, 
-            db.and_(
-                HistoryData.uuid == subquery.c.uuid, 
-                HistoryData.timestamp == subquery.c.max_timestamp
-            )
+        query = db.session.query(Node, NodeLatestState).outerjoin(
+            NodeLatestState, Node.uuid == NodeLatestState.uuid
         ).order_by(Node.weight.asc())
         
         return query.all()
@@ -280,7 +621,9 @@ def update_node_details(uuid, links_dict, routing_type, custom_name):
             node.routing_type = int(routing_type)
             node.custom_name = custom_name
             
+            changes = _stage_node_data_version()
             db.session.commit()
+            _apply_config_cache(changes)
             return True
         return False
     except Exception as e:
@@ -292,20 +635,9 @@ def get_total_consumed_traffic_summary(top_limit=5):
     try:
         total_nodes = Node.query.count()
 
-        max_time_per_node = db.session.query(
-            HistoryData.uuid,
-            func.max(HistoryData.timestamp).label('max_timestamp')
-        ).group_by(HistoryData.uuid).subquery()
-
         latest_history = db.session.query(
-            HistoryData.uuid,
-            (HistoryData.total_up + HistoryData.total_down).label('total_usage')
-        ).join(
-            max_time_per_node,
-            db.and_(
-                HistoryData.uuid == max_time_per_node.c.uuid,
-                HistoryData.timestamp == max_time_per_node.c.max_timestamp
-            )
+            NodeLatestState.uuid,
+            (NodeLatestState.total_up + NodeLatestState.total_down).label('total_usage')
         ).subquery()
         
         total_consumed_traffic = db.session.query(
@@ -376,6 +708,52 @@ def get_history_by_date(target_date):
         print(f"Error fetching history by date {target_date}: {e}")
         return []
 
+def get_usage_by_node(start_time, end_time):
+    """
+    [读] 一次查询获取所有节点在时间范围内的首/尾计数器，返回 {uuid: (up_bytes, down_bytes)}。
+    先按节点分组取最早/最晚时间戳，再连接回原表取计数器值。
+    首/尾样本都限定在 [start_time, end_time] 内，区间内没有样本的节点用量为 0。
+    语句数量与节点数无关，SQLite / PostgreSQL 通用。
+    """
+    try:
+        bounds = db.session.query(
+            HistoryData.uuid,
+            func.min(HistoryData.timestamp).label('first_ts'),
+            func.max(HistoryData.timestamp).label('last_ts')
+        ).filter(
+            HistoryData.timestamp >= start_time,
+            HistoryData.timestamp <= end_time
+        ).group_by(HistoryData.uuid).subquery()
+
+        first = aliased(HistoryData)
+        last = aliased(HistoryData)
+
+        rows = db.session.query(
+            bounds.c.uuid,
+            first.total_up.label('first_up'),
+            first.total_down.label('first_down'),
+            last.total_up.label('last_up'),
+            last.total_down.label('last_down')
+        ).join(
+            first, db.and_(first.uuid == bounds.c.uuid, first.timestamp == bounds.c.first_ts)
+        ).join(
+            last, db.and_(last.uuid == bounds.c.uuid, last.timestamp == bounds.c.last_ts)
+        ).all()
+
+        usage = {}
+        for row in rows:
+            d_up = (row.last_up or 0) - (row.first_up or 0)
+            d_down = (row.last_down or 0) - (row.first_down or 0)
+            # 处理重启归零
+            if d_up < 0: d_up = row.last_up or 0
+            if d_down < 0: d_down = row.last_down or 0
+            usage[row.uuid] = (d_up, d_down)
+        return usage
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error fetching usage by node: {e}")
+        return {}
+
 def add_history_snapshot(uuid, total_up, total_down, cpu):
     try:
         record = HistoryData(
@@ -391,6 +769,10 @@ def add_history_snapshot(uuid, total_up, total_down, cpu):
         db.session.rollback()
         print(f"Error adding history: {e}")
 
+# 同一进程内串行化快照写入 (定时采集与手动刷新可能同时执行)，
+# 保证汇总增量基于的 "上一次计数器" 不会被另一批次同时读取
+_history_write_lock = threading.Lock()
+
 # 增强版批量写入函数
 def bulk_add_history(records_list):
     """
@@ -398,6 +780,19 @@ def bulk_add_history(records_list):
     功能：
     1. 手动补充 timestamp，解决 bulk_insert 忽略 default 问题。
     2. [PostgreSQL] 自动捕获 Sequence 不同步错误并修复，防止 ID 冲突。
+    3. 原始快照与节点最新状态 (NodeLatestState) 在同一事务中写入。
+    4. 提交后在单独的事务中增量更新小时/天汇总表 (HistoryHourly / HistoryDaily)，
+       汇总失败不会影响原始快照与最新状态的写入。
+    """
+    with _history_write_lock:
+        previous = _insert_history_rows(records_list)
+        if previous is not None:
+            _commit_history_rollups(records_list, previous)
+
+def _insert_history_rows(records_list):
+    """
+    [写] 写入原始快照并更新节点最新状态，一个事务提交。
+    成功返回更新前各节点的计数器 (供汇总表计算增量)，失败返回 None。
     """
     try:
         current_time = datetime.now()
@@ -407,7 +802,9 @@ def bulk_add_history(records_list):
                 record['timestamp'] = current_time
         
         db.session.bulk_insert_mappings(HistoryData, records_list)
+        previous = _update_latest_states(records_list)
         db.session.commit()
+        return previous
     
     except IntegrityError as e:
         # 专门捕获完整性错误 (IntegrityError)
@@ -430,25 +827,532 @@ def bulk_add_history(records_list):
                     print(">>> [DB Fix] 序列已重置，正在重试写入...")
                     # 修复后立即重试一次
                     db.session.bulk_insert_mappings(HistoryData, records_list)
+                    previous = _update_latest_states(records_list)
                     db.session.commit()
                     print(">>> [DB Fix] 重试写入成功！")
-                    return
+                    return previous
             except Exception as fix_e:
                 print(f">>> [DB Fix] 自动修复失败: {fix_e}")
                 # 修复失败则抛出原始异常，避免掩盖问题
         
         print(f"Error bulk adding history (IntegrityError): {e}")
+        return None
 
     except Exception as e:
         db.session.rollback()
         print(f"Error bulk adding history: {e}")
+        return None
+
+def _commit_history_rollups(records_list, previous):
+    """[写] 更新小时/天汇总并提交 (独立事务)"""
+    try:
+        _apply_history_rollups(records_list, previous)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error updating history rollups: {e}")
+
+def _counter_delta(current, previous):
+    """
+    计算两次采样之间的计数器增量。
+    计数器变小说明节点重启归零，此时直接取当前值作为增量。
+    """
+    current = int(current or 0)
+    if previous is None:
+        return 0
+    delta = current - int(previous or 0)
+    return current if delta < 0 else delta
+
+def _hour_bucket(timestamp):
+    """返回时间所在小时的起始时间"""
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+def _update_latest_states(records_list):
+    """
+    [写] 更新 NodeLatestState (不提交，由调用方统一提交)。
+    返回更新前各节点的计数器 {uuid: (total_up, total_down)}，供汇总表计算增量。
+    """
+    uuids = {record['uuid'] for record in records_list}
+    states = {
+        state.uuid: state for state in NodeLatestState.query.filter(NodeLatestState.uuid.in_(uuids))
+    }
+    previous = {uuid: (state.total_up, state.total_down) for uuid, state in states.items()}
+
+    for record in sorted(records_list, key=lambda r: r['timestamp']):
+        state = states.get(record['uuid'])
+        if state is None:
+            state = states[record['uuid']] = NodeLatestState(uuid=record['uuid'])
+            db.session.add(state)
+        state.timestamp = record['timestamp']
+        state.total_up = record.get('total_up')
+        state.total_down = record.get('total_down')
+        state.cpu_usage = record.get('cpu_usage')
+    return previous
+
+def _accumulate_rows(model, key_columns, rows, add_columns, replace_columns=()):
+    """
+    [内部] 按唯一键累加汇总行 (不提交)。
+    add_columns 在数据库端做 "原值 + 增量"，replace_columns 直接覆盖；
+    数据库支持时使用 INSERT ... ON CONFLICT DO UPDATE，并发写入同一行也不会丢失增量或违反唯一约束。
+    """
+    if not rows:
+        return
+    insert = _native_insert()
+    if insert is None:
+        for row in rows:
+            obj = model.query.filter_by(**{col: row[col] for col in key_columns}).first()
+            if obj is None:
+                db.session.add(model(**row))
+                continue
+            for col in add_columns:
+                setattr(obj, col, (getattr(obj, col) or 0) + row[col])
+            for col in replace_columns:
+                setattr(obj, col, row[col])
+        return
+    table = model.__table__
+    for i in range(0, len(rows), BULK_UPSERT_CHUNK_SIZE):
+        stmt = insert(table).values(rows[i:i + BULK_UPSERT_CHUNK_SIZE])
+        set_ = {col: func.coalesce(table.c[col], 0) + stmt.excluded[col] for col in add_columns}
+        set_.update({col: stmt.excluded[col] for col in replace_columns})
+        db.session.execute(stmt.on_conflict_do_update(index_elements=list(key_columns), set_=set_))
+
+def _apply_history_rollups(records_list, previous):
+    """
+    [写] 根据本批次的快照更新 HistoryHourly / HistoryDaily (不提交，由调用方统一提交)。
+    previous 为写入前各节点的计数器 {uuid: (total_up, total_down)}，用于计算增量。
+    增量先在内存中按 (节点, 小时) / (节点, 天) 合并，再以数据库端累加的方式写入。
+    """
+    if not records_list:
+        return
+
+    previous = dict(previous)
+    hourly = {}
+    daily = {}
+
+    for record in sorted(records_list, key=lambda r: r['timestamp']):
+        uuid = record['uuid']
+        total_up = int(record.get('total_up') or 0)
+        total_down = int(record.get('total_down') or 0)
+        prev_up, prev_down = previous.get(uuid, (None, None))
+        delta_up = _counter_delta(total_up, prev_up)
+        delta_down = _counter_delta(total_down, prev_down)
+
+        hour = _hour_bucket(record['timestamp'])
+        row = hourly.setdefault((uuid, hour), {'uuid': uuid, 'hour': hour, 'up_bytes': 0, 'down_bytes': 0, 'samples': 0})
+        row['up_bytes'] += delta_up
+        row['down_bytes'] += delta_down
+        row['samples'] += 1
+
+        day = record['timestamp'].date()
+        row = daily.setdefault((uuid, day), {'uuid': uuid, 'day': day, 'up_bytes': 0, 'down_bytes': 0, 'samples': 0})
+        row['up_bytes'] += delta_up
+        row['down_bytes'] += delta_down
+        row['samples'] += 1
+        row['last_total_up'] = total_up
+        row['last_total_down'] = total_down
+
+        previous[uuid] = (total_up, total_down)
+
+    db.session.flush()
+    _accumulate_rows(HistoryHourly, ('uuid', 'hour'), list(hourly.values()), ('up_bytes', 'down_bytes', 'samples'))
+    _accumulate_rows(HistoryDaily, ('uuid', 'day'), list(daily.values()), ('up_bytes', 'down_bytes', 'samples'),
+                     ('last_total_up', 'last_total_down'))
+
+def _rollup_history_day(day_start, day_end, batch_size=5000):
+    """
+    [写] 将 [day_start, day_end) 区间的原始快照汇总到 HistoryDaily / HistoryHourly。
+    用于旧数据回填以及过期清理前的兜底汇总：
+    - 已存在天汇总行的 (uuid, day) 视为已由 bulk_add_history 维护，不会重复累加。
+    - 前一天的最后计数器从 HistoryDaily 读取，跨天的增量也能被统计。
+    """
+    day = day_start.date()
+    existing = {
+        row.uuid for row in db.session.query(HistoryDaily.uuid).filter(HistoryDaily.day == day)
+    }
+    previous = {
+        row.uuid: (row.last_total_up, row.last_total_down)
+        for row in db.session.query(
+            HistoryDaily.uuid, HistoryDaily.last_total_up, HistoryDaily.last_total_down
+        ).filter(HistoryDaily.day == day - timedelta(days=1))
+    }
+
+    existing_hours = {
+        (row.uuid, row.hour) for row in db.session.query(HistoryHourly.uuid, HistoryHourly.hour).filter(
+            HistoryHourly.hour >= day_start, HistoryHourly.hour < day_end
+        )
+    }
+
+    rollups = {}
+    hourly_rollups = {}
+    rows = db.session.query(
+        HistoryData.uuid, HistoryData.timestamp, HistoryData.total_up, HistoryData.total_down
+    ).filter(
+        HistoryData.timestamp >= day_start,
+        HistoryData.timestamp < day_end
+    ).order_by(HistoryData.uuid, HistoryData.timestamp).yield_per(batch_size)
+
+    for uuid, timestamp, total_up, total_down in rows:
+        if uuid in existing:
+            continue
+        item = rollups.get(uuid)
+        if item is None:
+            prev_up, prev_down = previous.get(uuid, (None, None))
+            item = rollups[uuid] = {
+                'uuid': uuid, 'day': day, 'up_bytes': 0, 'down_bytes': 0, 'samples': 0,
+                'last_total_up': prev_up, 'last_total_down': prev_down
+            }
+        delta_up = _counter_delta(total_up, item['last_total_up'])
+        delta_down = _counter_delta(total_down, item['last_total_down'])
+        item['up_bytes'] += delta_up
+        item['down_bytes'] += delta_down
+        item['samples'] += 1
+        item['last_total_up'] = int(total_up or 0)
+        item['last_total_down'] = int(total_down or 0)
+
+        hour_key = (uuid, _hour_bucket(timestamp))
+        if hour_key in existing_hours:
+            continue
+        hourly = hourly_rollups.get(hour_key)
+        if hourly is None:
+            hourly = hourly_rollups[hour_key] = {
+                'uuid': uuid, 'hour': hour_key[1], 'up_bytes': 0, 'down_bytes': 0, 'samples': 0
+            }
+        hourly['up_bytes'] += delta_up
+        hourly['down_bytes'] += delta_down
+        hourly['samples'] += 1
+
+    if rollups:
+        db.session.bulk_insert_mappings(HistoryDaily, list(rollups.values()))
+    if hourly_rollups:
+        db.session.bulk_insert_mappings(HistoryHourly, list(hourly_rollups.values()))
+    db.session.commit()
+    return len(rollups)
+
+def backfill_history_rollups(batch_size=5000):
+    """
+    [写] 用已有的原始快照回填小时/天汇总表 (升级后首次启动时执行一次)。
+    必须在快照任务启动前调用，避免与 bulk_add_history 的增量维护交叉。
+    返回回填的 (节点, 天) 数量；失败时回滚并抛出异常，由调用方决定是否下次重试。
+    """
+    try:
+        oldest = db.session.query(func.min(HistoryData.timestamp)).scalar()
+        if oldest is None:
+            return 0
+
+        filled = 0
+        day_start = datetime.combine(oldest.date(), datetime.min.time())
+        end = datetime.now() + timedelta(days=1)
+        while day_start < end:
+            day_end = day_start + timedelta(days=1)
+            filled += _rollup_history_day(day_start, day_end, batch_size)
+            day_start = day_end
+        return filled
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error backfilling history rollups: {e}")
+        raise
+
+def prune_history_data(retention_days, batch_size=5000, rollup=True):
+    """
+    [写] 清理超过保留天数的原始快照数据，返回删除的行数。
+    1. 按天从最旧的数据开始处理，可选地先汇总到 HistoryDaily (长期流量不丢失)。
+    2. 每次最多删除 batch_size 行并立即提交，避免长时间持有数据库锁 (SQLite 尤其明显)。
+    """
+    if retention_days is None or retention_days <= 0:
+        return 0
+
+    cutoff = datetime.combine((datetime.now() - timedelta(days=retention_days)).date(), datetime.min.time())
+    removed = 0
+
+    try:
+        while True:
+            oldest = db.session.query(func.min(HistoryData.timestamp)).filter(
+                HistoryData.timestamp < cutoff
+            ).scalar()
+            if oldest is None:
+                break
+
+            day_start = datetime.combine(oldest.date(), datetime.min.time())
+            day_end = min(day_start + timedelta(days=1), cutoff)
+
+            if rollup:
+                _rollup_history_day(day_start, day_end, batch_size)
+
+            while True:
+                # 只取本批最后一行的 id，按范围删除，避免把上千个 id 拼进 IN (...) 参数列表
+                boundary = db.session.query(HistoryData.id).filter(
+                    HistoryData.timestamp >= day_start,
+                    HistoryData.timestamp < day_end
+                ).order_by(HistoryData.id).offset(max(batch_size, 1) - 1).limit(1).scalar()
+                query = HistoryData.query.filter(
+                    HistoryData.timestamp >= day_start,
+                    HistoryData.timestamp < day_end
+                )
+                if boundary is not None:
+                    query = query.filter(HistoryData.id <= boundary)
+                removed += query.delete(synchronize_session=False)
+                db.session.commit()
+                if boundary is None:
+                    # 当天剩余不足一批，已全部删除
+                    break
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error pruning history data: {e}")
+
+    return removed
+
+def backfill_latest_states():
+    """
+    [写] 用历史快照初始化 NodeLatestState (升级后首次启动时执行一次)。
+    仅在该表为空时执行，返回写入的节点数。
+    """
+    try:
+        if db.session.query(NodeLatestState.uuid).first() is not None:
+            return 0
+
+        max_time_per_node = db.session.query(
+            HistoryData.uuid,
+            func.max(HistoryData.timestamp).label('max_timestamp')
+        ).group_by(HistoryData.uuid).subquery()
+
+        rows = db.session.query(HistoryData).join(
+            max_time_per_node,
+            db.and_(
+                HistoryData.uuid == max_time_per_node.c.uuid,
+                HistoryData.timestamp == max_time_per_node.c.max_timestamp
+            )
+        ).all()
+
+        states = {
+            row.uuid: {
+                'uuid': row.uuid,
+                'timestamp': row.timestamp,
+                'total_up': row.total_up,
+                'total_down': row.total_down,
+                'cpu_usage': row.cpu_usage
+            }
+            for row in rows
+        }
+        if states:
+            db.session.bulk_insert_mappings(NodeLatestState, list(states.values()))
+        db.session.commit()
+        return len(states)
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error backfilling latest node states: {e}")
+        return 0
+
+def prune_hourly_rollups(retention_days):
+    """
+    [写] 删除超过保留天数的小时汇总，天汇总永久保留。返回删除的行数。
+    """
+    if retention_days is None or retention_days <= 0:
+        return 0
+    try:
+        cutoff = datetime.combine((datetime.now() - timedelta(days=retention_days)).date(), datetime.min.time())
+        removed = HistoryHourly.query.filter(HistoryHourly.hour < cutoff).delete(synchronize_session=False)
+        db.session.commit()
+        return removed
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error pruning hourly rollups: {e}")
+        return 0
+
+def get_hourly_traffic(uuid, start_time, end_time):
+    """[读] 获取节点在时间范围内的小时流量汇总 (按小时升序)"""
+    try:
+        return HistoryHourly.query.filter(
+            HistoryHourly.uuid == uuid,
+            HistoryHourly.hour >= start_time,
+            HistoryHourly.hour <= end_time
+        ).order_by(HistoryHourly.hour.asc()).all()
+    except Exception as e:
+        print(f"Error fetching hourly traffic for node {uuid}: {e}")
+        return []
 
 def get_latest_history(uuid, limit=10):
     return HistoryData.query.filter_by(uuid=uuid)\
         .order_by(desc(HistoryData.timestamp))\
         .limit(limit).all()
 
-# --- 4. 用户相关操作 ---
+# --- 4. GeoIP 缓存相关操作 ---
+
+def get_geoip_cache(host):
+    """查询未过期的 GeoIP 缓存，返回 (country_code, expires_at)；无记录或已过期返回 None"""
+    try:
+        row = db.session.get(GeoIPCache, host)
+        if row is None or row.expires_at <= datetime.now():
+            return None
+        return row.country_code, row.expires_at
+    except Exception as e:
+        print(f"Error reading geoip cache: {e}")
+        return None
+
+def save_geoip_cache(host, country_code, ttl_seconds):
+    """写入 (或覆盖) GeoIP 缓存，返回过期时间"""
+    now = datetime.now()
+    expires_at = now + timedelta(seconds=ttl_seconds)
+    try:
+        row = db.session.get(GeoIPCache, host)
+        if row is None:
+            row = GeoIPCache(host=host)
+            db.session.add(row)
+        row.country_code = country_code or ''
+        row.updated_at = now
+        row.expires_at = expires_at
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error saving geoip cache: {e}")
+    return expires_at
+
+def prune_geoip_cache():
+    """删除已过期的 GeoIP 缓存，返回删除行数"""
+    try:
+        deleted = GeoIPCache.query.filter(GeoIPCache.expires_at <= datetime.now()).delete(synchronize_session=False)
+        db.session.commit()
+        return deleted
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error pruning geoip cache: {e}")
+        return 0
+
+# --- 5. 本地节点相关操作 ---
+
+# 本地节点版本戳：local_nodes 表发生变化时刷新，订阅模块的节点缓存据此判断是否需要重载
+LOCAL_NODE_VERSION_KEY = 'LOCAL_NODE_VERSION'
+
+def _stage_local_node_version():
+    """[内部] 在当前事务中刷新本地节点版本戳 (不提交)"""
+    return _stage_config(LOCAL_NODE_VERSION_KEY, uuid_lib.uuid4().hex, '本地节点版本戳(自动维护)')
+
+def get_local_node_version(fresh=False):
+    """
+    [读] 获取本地节点版本戳。
+    fresh=True 时绕过进程内配置缓存直接查库 (读-改-写之前使用，保证看到其他进程的修改)
+    """
+    if not fresh:
+        return get_config(LOCAL_NODE_VERSION_KEY, '0')
+    try:
+        value = db.session.scalar(db.select(AppSetting.value).where(AppSetting.key == LOCAL_NODE_VERSION_KEY))
+        return value if value is not None else '0'
+    except Exception as e:
+        print(f"Error reading local node version: {e}")
+        return get_config(LOCAL_NODE_VERSION_KEY, '0')
+
+def _local_node_order():
+    return func.coalesce(LocalNode.sort_index, 9999), LocalNode.id
+
+def get_all_local_nodes():
+    """[读] 全部本地节点 (字典列表)，按 sort_index 排序"""
+    try:
+        return [row.to_dict() for row in LocalNode.query.order_by(*_local_node_order()).all()]
+    except Exception as e:
+        print(f"Error loading local nodes: {e}")
+        return []
+
+def get_local_node(uuid):
+    """[读] 按 uuid 查找本地节点，返回字典或 None"""
+    row = LocalNode.query.filter_by(uuid=uuid).first()
+    return row.to_dict() if row else None
+
+def find_local_node_by_name(name, origins):
+    """[读] 按 (origin, name) 查找节点，origins 为允许的来源列表；有多个时返回排序靠前的一个"""
+    row = LocalNode.query.filter(LocalNode.origin.in_(list(origins)), LocalNode.name == name)\
+        .order_by(*_local_node_order()).first()
+    return row.to_dict() if row else None
+
+def _commit_local_nodes(changed):
+    """[内部] 有变化时刷新版本戳并提交"""
+    changes = _stage_local_node_version() if changed else None
+    db.session.commit()
+    if changes:
+        _apply_config_cache(changes)
+
+def upsert_local_nodes(nodes):
+    """[写] 插入或更新若干节点 (不影响其他节点)，只写内容有变化的行"""
+    try:
+        uuids = [n['uuid'] for n in nodes]
+        rows = {r.uuid: r for r in LocalNode.query.filter(LocalNode.uuid.in_(uuids)).all()} if uuids else {}
+        changed = False
+        for node in nodes:
+            row = rows.get(node['uuid'])
+            if row is None:
+                row = LocalNode(uuid=node['uuid'])
+                db.session.add(row)
+                rows[node['uuid']] = row
+            row.update_from_dict(node)
+            changed = changed or row in db.session.new or db.session.is_modified(row)
+        _commit_local_nodes(changed)
+        return True
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error saving local nodes: {e}")
+        return False
+
+def delete_local_nodes(uuids):
+    """[写] 按 uuid 删除节点，返回删除行数，失败返回 None"""
+    try:
+        uuids = list(uuids)
+        deleted = LocalNode.query.filter(LocalNode.uuid.in_(uuids)).delete(synchronize_session=False) if uuids else 0
+        _commit_local_nodes(deleted > 0)
+        return deleted
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error deleting local nodes: {e}")
+        return None
+
+def replace_local_nodes(nodes, db_node_updates=None):
+    """
+    [写] 用完整节点列表替换表内容 (同一事务)。
+    与现有行逐个比对：只插入新增、更新变化、删除列表中已不存在的节点。
+    db_node_updates: 可选 {uuid: {'custom_name': ..., 'routing_type': ...}}，
+    对 DB 节点 (nodes 表) 的修改在同一事务中提交，任意一步失败则全部回滚。
+    """
+    try:
+        node_changes = None
+        for uuid, fields in (db_node_updates or {}).items():
+            node = db.session.get(Node, uuid)
+            if node is None:
+                raise ValueError(f"DB 节点不存在: {uuid}")
+            if 'custom_name' in fields:
+                node.custom_name = fields['custom_name']
+            if 'routing_type' in fields:
+                node.routing_type = int(fields['routing_type'])
+            if node_changes is None and db.session.is_modified(node):
+                node_changes = _stage_node_data_version()
+
+        rows = {r.uuid: r for r in LocalNode.query.all()}
+        changed = False
+        seen = set()
+        for node in nodes:
+            uuid = node['uuid']
+            if uuid in seen:
+                continue
+            seen.add(uuid)
+            row = rows.get(uuid)
+            if row is None:
+                row = LocalNode(uuid=uuid)
+                db.session.add(row)
+            row.update_from_dict(node)
+            changed = changed or row in db.session.new or db.session.is_modified(row)
+        for uuid, row in rows.items():
+            if uuid not in seen:
+                db.session.delete(row)
+                changed = True
+        local_changes = _stage_local_node_version() if changed else None
+        db.session.commit()
+        # 按暂存顺序应用，最后一次暂存的配置版本戳才是库中的值
+        for changes in (node_changes, local_changes):
+            if changes:
+                _apply_config_cache(changes)
+        return True
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error saving local nodes: {e}")
+        return False
+
+# --- 6. 用户相关操作 ---
 
 def get_user_by_username(username):
     try:
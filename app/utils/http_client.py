@@ -0,0 +1,72 @@
+# 文件路径：./app/utils/http_client.py
+
+import random
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# 共享的 HTTP 会话 (按用途区分的进程级单例，例如节点列表同步 / 快照采集)
+# requests.Session 内部的连接池是线程安全的，可被快照线程池中的多个线程同时复用。
+# 同一个 Komari 主机的请求会复用 keep-alive 连接，避免每个节点都重新握手 (TCP/TLS)。
+_sessions = {}
+_session_lock = threading.Lock()
+
+# 需要重试的 HTTP 状态码 (限流 / 网关类错误)
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class JitteredRetry(Retry):
+    """
+    带随机抖动的指数退避重试策略。
+    urllib3 2.x 原生支持 backoff_jitter，这里为 1.x 手动补上抖动，
+    防止大量并发请求在同一时刻集中重试。
+    """
+    JITTER_SECONDS = 0.3
+
+    def get_backoff_time(self):
+        backoff = super().get_backoff_time()
+        if backoff <= 0:
+            return backoff
+        return backoff + random.uniform(0, self.JITTER_SECONDS)
+
+
+def _build_session(pool_size, retries, backoff_factor):
+    retry = JitteredRetry(
+        total=retries,
+        connect=retries,
+        read=retries,
+        status=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=RETRY_STATUS_CODES,
+        allowed_methods=frozenset(['GET', 'HEAD']),
+        # 重试耗尽后返回最后一次响应，由调用方 raise_for_status 统一处理
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry, pool_block=False)
+
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers.update({
+        'Accept-Encoding': 'gzip, deflate',
+        'Connection': 'keep-alive',
+    })
+    return session
+
+
+def get_http_session(pool_size=32, retries=2, backoff_factor=0.3, name='default'):
+    """
+    获取共享的 HTTP 会话，name 区分不同用途的会话。
+    有严格时限的调用 (如单节点快照) 应使用 retries=0 的独立会话，否则一次慢请求会占用数倍的超时时间。
+    连接池大小 / 重试次数变化时 (例如在设置页修改了配置) 会自动重建会话；
+    旧会话可能仍被其他线程使用，不主动关闭，由垃圾回收释放连接池。
+    """
+    options = (int(pool_size), int(retries), float(backoff_factor))
+
+    with _session_lock:
+        current = _sessions.get(name)
+        if current is None or current[0] != options:
+            current = _sessions[name] = (options, _build_session(*options))
+        return current[1]
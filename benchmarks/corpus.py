@@ -0,0 +1,168 @@
+# corpus.py
+# 确定性的节点链接语料生成器：相同 seed 总是生成完全相同的链接，便于不同版本之间对比
+#
+# 覆盖 link_parser 支持的全部协议，并刻意包含容易出错的写法：
+# - IPv6 (带方括号 / 不带方括号)、域名、IPv4
+# - VLESS/Trojan Reality 参数、ws / grpc / h2 / http 传输
+# - Base64 的各种 padding：标准、去掉 '='、URL Safe 字符
+
+import base64
+import json
+import random
+import urllib.parse
+
+PROTOCOLS = ('vless', 'vmess', 'trojan', 'hy2', 'hysteria2', 'tuic', 'ss', 'socks5')
+
+_TLDS = ('com', 'net', 'org', 'io', 'dev')
+_REGIONS = ('香港', '日本', '新加坡', 'US', 'DE', '台湾')
+
+
+class CorpusGenerator:
+    """按协议生成链接；所有随机性都来自 seed 初始化的 random.Random"""
+
+    def __init__(self, seed=20240501):
+        self.rng = random.Random(seed)
+
+    # ---------------------------------------------------------
+    # 基础字段
+    # ---------------------------------------------------------
+    def uuid(self):
+        h = '%032x' % self.rng.getrandbits(128)
+        return f"{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}"
+
+    def token(self, length=12):
+        return ''.join(self.rng.choice('abcdefghijkmnpqrstuvwxyzABCDEFGHJKLMNPQRSTUVWXYZ23456789') for _ in range(length))
+
+    def domain(self):
+        return f"{self.token(6).lower()}.{self.rng.choice(_TLDS)}"
+
+    def ipv4(self):
+        return '.'.join(str(self.rng.randint(1, 254)) for _ in range(4))
+
+    def ipv6(self):
+        groups = ['%x' % self.rng.getrandbits(16) for _ in range(6)]
+        if self.rng.random() < 0.5:
+            return '2001:db8:' + ':'.join(groups)  # 完整 8 段
+        return '2001:db8::' + ':'.join(groups[:self.rng.randint(1, 4)])  # 压缩写法
+
+    def host_port(self, port=None):
+        """返回 URL 中的 host:port 部分，包含带括号和不带括号的 IPv6"""
+        port = port or self.rng.choice((443, 8443, 2053, self.rng.randint(10000, 60000)))
+        kind = self.rng.random()
+        if kind < 0.4:
+            return f"{self.domain()}:{port}"
+        if kind < 0.7:
+            return f"{self.ipv4()}:{port}"
+        if kind < 0.9:
+            return f"[{self.ipv6()}]:{port}"
+        return f"{self.ipv6()}:{port}"  # 不规范的无括号 IPv6
+
+    def name(self):
+        raw = f"{self.rng.choice(_REGIONS)}-{self.token(4)} {self.rng.randint(1, 99):02d}"
+        return urllib.parse.quote(raw)
+
+    def b64(self, data):
+        """随机选择 padding 风格的 Base64 编码"""
+        style = self.rng.random()
+        if style < 0.4:
+            return base64.b64encode(data).decode('ascii')
+        if style < 0.7:
+            return base64.b64encode(data).decode('ascii').rstrip('=')
+        return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+    def transport_params(self, networks=('tcp', 'ws', 'grpc', 'h2', 'http')):
+        network = self.rng.choice(networks)
+        params = {'type': network}
+        if network in ('ws', 'h2', 'http'):
+            params['path'] = '/' + self.token(6)
+            params['host'] = self.domain()
+        elif network == 'grpc':
+            params['serviceName'] = self.token(8)
+        return params
+
+    # ---------------------------------------------------------
+    # 各协议
+    # ---------------------------------------------------------
+    def vless(self):
+        params = self.transport_params()
+        security = self.rng.choice(('none', 'tls', 'reality', 'reality'))
+        params['security'] = security
+        params['sni'] = self.domain()
+        if security == 'reality':
+            params.update(pbk=self.b64(self.rng.randbytes(32)), sid='%08x' % self.rng.getrandbits(32), fp='chrome')
+            params['flow'] = 'xtls-rprx-vision'
+        elif security == 'tls':
+            params['alpn'] = 'h2,http/1.1'
+            params['fp'] = self.rng.choice(('chrome', 'firefox', 'safari'))
+        return f"vless://{self.uuid()}@{self.host_port()}?{urllib.parse.urlencode(params)}#{self.name()}"
+
+    def vmess(self):
+        net = self.rng.choice(('tcp', 'ws', 'grpc', 'h2', 'http'))
+        host = self.rng.choice((self.domain(), self.ipv4(), self.ipv6()))
+        data = {
+            "v": "2", "ps": urllib.parse.unquote(self.name()), "add": host, "port": str(self.rng.choice((443, 80, 8080))),
+            "id": self.uuid(), "aid": "0", "scy": "auto", "net": net, "type": "none",
+            "host": self.domain(), "path": '/' + self.token(5), "tls": self.rng.choice(('tls', '', 'none')), "sni": self.domain(),
+        }
+        return 'vmess://' + self.b64(json.dumps(data, ensure_ascii=False).encode('utf-8'))
+
+    def trojan(self):
+        params = self.transport_params(('tcp', 'ws', 'grpc'))
+        params['security'] = self.rng.choice(('tls', 'tls', 'reality'))
+        params['sni'] = self.domain()
+        if params['security'] == 'reality':
+            params.update(pbk=self.b64(self.rng.randbytes(32)), sid='%04x' % self.rng.getrandbits(16))
+        if self.rng.random() < 0.3:
+            params['allowInsecure'] = '1'
+        password = urllib.parse.quote(self.token(10) + '@#')
+        return f"trojan://{password}@{self.host_port()}?{urllib.parse.urlencode(params)}#{self.name()}"
+
+    def hy2(self, scheme='hy2'):
+        params = {'sni': self.domain(), 'insecure': self.rng.choice(('0', '1'))}
+        if self.rng.random() < 0.5:
+            params.update({'obfs': 'salamander', 'obfs-password': self.token(8)})
+        if self.rng.random() < 0.3:
+            params.update(ports='20000-30000', **{'hop-interval': '30'})
+        if self.rng.random() < 0.5:
+            params.update(up=str(self.rng.randint(10, 100)), down=str(self.rng.randint(100, 1000)))
+        return f"{scheme}://{self.token(16)}@{self.host_port()}?{urllib.parse.urlencode(params)}#{self.name()}"
+
+    def hysteria2(self):
+        return self.hy2('hysteria2')
+
+    def tuic(self):
+        params = {'congestion_controller': self.rng.choice(('bbr', 'cubic')), 'alpn': 'h3', 'sni': self.domain(),
+                  'udp-relay-mode': self.rng.choice(('native', 'quic'))}
+        return f"tuic://{self.uuid()}:{self.token(10)}@{self.host_port()}?{urllib.parse.urlencode(params)}#{self.name()}"
+
+    def ss(self):
+        method = self.rng.choice(('aes-128-gcm', 'chacha20-ietf-poly1305', '2022-blake3-aes-128-gcm'))
+        userinfo = f"{method}:{self.token(16)}".encode('utf-8')
+        if self.rng.random() < 0.3:
+            # 旧格式：整段 method:password@host:port 都经过 Base64
+            return f"ss://{self.b64(userinfo + b'@' + self.host_port().encode('utf-8'))}#{self.name()}"
+        link = f"ss://{self.b64(userinfo)}@{self.host_port()}"
+        if self.rng.random() < 0.3:
+            link += '?' + urllib.parse.urlencode({'plugin': 'obfs-local', 'plugin_opts': 'obfs=http;obfs-host=' + self.domain()})
+        return f"{link}#{self.name()}"
+
+    def socks5(self):
+        auth = f"{self.token(6)}:{urllib.parse.quote(self.token(8) + ':')}@" if self.rng.random() < 0.7 else ''
+        query = '?tls=1' if self.rng.random() < 0.3 else ''
+        return f"socks5://{auth}{self.host_port(1080)}{query}#{self.name()}"
+
+    # ---------------------------------------------------------
+    # 语料
+    # ---------------------------------------------------------
+    def links(self, count, protocols=PROTOCOLS):
+        """按协议轮流生成 count 条链接"""
+        return [getattr(self, protocols[i % len(protocols)])() for i in range(count)]
+
+    def subscription(self, links, encoded=True):
+        """把链接拼成订阅正文；encoded=True 时整体 Base64 (随机 padding 风格)"""
+        text = '\n'.join(links)
+        return self.b64(text.encode('utf-8')) if encoded else text
+
+
+def generate_links(count, seed=20240501, protocols=PROTOCOLS):
+    return CorpusGenerator(seed).links(count, protocols)
@@ -0,0 +1,153 @@
+# link_parser_bench.py
+# link_parser 基准测试：使用确定性语料测量吞吐量 (链接/秒) 与峰值内存，结果输出为 JSON 便于跨版本对比
+#
+# 用法 (在仓库根目录执行)：
+#   python benchmarks/link_parser_bench.py -o before.json --baseline HEAD~1   # 测某个 git 版本
+#   python benchmarks/link_parser_bench.py -o after.json                      # 测当前工作区
+#   python benchmarks/link_parser_bench.py --compare before.json              # 与已保存的结果对比
+#
+# 测试项：
+#   parse_proxy_link         不经过缓存的解析 (解析器本身的开销)
+#   parse_proxy_link_cached  全部命中缓存时的开销 (仅当前版本有缓存时)
+#   fix_link_ipv6            链接 IPv6 标准化
+#   extract_nodes_base64     从 Base64 订阅正文提取节点
+#   extract_nodes_plain      从明文订阅正文提取节点
+#   extract_nodes_stream     流式提取 Base64 订阅 (仅当前版本支持时)
+
+import argparse
+import contextlib
+import io
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+from corpus import CorpusGenerator, PROTOCOLS
+from parser_dispatch import load_parser_from_file, load_parser_from_git, uncached_parser
+
+DEFAULT_SIZE = 5000
+DEFAULT_SEED = 20240501
+
+
+def _best_of(func, repeat):
+    """运行 repeat 次，返回最短耗时 (秒)"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def _peak_kb(func):
+    """单独运行一次并用 tracemalloc 统计峰值内存 (KB)"""
+    tracemalloc.start()
+    try:
+        func()
+        return round(tracemalloc.get_traced_memory()[1] / 1024, 1)
+    finally:
+        tracemalloc.stop()
+
+
+def build_cases(module, links, sub_base64, sub_plain):
+    parse = uncached_parser(module)
+    cases = {
+        'parse_proxy_link': (len(links), lambda: [parse(link, 'bench', 'US') for link in links]),
+        'fix_link_ipv6': (len(links), lambda: [module.fix_link_ipv6(link) for link in links]),
+        'extract_nodes_base64': (len(links), lambda: module.extract_nodes_from_content(sub_base64)),
+        'extract_nodes_plain': (len(links), lambda: module.extract_nodes_from_content(sub_plain)),
+    }
+    if hasattr(module, 'iter_nodes_from_chunks'):
+        raw = sub_base64.encode('ascii')
+        chunks = [raw[i:i + 65536] for i in range(0, len(raw), 65536)]
+        cases['extract_nodes_stream'] = (len(links), lambda: sum(1 for _ in module.iter_nodes_from_chunks(chunks)))
+    if hasattr(module, '_parse_proxy_link_uncached'):
+        module.configure_parse_cache(len(links) * 2)
+        cached = lambda: [module.parse_proxy_link(link, 'bench', 'US') for link in links]
+        cached()  # 预热，之后全部命中
+        cases['parse_proxy_link_cached'] = (len(links), cached)
+    return cases
+
+
+def run(module, size=DEFAULT_SIZE, seed=DEFAULT_SEED, repeat=3):
+    gen = CorpusGenerator(seed)
+    links = gen.links(size)
+    sub_base64 = gen.subscription(links, encoded=True)
+    sub_plain = gen.subscription(links, encoded=False)
+
+    results = {}
+    # 解析失败时解析器会 print 错误，基准测试中屏蔽这些输出
+    with contextlib.redirect_stdout(io.StringIO()):
+        parsed_ok = sum(1 for link in links if uncached_parser(module)(link, 'bench', 'US'))
+        for name, (count, func) in build_cases(module, links, sub_base64, sub_plain).items():
+            seconds = _best_of(func, repeat)
+            results[name] = {
+                'items': count,
+                'seconds': round(seconds, 4),
+                'links_per_sec': round(count / seconds, 1) if seconds else None,
+                'peak_kb': _peak_kb(func),
+            }
+
+    return {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'size': size,
+            'seed': seed,
+            'repeat': repeat,
+            'protocols': list(PROTOCOLS),
+            'parsed_ok': parsed_ok,
+            'subscription_bytes': len(sub_base64),
+        },
+        'results': results,
+    }
+
+
+def compare(current, previous):
+    """打印两次结果的吞吐量与内存变化"""
+    print(f"{'case':<26} {'links/s':>12} {'prev':>12} {'change':>8} {'peak KB':>10} {'prev':>10}")
+    for name, row in current['results'].items():
+        prev = previous.get('results', {}).get(name)
+        if not prev:
+            print(f"{name:<26} {row['links_per_sec']:>12.0f} {'-':>12} {'-':>8} {row['peak_kb']:>10.1f} {'-':>10}")
+            continue
+        change = (row['links_per_sec'] / prev['links_per_sec'] - 1) * 100 if prev['links_per_sec'] else 0
+        print(f"{name:<26} {row['links_per_sec']:>12.0f} {prev['links_per_sec']:>12.0f} {change:>+7.1f}% "
+              f"{row['peak_kb']:>10.1f} {prev['peak_kb']:>10.1f}")
+    for key in ('size', 'seed'):
+        if current['meta'].get(key) != previous.get('meta', {}).get(key):
+            print(f"注意：语料参数 {key} 不同，结果不可直接比较")
+    if current['meta'].get('parsed_ok') != previous.get('meta', {}).get('parsed_ok'):
+        print(f"注意：可解析链接数不同 ({current['meta'].get('parsed_ok')} vs {previous.get('meta', {}).get('parsed_ok')})")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='link_parser 基准测试')
+    parser.add_argument('--size', type=int, default=DEFAULT_SIZE, help='语料链接数')
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED, help='语料随机种子')
+    parser.add_argument('--repeat', type=int, default=3, help='每项取最快的一次')
+    parser.add_argument('--baseline', metavar='REV', help='测试指定 git 版本的 link_parser，而不是当前工作区')
+    parser.add_argument('-o', '--output', help='把 JSON 结果写入文件')
+    parser.add_argument('--compare', metavar='JSON', help='与之前保存的 JSON 结果对比')
+    args = parser.parse_args(argv)
+
+    module = load_parser_from_git(args.baseline) if args.baseline else load_parser_from_file()
+    report = run(module, args.size, args.seed, args.repeat)
+    report['meta']['source'] = args.baseline or 'working-tree'
+
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            compare(report, json.load(f))
+    elif not args.output:
+        print(output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())